@@ -145,7 +145,7 @@ def create_request(action, value=None):
         content=bytes(action + value, encoding="utf-8"),
     )
 
-def req_connection(host, port, request):
+def req_connection(host, port, request, keepalive=False):
   if local:
     addr = str(port)
     sockfam = socket.AF_UNIX
@@ -156,8 +156,9 @@ def req_connection(host, port, request):
   sock.setblocking(True)
   sock.connect_ex(addr)
   events = selectors.EVENT_READ | selectors.EVENT_WRITE
-  message = applylib.Message(sel, sock, addr, request)
+  message = applylib.Message(sel, sock, addr, request, keepalive)
   sel.register(sock, events, data=message)
+  return message
 
 def getApplyPars( args ):
   if args['examples'] == None:
@@ -198,8 +199,9 @@ inpdata = inpdata.astype('float32')
 start = time.time()
 
 host,port = args['addr'], args['port']
-req_connection(host, port, create_request('status'))
-req_connection(host, port, create_request('outputs',pars['outputnms']))
+# All requests are pipelined over a single connection
+conn = req_connection(host, port, create_request('status'), keepalive=True)
+conn.add_request(create_request('outputs',pars['outputnms']))
 applydict = {
   'arr': inpdata,
   'inp_shape': shape,
@@ -215,9 +217,9 @@ for i in range(nrrepeats):
   applydict['idx'] = i
   for idy in range(0,nrtrcs_in-shape[1]+1,chunk_step):
     applydict['idy'] = idy
-    req_connection(host, port, create_request('data',applydict))
+    conn.add_request(create_request('data',applydict))
 
-req_connection(host, port, create_request('kill'))
+conn.add_request(create_request('kill'))
 
 try:
   while True:
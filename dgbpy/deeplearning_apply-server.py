@@ -33,6 +33,36 @@ datagrp = parser.add_argument_group( 'Data' )
 datagrp.add_argument( '--mldir',
             dest='mldir', nargs=1,
             help='Machine Learning Directory' )
+procgrp = parser.add_argument_group( 'Processing' )
+procgrp.add_argument( '--workers',
+            dest='nrworkers', action='store',
+            type=int, default=0,
+            help='Number of threads applying the model (0: apply in the network loop)' )
+procgrp.add_argument( '--queue-size',
+            dest='queuesize', action='store',
+            type=int, default=None,
+            help='Maximum number of received requests waiting for a worker' )
+procgrp.add_argument( '--batch-wait',
+            dest='batchwait', action='store',
+            type=float, default=0,
+            help='Maximum time in ms to wait for the windows of other requests, '
+                 'to be applied together (requires several workers)' )
+procgrp.add_argument( '--batch-size',
+            dest='maxbatchsize', action='store',
+            type=int, default=4096,
+            help='Maximum number of windows applied together' )
+procgrp.add_argument( '--quantized',
+            dest='quantized', action='store_true', default=False,
+            help='Apply the int8 quantized version of the model, if saved with the model' )
+procgrp.add_argument( '--onnx',
+            dest='onnx', action='store_true', default=False,
+            help='Apply the model with onnxruntime, without loading its platform '
+                 '(the model is exported to ONNX once if needed)' )
+procgrp.add_argument( '--onnx-threads',
+            dest='onnxthreads', action='store',
+            type=int, default=None,
+            help='Number of threads of each onnxruntime operator (0: onnxruntime default), '
+                 'for the models applied with onnxruntime' )
 loggrp = parser.add_argument_group( 'Logging' )
 loggrp.add_argument( '--log',
             dest='logfile', metavar='file', nargs='?',
@@ -108,10 +138,10 @@ def timerCB():
   if not parentproc.is_running():
     os.kill( psutil.Process().pid, signal.SIGINT )
 
-def accept_wrapper(sock,applier):
+def accept_wrapper(sock,applier,workers):
   conn, addr = sock.accept()  # Should be ready to read
   conn.setblocking(True)
-  message = applylib.Message(sel, conn, addr, applier)
+  message = applylib.Message(sel, conn, addr, applier, workers)
   sel.register(conn, selectors.EVENT_READ, data=message)
 
 timer = Timer(15, timerCB)
@@ -123,16 +153,30 @@ if 'parentpid' in args:
     timer.start()
 
 applier = None
+workers = None
 try:
   if applier == None:
-    applier = applylib.ModelApplier( args['modelfile'].name, args['fakeapply'] )
+    sessopts = None
+    if args['onnxthreads'] != None:
+      import dgbpy.onnx_classes as dgbonnx
+      sessopts = dgbonnx.getSessionOptions( intra_op_threads=args['onnxthreads'] )
+    applier = applylib.ModelApplier( args['modelfile'].name, args['fakeapply'],
+                                     quantized=args['quantized'], onnx=args['onnx'],
+                                     sessopts=sessopts )
+    log_msg( 'Server started', applylib.getServerTimeStr() )
+  if args['nrworkers'] > 0:
+    workers = applylib.ApplyWorkers( sel, args['nrworkers'], args['queuesize'] )
+    if args['nrworkers'] > 1 and args['batchwait'] > 0:
+      applier.useBatching( args['maxbatchsize'], args['batchwait']/1000 )
   lastmessage = False
   cont = True
   while cont:
     events = sel.select(timeout=300)
     for key, mask in events:
       if key.data is None:
-        accept_wrapper(key.fileobj,applier)
+        accept_wrapper(key.fileobj,applier,workers)
+      elif key.data is workers:
+        workers.process_events(mask)
       else:
         message = key.data
         try:
@@ -155,4 +199,6 @@ except applylib.ExitCommand:
   std_msg('Found dead parent, exiting')
 finally:
   timer.cancel()
+  if workers != None:
+    workers.close()
   sel.close()
@@ -8,6 +8,7 @@
 #
 
 import sys
+import collections
 import selectors
 import json
 import io
@@ -16,22 +17,41 @@ import struct
 
 from odpy.common import *
 
+maxsendbuffers = 512
+recvheadersize = 65536
 
 class Message:
-    def __init__(self, selector, sock, addr, request):
+    """Client side of a connection to the apply server
+
+    By default a single request is sent, and the connection is closed once
+    its response has been received. With keepalive set, any number of requests
+    can be queued with add_request: they are all sent (pipelined) over the
+    same connection, and their responses are received in the same order.
+    The connection is closed once all queued requests have been answered.
+    """
+
+    def __init__(self, selector, sock, addr, request, keepalive=False):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self.keepalive = keepalive
+        self._recv_buffer = bytearray()
+        self._content = None
+        self._content_view = None
+        self._content_pos = 0
+        self._send_buffer = list()
         self._payload_len = None
         self._reqid = None
         self._subid = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
-        self.request = request
-        self._request_queued = False
+        self.responses = list()
+        self._requests = collections.deque()
+        self._nrpending = 0
+        self._nextreqid = 1
+        if request != None:
+            self._requests.append( request )
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -48,26 +68,58 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(16777216)
+            if self._content_view is not None and \
+               self._content_pos < len(self._content_view):
+                nrbytes = self.sock.recv_into(self._content_view[self._content_pos:])
+                self._content_pos += nrbytes
+            else:
+                data = self.sock.recv(recvheadersize)
+                nrbytes = len(data)
+                self._recv_buffer += data
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nrbytes:
                 raise RuntimeError("Peer closed.")
 
+    def _start_content(self, content_len):
+        """Allocates the content buffer, to be filled by recv_into."""
+        self._content = bytearray(content_len)
+        self._content_view = memoryview(self._content)
+        nrbytes = min(content_len, len(self._recv_buffer))
+        self._content_view[:nrbytes] = self._recv_buffer[:nrbytes]
+        self._content_pos = nrbytes
+        self._recv_buffer = self._recv_buffer[nrbytes:]
+
+    def _content_complete(self):
+        return self._content_view is not None and \
+               self._content_pos == len(self._content_view)
+
     def _write(self):
         if self._send_buffer:
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if hasattr(self.sock,'sendmsg'):
+                    sent = self.sock.sendmsg(self._send_buffer[:maxsendbuffers])
+                else:
+                    sent = self.sock.send(self._send_buffer[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self._advance_send_buffer(sent)
+
+    def _advance_send_buffer(self, sent):
+        """Drops the sent bytes from the send buffers, without copying."""
+        while self._send_buffer:
+            buf = self._send_buffer[0]
+            if sent < buf.nbytes:
+                if sent > 0:
+                    self._send_buffer[0] = buf[sent:]
+                break
+            sent -= buf.nbytes
+            self._send_buffer.pop(0)
 
     def _json_encode(self, obj, encoding):
         json_hdr = json.dumps(obj, ensure_ascii=False).encode(encoding)
@@ -83,10 +135,10 @@ class Message:
         return (obj,json_bytes[4+json_hdr:])
 
     def _array_encode(self, objs):
-        ret = bytes()
+        ret = list()
         shapes = list()
         for obj in objs:
-          ret += obj.tobytes()
+          ret.append( np.ascontiguousarray(obj).reshape(-1).view(np.uint8) )
           shapes.append( obj.shape )
         return (ret,shapes)
 
@@ -107,20 +159,27 @@ class Message:
     def _create_message(
         self, *, content_bytes, content_type, content_encoding, arrsize
     ):
+        if isinstance(content_bytes,list):
+            content_bufs = [memoryview(buf) for buf in content_bytes]
+        else:
+            content_bufs = [memoryview(content_bytes)]
         jsonheader = {
             'byteorder': sys.byteorder,
             'content-type': content_type,
             'content-encoding': content_encoding,
-            'content-length': len(content_bytes),
+            'content-length': sum([buf.nbytes for buf in content_bufs]),
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
+        if self.keepalive:
+          jsonheader.update({ 'keep-alive': True })
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
-        od_hdr =   struct.pack('=i',len(jsonheader_bytes)+len(content_bytes)) \
-                 + struct.pack('=i',1) \
+        payloadlen = len(jsonheader_bytes) + jsonheader['content-length']
+        od_hdr =   struct.pack('=i',payloadlen) \
+                 + struct.pack('=i',self._nextreqid) \
                  + struct.pack('=h',-1)
-        message = od_hdr + jsonheader_bytes + content_bytes
-        return message
+        self._nextreqid += 1
+        return [memoryview(od_hdr + jsonheader_bytes)] + content_bufs
 
     def _process_response_json_content(self):
         content = self.response
@@ -144,27 +203,32 @@ class Message:
     def read(self):
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+        # Several pipelined responses may have been received at once
+        while self.sock is not None:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
 
-        if self.jsonheader:
-            if self.response is None:
-                self.process_response()
+            if self.jsonheader is None or not self.process_response():
+                break
 
     def write(self):
-        if not self._request_queued:
+        if self._requests:
             self.queue_request()
 
         self._write()
 
-        if self._request_queued:
-            if not self._send_buffer:
-                # Set selector to listen for read events, we're done writing.
-                self._set_selector_events_mask("r")
+        if not self._send_buffer:
+            # Set selector to listen for read events, we're done writing.
+            self._set_selector_events_mask("r")
+
+    def add_request(self, request):
+        """Queues a request, to be sent over this (kept-alive) connection."""
+        self._requests.append( request )
+        self._set_selector_events_mask("rw")
 
     def close(self):
         try:
@@ -187,9 +251,16 @@ class Message:
             self.sock = None
 
     def queue_request(self):
-        content = self.request['content']
-        content_type = self.request['type']
-        content_encoding = self.request['encoding']
+        while self._requests:
+            self.request = self._requests.popleft()
+            message = self._create_message(**self._get_request_content(self.request))
+            self._send_buffer.extend( message )
+            self._nrpending += 1
+
+    def _get_request_content(self, request):
+        content = request['content']
+        content_type = request['type']
+        content_encoding = request['encoding']
         if content_type == 'text/json':
             req = {
                 'content_bytes': self._json_encode(content, content_encoding),
@@ -212,13 +283,11 @@ class Message:
                 'content_encoding': content_encoding,
                 'arrsize': None,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        return req
 
     def process_protoheader(self):
         hdrlen = 10
-        if len(self._recv_buffer) >= hdrlen:
+        if len(self._recv_buffer) >= hdrlen+4:
           self._payload_len = struct.unpack('=i',self._recv_buffer[0:4])[0]
           self._reqid = struct.unpack('=i',self._recv_buffer[4:8])[0]
           self._subid = struct.unpack('=h',self._recv_buffer[8:hdrlen])[0]
@@ -226,7 +295,7 @@ class Message:
           self._recv_buffer = self._recv_buffer[hdrlen:]
 
     def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
+        hdrlen = 4 + self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
             (self.jsonheader,self._recv_buffer) = self._json_decode(
                 self._recv_buffer, "utf-8"
@@ -239,16 +308,15 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            self._start_content(self.jsonheader["content-length"])
 
     def process_response(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        if not self._content_complete():
+            return False
+        data = self._content
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
-            (self.response,self._recv_buffer) = self._json_decode(data, encoding)
+            (self.response,_) = self._json_decode(data, encoding)
             self._process_response_json_content()
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
@@ -263,5 +331,21 @@ class Message:
                 self.addr,
             )
             self._process_response_binary_content()
-        # Close when response has been processed
-        self.close()
+        self.responses.append( self.response )
+        self._nrpending -= 1
+        # Close when all responses have been processed
+        if self._nrpending < 1 and not self._requests:
+            self.close()
+            return False
+        self._next_response()
+        return True
+
+    def _next_response(self):
+        self._payload_len = None
+        self._reqid = None
+        self._subid = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self._content = None
+        self._content_view = None
+        self._content_pos = 0
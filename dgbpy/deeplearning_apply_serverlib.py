@@ -12,9 +12,13 @@ import json
 import numpy as np
 import os
 import psutil
+import queue
 import selectors
+import socket
 import struct
 import sys
+import threading
+import time
 import traceback as tb
 
 from odpy.common import *
@@ -22,21 +26,59 @@ import dgbpy.keystr as dgbkeys
 from dgbpy import hdf5 as dgbhdf5
 from dgbpy import mlio as dgbmlio
 from dgbpy import mlapply as dgbmlapply
-from dgbpy import dgbscikit, dgbkeras
+from dgbpy import mlscaler as dgbscaler
 
 class ExitCommand(Exception):
     pass
 
+applyblocksize = 256 * 1024 * 1024
+maxsendbuffers = 512
+recvheadersize = 65536
+
+def getSlidingWindows( inp, windowshape, chunksz, nrzoutsamps ):
+    """ Gets all apply windows of an input block, as a read-only strided view
+
+    Parameters:
+      * inp (ndarray): input block, of shape (nrattribs,nrz), (nrattribs,nrtrcs,nrz)
+        or (nrattribs,nrinl,nrcrl,nrz)
+      * windowshape (tuple): shape of a single window (nrattribs,nrinl,nrcrl,nrz)
+      * chunksz (int): number of window positions along the last lateral axis
+      * nrzoutsamps (int): number of window positions along the z axis
+
+    Returns:
+      * ndarray: view of shape (chunksz,nrzoutsamps)+windowshape, no data is copied
+    """
+
+    strides = inp.strides
+    if len(inp.shape) == 2:
+        winstrides = (strides[0],0,0,strides[1])
+        chunkstride = 0
+    elif len(inp.shape) == 3:
+        winstrides = (strides[0],0,strides[1],strides[2])
+        chunkstride = strides[1]
+    else:
+        winstrides = strides
+        chunkstride = strides[2]
+    return np.lib.stride_tricks.as_strided( inp,
+                        shape=(chunksz,nrzoutsamps)+tuple(windowshape),
+                        strides=(chunkstride,strides[-1])+winstrides,
+                        writeable=False )
+
 class ModelApplier:
-    def __init__(self, modelfnm,isfake=False):
+    def __init__(self, modelfnm,isfake=False,quantized=False,onnx=False,sessopts=None):
         self.pars_ = None
         self.fakeapply_ = isfake
+        self.quantized_ = quantized
+        self.onnx_ = onnx
+        self.sessopts_ = sessopts
         self.scaler_ = None
         self.extscaler_ = None
         self.info_ = self._get_info(modelfnm)
         self.model_ = None
         self.applyinfo_ = None
         self.batchsize_ = None
+        self.batcher_ = None
+        self.nrapplied_ = 0
         self.debugstr = ''
 
     def _get_info(self,modelfnm):
@@ -51,14 +93,47 @@ class ModelApplier:
         else:
             self.applyinfo_ = dgbmlio.getApplyInfo( self.info_, outputs )
         (self.scaler_,self.extscaler_) = self.getScaler( outputs )
-        if dgbkeras.prefercpustr in outputs:
-            dgbkeras.set_compute_device( outputs[dgbkeras.prefercpustr] )
-        if dgbkeras.defbatchstr in outputs:
-            self.batchsize_ = outputs[dgbkeras.defbatchstr]
+        if dgbkeys.prefercpustr in outputs and not self.onnx_ and \
+           self.info_.get(dgbkeys.plfdictstr) == dgbkeys.kerasplfnm:
+            # Only import TensorFlow for Keras models
+            from dgbpy import dgbkeras
+            dgbkeras.set_compute_device( outputs[dgbkeys.prefercpustr] )
+        if dgbkeys.defbatchstr in outputs:
+            self.batchsize_ = outputs[dgbkeys.defbatchstr]
         if self.fakeapply_:
             return None
         modelfnm = self.info_[dgbkeys.filedictstr]
-        (self.model_,self.info_) = dgbmlio.getModel( modelfnm, fortrain=False )
+        (self.model_,self.info_) = dgbmlio.getModel( modelfnm, fortrain=False,
+                                                     quantized=self.quantized_,
+                                                     onnx=self.onnx_,
+                                                     sessopts=self.sessopts_ )
+        log_msg( 'Model loaded', getServerTimeStr() )
+        self.warmUp()
+
+    def warmUp(self):
+        """ Applies the model once on a dummy brick of the model input size,
+            so that the first request does not pay for the lazy initializations
+            of the platform (graph building, memory allocations)
+        """
+
+        inpshape = self.info_[dgbkeys.inpshapedictstr]
+        nrattribs = dgbhdf5.getNrAttribs( self.info_ )
+        if isinstance(inpshape,int):
+            shape = (nrattribs,inpshape)
+        else:
+            shape = (nrattribs,*inpshape)
+        self.nrapplied_ = -1 # Not counted as a prediction
+        try:
+            self.doWork( np.zeros(shape,dtype=np.float32) )
+        except Exception as e:
+            log_msg( '[Warning] Model warm-up failed:', repr(e) )
+        else:
+            log_msg( 'Model warmed up', getServerTimeStr() )
+        self.debugstr = ''
+        self.nrapplied_ = 0
+
+    def isReady(self):
+        return self.fakeapply_ or self.hasModel()
 
     def _usePar(self, pars):
         self.pars_ = pars
@@ -72,7 +147,7 @@ class ModelApplier:
         for i in range(dgbhdf5.getNrAttribs(self.info_)):
             stddevs.append( 50 )
             means.append( 128 )
-        self.extscaler_ = dgbscikit.getNewScaler( means, stddevs )
+        self.extscaler_ = dgbscaler.getNewScaler( means, stddevs )
         return self.extscaler_
 
     def getScaler( self, outputs ):
@@ -89,7 +164,7 @@ class ModelApplier:
             scaleratios.append( scl['scaleratio'] )
 
         if len(means) > 0:
-            self.scaler_ = dgbscikit.getNewScaler( means, stddevs )
+            self.scaler_ = dgbscaler.getNewScaler( means, stddevs )
         inputs = self.info_[dgbkeys.inputdictstr]
         if dgbhdf5.isLogInput( self.info_ ):
             inputs = self.info_[dgbkeys.inputdictstr]
@@ -125,7 +200,7 @@ class ModelApplier:
                     means.append( inpscale.mean_[i] )
                     stddevs.append( inpscale.scale_[i] )
                   if len(means) > 0:
-                    self.scaler_ = dgbscikit.getNewScaler( means, stddevs )
+                    self.scaler_ = dgbscaler.getNewScaler( means, stddevs )
         elif dgbkeys.mlsoftkey in inputs:
             inp = inputs[dgbkeys.mlsoftkey]
             means = list()
@@ -135,7 +210,7 @@ class ModelApplier:
                 for (scale,mean) in zip(inpscale.scale_,inpscale.mean_):
                     stddevs.append( scale )
                     means.append( mean )
-                self.extscaler_ = dgbscikit.getNewScaler( means, stddevs )
+                self.extscaler_ = dgbscaler.getNewScaler( means, stddevs )
             else:
                 self.extscaler_ = self.getDefaultScaler()
 
@@ -160,43 +235,19 @@ class ModelApplier:
         nroutsamps = nrzoutsamps * chunksz
         samples_shape = dgbhdf5.get_np_shape( inpshape, nrattribs=nrattribs,
                                               nrpts=nrzoutsamps )
-        nrtrcs = samples_shape[-2]
         nrz = samples_shape[-1]
-        allsamples = list()
-        for i in range(chunksz):
-          if nrz == 1:
-            inp = np.transpose( inp )
-            if chunksz < 2:
-              allsamples.append( np.resize( np.array(inp), samples_shape ) )
-            else:
-              allsamples.append( np.resize( np.array(inp), samples_shape ) ) #review
-          else:
-            loc_samples = np.empty( samples_shape, dtype=inp.dtype )
-            if vertical:
-              for zidz in range(nrzoutsamps):
-                loc_samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
-            else:
-              if is2d:
-                for zidz in range(nrzoutsamps):
-                  loc_samples[zidz] = inp[:,i:i+nrtrcs+1,zidz:zidz+nrz]                 
-              else:
-                for zidz in range(nrzoutsamps):
-                  loc_samples[zidz] = inp[:,:,i:i+nrtrcs+1,zidz:zidz+nrz]
-            allsamples.append( loc_samples )
-        samples = np.concatenate( allsamples )
-#        self.debugstr = self.debug_msg( samples[0,0,0,0,:1].squeeze() )
-        samples = dgbscikit.scale( samples, self.scaler_ )
-#        self.debugstr = self.debug_msg( samples[0,0,0,0,:1].squeeze() )
-        samples = dgbscikit.unscale( samples, self.extscaler_ )
-#        self.debugstr = self.debug_msg( samples[0,0,0,0,:1].squeeze() )
-#        min = np.min( samples ) 
-#        samples = samples-min
-#        max = np.max( samples )
-#        samples = samples/max
-#        samples = samples*255 
-        ret = dgbmlapply.doApply( self.model_, self.info_, samples, \
-                                  scaler=None, applyinfo=self.applyinfo_, \
-                                  batchsize=self.batchsize_ )
+        if nrz == 1:
+          inp = np.transpose( inp )
+          allsamples = list()
+          for i in range(chunksz):
+            allsamples.append( np.resize( np.array(inp), samples_shape ) ) #review
+          ret = self.applySamples( np.concatenate(allsamples) )
+        else:
+          windows = getSlidingWindows( inp, samples_shape[1:], chunksz, nrzoutsamps )
+          ret = self.applyWindows( windows )
+        self.nrapplied_ += 1
+        if self.nrapplied_ == 1:
+            log_msg( 'First prediction', getServerTimeStr() )
         res = list()
         outkeys = list()
         outkeys.append( dgbkeys.preddictstr )
@@ -210,6 +261,78 @@ class ModelApplier:
             res.append( ret[outkey] )
         return res
 
+    def applySamples(self,samples):
+#        self.debugstr = self.debug_msg( samples[0,0,0,0,:1].squeeze() )
+        (factor,offset) = dgbscaler.getAffineTransform( samples.shape[1], \
+                                                        scaler=self.scaler_, \
+                                                        unscaler=self.extscaler_ )
+        samples = dgbscaler.applyAffineTransform( samples, factor, offset, \
+                                                  dtype=self.getSamplesType(samples) )
+#        self.debugstr = self.debug_msg( samples[0,0,0,0,:1].squeeze() )
+        if self.batcher_ != None:
+            return self.batcher_.apply( samples )
+        return self._doApply( samples )
+
+    def getSamplesType(self,samples):
+        if np.issubdtype( samples.dtype, np.floating ):
+            return samples.dtype
+        return np.float32
+
+    def _doApply(self,samples):
+        return dgbmlapply.doApply( self.model_, self.info_, samples, \
+                                   scaler=None, applyinfo=self.applyinfo_, \
+                                   batchsize=self.batchsize_ )
+
+    def getSamplesAxis(self):
+        """ Axis of the samples in the arrays returned by doApply: first for
+            image to image models, last otherwise (transposed outputs)
+        """
+        if dgbhdf5.isImg2Img( self.info_ ):
+            return 0
+        return -1
+
+    def useBatching(self,maxbatchsize,maxwait):
+        """ Merges the samples of concurrent requests into larger batches
+
+        Parameters:
+          * maxbatchsize (int): maximum number of samples of a merged batch
+          * maxwait (float): maximum waiting time for more samples, in seconds
+        """
+
+        self.batcher_ = ApplyBatcher( self._doApply, maxbatchsize, maxwait,
+                                      samplesaxis=self.getSamplesAxis() )
+
+    def applyWindows(self,windows):
+        """ Applies the model on all windows of a getSlidingWindows view
+
+        The windows are copied into contiguous arrays of at most
+        applyblocksize bytes, in the order trace offset first, then z.
+        """
+
+        (chunksz,nrzoutsamps) = windows.shape[:2]
+        nrwindows = chunksz * nrzoutsamps
+        windowshape = windows.shape[2:]
+        windowsz = int(np.prod(windowshape)) * windows.itemsize
+        blocksz = max( 1, applyblocksize // windowsz )
+        allret = list()
+        for start in range(0,nrwindows,blocksz):
+            stop = min( start+blocksz, nrwindows )
+            samples = np.empty( (stop-start,)+windowshape, dtype=windows.dtype )
+            pos = start
+            while pos < stop:
+                (i,zidz) = divmod( pos, nrzoutsamps )
+                nr = min( stop-pos, nrzoutsamps-zidz )
+                samples[pos-start:pos-start+nr] = windows[i,zidz:zidz+nr]
+                pos += nr
+            allret.append( self.applySamples(samples) )
+        if len(allret) == 1:
+            return allret[0]
+        ret = {}
+        for outkey in allret[0]:
+            ret.update({outkey: np.concatenate([blockret[outkey] for blockret in allret],
+                                               axis=self.getSamplesAxis())})
+        return ret
+
     def debug_msg(self,a,b=None,c=None,d=None,e=None,f=None,g=None,h=None):
         ret = str(a)
         if b != None:
@@ -232,13 +355,194 @@ class ModelApplier:
         return self.debugstr
 
 
+def getServerTimeStr():
+    starttime = psutil.Process().create_time()
+    return '{:.3f} s. after server start'.format( time.time()-starttime )
+
+class ApplyBatcher:
+    """Merges the samples applied concurrently by several threads
+
+    The first waiting thread collects the samples of the other threads, up to
+    maxbatchsize samples or for at most maxwait seconds, applies them in a
+    single call, and splits the results back per thread. The next batch can
+    be collected while this one is being applied.
+    The samples are merged along the first axis, and the results are split
+    along samplesaxis (see ModelApplier.getSamplesAxis).
+    """
+
+    def __init__(self, applyfn, maxbatchsize, maxwait, samplesaxis=0):
+        self._applyfn = applyfn
+        self.maxbatchsize = maxbatchsize
+        self.maxwait = maxwait
+        self.samplesaxis = samplesaxis
+        self._cond = threading.Condition()
+        self._pending = list()
+        self._collecting = False
+
+    def apply(self, samples):
+        if len(samples) >= self.maxbatchsize:
+            return self._applyfn( samples )
+        item = {
+          'samples': samples,
+          'done': False,
+          'result': None,
+          'error': None,
+        }
+        with self._cond:
+            self._pending.append( item )
+            self._cond.notify_all()
+            while not item['done']:
+                if self._collecting or not self._isPending( item ):
+                    self._cond.wait()
+                    continue
+                self._collecting = True
+                batch = self._collect( item )
+                self._collecting = False
+                self._cond.notify_all()
+                self._cond.release()
+                try:
+                    self._applyBatch( batch )
+                finally:
+                    self._cond.acquire()
+                    self._cond.notify_all()
+        if item['error'] != None:
+            raise item['error']
+        return item['result']
+
+    def _isPending(self, item):
+        return any( [other is item for other in self._pending] )
+
+    def _matches(self, item, other):
+        return item['samples'].shape[1:] == other['samples'].shape[1:] and \
+               item['samples'].dtype == other['samples'].dtype
+
+    def _collect(self, item):
+        deadline = time.monotonic() + self.maxwait
+        while True:
+            nrsamples = sum( [len(other['samples']) for other in self._pending \
+                                        if self._matches(item,other)] )
+            remaining = deadline - time.monotonic()
+            if nrsamples >= self.maxbatchsize or remaining <= 0:
+                break
+            self._cond.wait( remaining )
+        batch = [item]
+        nrsamples = len(item['samples'])
+        for other in self._pending:
+            if other is item or not self._matches(item,other):
+                continue
+            if nrsamples + len(other['samples']) > self.maxbatchsize:
+                break
+            batch.append( other )
+            nrsamples += len(other['samples'])
+        self._pending = [other for other in self._pending \
+                         if not any([other is inbatch for inbatch in batch])]
+        return batch
+
+    def _applyBatch(self, batch):
+        try:
+            if len(batch) == 1:
+                results = [self._applyfn( batch[0]['samples'] )]
+            else:
+                samples = np.concatenate( [item['samples'] for item in batch] )
+                ret = self._applyfn( samples )
+                offsets = np.cumsum( [len(item['samples']) for item in batch] )[:-1]
+                results = [dict() for item in batch]
+                for outkey in ret:
+                    for res,arr in zip(results,np.split(ret[outkey],offsets,
+                                                        axis=self.samplesaxis)):
+                        res.update({outkey: arr})
+        except Exception as e:
+            results = None
+            error = e
+        for idx,item in enumerate(batch):
+            if results == None:
+                item['error'] = error
+            else:
+                item['result'] = results[idx]
+            item['done'] = True
+
+
+class ApplyWorkers:
+    """Pool of threads applying the model on the array requests
+
+    The selectors loop keeps doing all network I/O: a fully received apply
+    request is removed from the selector and queued (the queue is bounded,
+    so the loop waits when all workers are busy). A worker creates the
+    response, using the single shared ModelApplier, and hands the message
+    back to the loop through a wake-up socket; the loop then sends it.
+    The inference libraries release the GIL while computing.
+    """
+
+    def __init__(self, selector, nrworkers, maxqueued=None):
+        self.selector = selector
+        if maxqueued == None:
+            maxqueued = 2 * nrworkers
+        self._jobs = queue.Queue( maxsize=maxqueued )
+        self._done = queue.Queue()
+        (self._wakeup_recv,self._wakeup_send) = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, data=self)
+        self._threads = list()
+        for i in range(nrworkers):
+            thread = threading.Thread( target=self._run, daemon=True,
+                                       name=f'ApplyWorker-{i}' )
+            thread.start()
+            self._threads.append( thread )
+
+    def submit(self, message):
+        self.selector.unregister(message.sock)
+        self._jobs.put( message )
+
+    def _run(self):
+        while True:
+            message = self._jobs.get()
+            if message is None:
+                break
+            try:
+                message.create_response()
+            except Exception:
+                message.error = tb.format_exc()
+            self._done.put( message )
+            self._wakeup_send.send( b'\0' )
+
+    def process_events(self, mask):
+        try:
+            self._wakeup_recv.recv(4096)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                message = self._done.get_nowait()
+            except queue.Empty:
+                break
+            self.selector.register(message.sock, selectors.EVENT_WRITE, data=message)
+            if message.error != None:
+                print( f"error: apply exception for {message.addr}:\n{message.error}" )
+                message.close()
+
+    def close(self):
+        for thread in self._threads:
+            self._jobs.put( None )
+        for thread in self._threads:
+            thread.join( timeout=1 )
+        try:
+            self.selector.unregister(self._wakeup_recv)
+        except Exception:
+            pass
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+
 class Message:
-    def __init__(self, selector, sock, addr, applier):
+    def __init__(self, selector, sock, addr, applier, workers=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = bytearray()
+        self._content = None
+        self._content_view = None
+        self._content_pos = 0
+        self._send_buffer = list()
         self._payload_len = None
         self._reqid = None
         self._subid = None
@@ -248,6 +552,9 @@ class Message:
         self.response_created = False
         self.applier = applier
         self.lastmessage = False
+        self.keepalive = False
+        self.workers = workers
+        self.error = None
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -264,29 +571,89 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(16777216)
+            if self._content_view is not None and \
+               self._content_pos < len(self._content_view):
+                nrbytes = self.sock.recv_into(self._content_view[self._content_pos:])
+                self._content_pos += nrbytes
+            else:
+                data = self.sock.recv(recvheadersize)
+                nrbytes = len(data)
+                self._recv_buffer += data
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nrbytes:
+                if self._is_idle():
+                    # Kept-alive connection closed by the peer between requests
+                    self.close()
+                    return False
                 raise RuntimeError("Peer closed.")
+        return True
+
+    def _is_idle(self):
+        return self._payload_len is None and not self._recv_buffer
+
+    def _start_content(self, content_len):
+        """Allocates the content buffer, to be filled by recv_into."""
+        self._content = bytearray(content_len)
+        self._content_view = memoryview(self._content)
+        nrbytes = min(content_len, len(self._recv_buffer))
+        self._content_view[:nrbytes] = self._recv_buffer[:nrbytes]
+        self._content_pos = nrbytes
+        self._recv_buffer = self._recv_buffer[nrbytes:]
+
+    def _content_complete(self):
+        return self._content_view is not None and \
+               self._content_pos == len(self._content_view)
 
     def _write(self):
         if self._send_buffer:
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if hasattr(self.sock,'sendmsg'):
+                    sent = self.sock.sendmsg(self._send_buffer[:maxsendbuffers])
+                else:
+                    sent = self.sock.send(self._send_buffer[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
+                self._advance_send_buffer(sent)
+                # The response has been sent: close when the buffer is drained,
+                # unless the client asked to keep the connection alive.
                 if sent and not self._send_buffer:
-                    self.close()
+                    if self.keepalive and not self.lastmessage:
+                        self._next_request()
+                    else:
+                        self.close()
+
+    def _next_request(self):
+        """Prepares for the next request on a kept-alive connection."""
+        self._payload_len = None
+        self._reqid = None
+        self._subid = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.request = None
+        self.response_created = False
+        self._content = None
+        self._content_view = None
+        self._content_pos = 0
+        self._set_selector_events_mask("r")
+        # A pipelined request may already be (partly) received
+        self._process_read()
+
+    def _advance_send_buffer(self, sent):
+        """Drops the sent bytes from the send buffers, without copying."""
+        while self._send_buffer:
+            buf = self._send_buffer[0]
+            if sent < buf.nbytes:
+                if sent > 0:
+                    self._send_buffer[0] = buf[sent:]
+                break
+            sent -= buf.nbytes
+            self._send_buffer.pop(0)
 
     def _json_encode(self, obj, encoding):
         json_hdr = json.dumps(obj, ensure_ascii=False).encode(encoding)
@@ -319,21 +686,25 @@ class Message:
     def _create_message(
         self, *, content_bytes, content_type, content_encoding, arrsize
     ):
+        if isinstance(content_bytes,list):
+            content_bufs = [memoryview(buf) for buf in content_bytes]
+        else:
+            content_bufs = [memoryview(content_bytes)]
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
+            "content-length": sum([buf.nbytes for buf in content_bufs]),
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
         (self,jsonheader) = self._add_debug_str( jsonheader )
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
-        payload = jsonheader_bytes + content_bytes
-        od_hdr =   struct.pack('=i',len(payload)) \
+        payloadlen = len(jsonheader_bytes) + jsonheader['content-length']
+        od_hdr =   struct.pack('=i',payloadlen) \
                  + struct.pack('=i',self._reqid) \
                  + struct.pack('=h',self._subid)
-        return od_hdr + payload
+        return [memoryview(od_hdr + jsonheader_bytes)] + content_bufs
 
     def _create_response_json_content(self):
         action = self.request.get('action')
@@ -341,6 +712,7 @@ class Message:
         if action == 'status':
             content['result'] = 'Server online'
             content['pid'] = psutil.Process().pid
+            content['ready'] = self.applier != None and self.applier.isReady()
         elif action == 'kill':
             content['result'] = 'Kill request received'
             self.lastmessage = True
@@ -385,11 +757,11 @@ class Message:
             }
             return (self,response)
 
-        ret = bytes()
+        ret = list()
         dtypes = list()
         shapes = list()
         for arr in res:
-          ret += arr.tobytes()
+          ret.append( np.ascontiguousarray(arr).reshape(-1).view(np.uint8) )
           shapes.append( arr.shape )
           dtypes.append( arr.dtype.name )
         response = {
@@ -426,8 +798,10 @@ class Message:
             self.write()
 
     def read(self):
-        self._read()
+        if self._read():
+            self._process_read()
 
+    def _process_read(self):
         if self._payload_len is None:
             self.process_odheader()
 
@@ -475,7 +849,11 @@ class Message:
             self._recv_buffer = self._recv_buffer[hdrlen:]
 
     def process_jsonheader(self):
-        if len(self._recv_buffer) >= 4:
+        hdrlen = 4
+        if len(self._recv_buffer) < hdrlen:
+            return
+        json_hdr = struct.unpack('=i',self._recv_buffer[:hdrlen])[0]
+        if len(self._recv_buffer) >= hdrlen+json_hdr:
             (self._jsonheader_len,self.jsonheader,self._recv_buffer) = \
                 self._json_decode(
                     self._recv_buffer, "utf-8"
@@ -488,17 +866,16 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            self.keepalive = self.jsonheader.get("keep-alive", False)
+            self._start_content(self.jsonheader["content-length"])
 
     def process_request(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        if not self._content_complete():
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        data = self._content
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
-            (jsonsz,self.request,self._recv_buffer) = \
-                                 self._json_decode(data, encoding)
+            (_,self.request,_) = self._json_decode(data, encoding)
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
             dtypes = self.jsonheader['content-encoding']
@@ -510,6 +887,11 @@ class Message:
                 f'received {self.jsonheader["content-type"]} request from',
                 self.addr,
             )
+        if self.workers != None and \
+           self.jsonheader["content-type"] == 'binary/array':
+            # The response is created by a worker, then sent from the main loop
+            self.workers.submit(self)
+            return
         # Set selector to listen for write events, we're done reading.
         self._set_selector_events_mask("w")
 
@@ -523,4 +905,4 @@ class Message:
             response = self._create_response_binary_content()
         message = self._create_message(**response)
         self.response_created = True
-        self._send_buffer += message
+        self._send_buffer.extend( message )
@@ -11,6 +11,8 @@
 import os
 import re
 import json
+import threading
+import weakref
 from datetime import datetime
 import numpy as np
 import math
@@ -49,8 +51,8 @@ def getMLPlatform():
 def getUIMLPlatform():
   return platform[1]
 
-prefercpustr = 'prefercpu'
-defbatchstr = 'defaultbatchsz'
+prefercpustr = dgbkeys.prefercpustr
+defbatchstr = dgbkeys.defbatchstr
 
 keras_dict = {
   dgbkeys.decimkeystr: False,
@@ -61,9 +63,13 @@ keras_dict = {
   'learnrate': 1e-4,
   'epochdrop': 5,
   'type': None,
-  'prefercpu': None
+  'prefercpu': None,
+  'databackend': 'sequence',
+  'datacache': None
 }
 
+databackends = ('sequence','tf.data')
+
 def can_use_gpu():
   from tensorflow import config as tfconfig
   return len(tfconfig.list_physical_devices('GPU')) > 0
@@ -92,7 +98,9 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
                epochs=keras_dict['epochs'],
                batch=keras_dict['batch'], patience=keras_dict['patience'],
                learnrate=keras_dict['learnrate'],epochdrop=keras_dict['epochdrop'],
-               nntype=keras_dict['type'],prefercpu=keras_dict['prefercpu']):
+               nntype=keras_dict['type'],prefercpu=keras_dict['prefercpu'],
+               databackend=keras_dict['databackend'],
+               datacache=keras_dict['datacache']):
   ret = {
     dgbkeys.decimkeystr: dodec,
     'nbchunk': nbchunk,
@@ -101,7 +109,9 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
     'patience': patience,
     'learnrate': learnrate,
     'epochdrop': epochdrop,
-    'type': nntype
+    'type': nntype,
+    'databackend': databackend,
+    'datacache': datacache
   }
   if prefercpu == None:
     prefercpu = get_cpu_preference()
@@ -267,7 +277,7 @@ def train(model,training,params=keras_dict,trainfile=None,logdir=None,
   redirect_stdout()
   import keras
   from keras.callbacks import EarlyStopping, LambdaCallback
-  from dgbpy.keras_classes import TrainingSequence
+  from dgbpy.keras_classes import TrainingSequence, ChunkLoader, TempModelSaver
   import tensorflow as tf
   restore_stdout()
 
@@ -296,20 +306,34 @@ def train(model,training,params=keras_dict,trainfile=None,logdir=None,
     tensor_board = TensorBoard(log_dir=logdir, \
                          write_graph=True, write_grads=False, write_images=True)
     callbacks.append( tensor_board )
-  train_datagen = TrainingSequence( training, False, model, exfilenm=trainfile, batch_size=batchsize, with_augmentation=withaugmentation, tempnm=tempnm )
-  validate_datagen = TrainingSequence( training, True, model, exfilenm=trainfile, batch_size=batchsize, with_augmentation=withaugmentation )
+  if tempnm != None:
+    callbacks.append( TempModelSaver(tempnm) )
+  usetfdata = 'databackend' in params and params['databackend'] == databackends[1]
+  streaming = dgbkeys.streamingdictstr in training
+  if streaming:
+    from dgbpy.keras_classes import StreamingData
+  else:
+    chunkloader = ChunkLoader( training, model )
+    train_datagen = TrainingSequence( training, False, model, exfilenm=trainfile, batch_size=batchsize, with_augmentation=withaugmentation, chunkloader=chunkloader )
+    validate_datagen = TrainingSequence( training, True, model, exfilenm=trainfile, batch_size=batchsize, with_augmentation=withaugmentation, chunkloader=chunkloader )
   nbchunks = len( infos[dgbkeys.trainseldicstr] )
   for ichunk in range(nbchunks):
     log_msg('Starting training iteration',str(ichunk+1)+'/'+str(nbchunks))
-    try:
-      if not train_datagen.set_chunk(ichunk) or not validate_datagen.set_chunk(ichunk):
-        continue
-    except Exception as e:
-      log_msg('')
-      log_msg('Data loading failed because of insufficient memory')
-      log_msg('Try to lower the batch size and restart the training')
-      log_msg('')
-      raise e
+    if streaming:
+      train_datagen = StreamingData( infos, False, model, batch_size=batchsize, ichunk=ichunk, with_augmentation=withaugmentation )
+      validate_datagen = StreamingData( infos, True, model, batch_size=batchsize, ichunk=ichunk, with_augmentation=withaugmentation )
+    else:
+      try:
+        hasdata = train_datagen.set_chunk(ichunk) and validate_datagen.set_chunk(ichunk)
+        chunkloader.prefetch( ichunk+1 )
+        if not hasdata:
+          continue
+      except Exception as e:
+        log_msg('')
+        log_msg('Data loading failed because of insufficient memory')
+        log_msg('Try to lower the batch size and restart the training')
+        log_msg('')
+        raise e
 
     if batchsize == 1:
       log_msg( 'Training on', len(train_datagen), 'samples' )
@@ -326,12 +350,20 @@ def train(model,training,params=keras_dict,trainfile=None,logdir=None,
       raise TypeError
 
     redirect_stdout()
-    x_validate, y_validate, validation_batch_size = \
-                            get_validation_data( validate_datagen )
+    if streaming:
+      datacache = params.get( 'datacache' )
+      traindata = train_datagen.asDataset( cache=datacache )
+      validdata = validate_datagen.asDataset( cache=datacache )
+    elif usetfdata:
+      traindata = train_datagen.asDataset()
+      validdata = validate_datagen.asDataset()
+    else:
+      traindata = train_datagen
+      validdata = validate_datagen
 
     try:
-      model.fit(x=train_datagen,epochs=params['epochs'],verbose=1,
-                validation_data=validate_datagen,callbacks=callbacks)
+      model.fit(x=traindata,epochs=params['epochs'],verbose=1,
+                validation_data=validdata,callbacks=callbacks)
     except Exception as e:
       log_msg('')
       log_msg('Training failed because of insufficient memory')
@@ -389,6 +421,18 @@ def save( model, outfnm ):
   except Exception:
     model.save( outfnm )
 
+def exportOnnx( model, joutfnm ):
+  try:
+    import tf2onnx
+  except ImportError:
+    log_msg( 'tf2onnx is required for the ONNX export of Keras models' )
+    return None
+  tf2onnx.convert.from_keras( model, output_path=joutfnm )
+  return joutfnm
+
+def adaptToOnnx( model, infos, samples ):
+  return adaptToModel( model, samples ).astype( np.float32 )
+
 def load( modelfnm, fortrain, infos=None, pars=keras_dict ):
   redirect_stdout()
   dgb_defs = {
@@ -469,7 +513,7 @@ def apply( model, samples, isclassification, withpred, withprobs, \
   if len(model_outshape) <= 2:
     nroutputs = model_outshape[-1]
   else:
-    model_data_format = get_data_format( model )
+    model_data_format = getLayoutPlans_( model )['data_format']
     if model_data_format == 'channels_first':
       nroutputs = model_outshape[1]
     else:
@@ -518,18 +562,52 @@ def apply( model, samples, isclassification, withpred, withprobs, \
   return ret
 
 
-def adaptToModel( model, samples, sample_data_format='channels_first' ):
+__layoutplans = {}
+__layoutplanslock = threading.Lock()
+
+def getLayoutPlans_( model ):
+  key = id(model)
+  with __layoutplanslock:
+    if not key in __layoutplans:
+      __layoutplans.update({key: {'data_format': get_data_format(model)}})
+      weakref.finalize( model, __layoutplans.pop, key, None )
+    return __layoutplans[key]
+
+def getLayoutPlan( model, shape, sample_data_format='channels_first' ):
+  """ Gets the layout adaptation of samples to the model input (see adaptToModel)
+
+  The plan is computed once per model, samples shape and data format,
+  and executed as views of the samples.
+
+  Parameters:
+    * model (keras.Model): model to be applied or trained
+    * shape (tuple): shape of the samples, without the number of samples
+    * sample_data_format (str): position of the attributes in the samples,
+      'channels_first' or 'channels_last'
+
+  Returns:
+    * dict: adaptation steps, None if the samples fit the model as they are
+  """
+
+  plans = getLayoutPlans_( model )
+  key = ('input',tuple(shape),sample_data_format)
+  if key in plans:
+    return plans[key]
   nrdims = len( model.input_shape ) - 2
-  nrsamples = samples.shape[0]
-  samples_nrdims = len(samples.shape)
-  model_data_format = get_data_format( model )
-  modelcubeszs = getCubeletShape( model )
+  model_data_format = plans['data_format']
+  if model_data_format == 'channels_first':
+    modelcubeszs = model.input_shape[2:]
+  elif model_data_format == 'channels_last':
+    modelcubeszs = model.input_shape[1:-1]
+  else:
+    plans.update({key: None})
+    return None
   if sample_data_format == 'channels_first':
-    nrattribs = samples.shape[1]
-    cube_shape = samples.shape[2:]
+    nrattribs = shape[0]
+    cube_shape = shape[1:]
   else:
-    nrattribs = samples.shape[-1]
-    cube_shape = samples.shape[1:-1]
+    nrattribs = shape[-1]
+    cube_shape = shape[:-1]
   shapelims = ()
   idx = 0
   shrinked = False
@@ -537,244 +615,92 @@ def adaptToModel( model, samples, sample_data_format='channels_first' ):
     if i == 1:
       dimsz = 1
     else:
-      dimsz = min(i,modelcubeszs[idx])
+      modelsz = modelcubeszs[idx]
+      dimsz = i if modelsz == None else min(i,modelsz)
       if dimsz < i:
         shrinked = True
       idx += 1
     shapelims += (dimsz,)
-  cube_shape = np.squeeze( np.empty( shapelims, dtype='uint8' ) ).shape
-  datadims = len(cube_shape)
-  out_shape = (nrsamples,)
-  if model_data_format == 'channels_first':
-    out_shape += (nrattribs,)
-  for i in cube_shape:
-    out_shape += (i,)
-  if len(cube_shape) < 1:
-    out_shape += (1,)
-  if model_data_format == 'channels_last':
-    out_shape += (nrattribs,)
+  cube_shape = tuple([i for i in shapelims if i != 1])
   switchedattribs = model_data_format != sample_data_format
-  if switchedattribs or nrdims != datadims or shrinked or len(cube_shape) < len(shapelims):
-    ret = np.empty( out_shape, dtype=samples.dtype )
-    if model_data_format == 'channels_last':
-      if nrdims == 3:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            ret[:,:,:,:,iattr] = np.reshape( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]], ret[:,:,:,:,iattr].shape )
-        else:
-          for iattr in range(nrattribs):
-            ret[:,:,:,:,iattr] = np.reshape( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr], ret[:,:,:,:,iattr].shape )
-      elif nrdims == 2:
-        if switchedattribs:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]] ), ret[:,:,:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1]] ), ret[:,:,:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0]] ), ret[:,:,:,iattr].shape )
-        else:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr] ), ret[:,:,:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],iattr] ), ret[:,:,:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,:,:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],iattr] ), ret[:,:,:,iattr].shape )
-      elif nrdims == 1:
-        if switchedattribs:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]] ), ret[:,:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1]] ), ret[:,:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( samples[:,iattr,:shapelims[0]], ret[:,:,iattr].shape )
-        else:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr] ), ret[:,:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],iattr] ), ret[:,:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,:,iattr] = np.reshape( samples[:,:shapelims[0],iattr], ret[:,:,iattr].shape )
-      else:
-        return samples
-      return ret
-    else:
-      if nrdims == 3:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            ret[:,iattr] = np.reshape( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr], ret[:,iattr].shape )
-        else:
-          for iattr in range(nrattribs):
-            ret[:,iattr] = np.reshape( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]], ret[:,iattr].shape )
-      elif nrdims == 2:
-        if switchedattribs:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr] ), ret[:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],iattr] ), ret[:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],iattr] ), ret[:,iattr].shape )
-        else:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]] ), ret[:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1]] ), ret[:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0]] ), ret[:,iattr].shape )
-      elif nrdims == 1:
-        if switchedattribs:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr] ), ret[:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,:shapelims[0],:shapelims[1],iattr] ), ret[:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( samples[:,:shapelims[0],iattr], ret[:,iattr].shape )
-        else:
-          if samples_nrdims == 5:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]] ), ret[:,iattr].shape )
-          elif samples_nrdims == 4:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( np.squeeze( samples[:,iattr,:shapelims[0],:shapelims[1]] ), ret[:,iattr].shape )
-          elif samples_nrdims == 3:
-            for iattr in range(nrattribs):
-              ret[:,iattr] = np.reshape( samples[:,iattr,:shapelims[0]], ret[:,iattr].shape )
-      else:
-        return samples
-      return ret
-  return samples
+  plan = None
+  if nrdims in (1,2,3) and (switchedattribs or nrdims != len(cube_shape) or \
+                            shrinked or len(cube_shape) < len(shapelims)):
+    if len(cube_shape) < 1:
+      cube_shape = (1,)
+    plan = {
+      'fromlast': sample_data_format == 'channels_last',
+      'crop': (slice(None),slice(None)) + tuple([slice(0,i) for i in shapelims]),
+      'shape': (nrattribs,) + cube_shape,
+      'tolast': model_data_format == 'channels_last',
+    }
+  plans.update({key: plan})
+  return plan
+
+def adaptToModel( model, samples, sample_data_format='channels_first' ):
+  plan = getLayoutPlan( model, samples.shape[1:], sample_data_format )
+  if plan == None:
+    return samples
+  nrsamples = len(samples)
+  if plan['fromlast']:
+    samples = np.moveaxis( samples, -1, 1 )
+  samples = np.reshape( samples[plan['crop']], (nrsamples,)+plan['shape'] )
+  if plan['tolast']:
+    samples = np.moveaxis( samples, 1, -1 )
+  return np.ascontiguousarray( samples )
+
+def getOutputLayoutPlan_( model, shape, inp_shape, ret_data_format ):
+  plans = getLayoutPlans_( model )
+  key = ('output',tuple(shape),tuple(inp_shape),ret_data_format)
+  if key in plans:
+    return plans[key]
+  fromlast = plans['data_format'] != 'channels_first'
+  if fromlast:
+    nrattribs = shape[-1]
+    shapelims = tuple( shape[:-1] )
+  else:
+    nrattribs = shape[0]
+    shapelims = tuple( shape[1:] )
+  if ret_data_format == 'channels_first':
+    cube_shape = tuple( inp_shape[1:] )
+  else:
+    cube_shape = tuple( inp_shape[:-1] )
+  nrlead = len(cube_shape) - len(shapelims)
+  region = (slice(None),slice(None)) + (slice(None),)*nrlead + \
+           tuple([slice(0,i) for i in shapelims])
+  valshape = (nrattribs,) + (1,)*nrlead + shapelims
+  plan = {
+    'fromlast': fromlast,
+    'valshape': valshape,
+    'region': region,
+    'shape': (nrattribs,) + cube_shape,
+    'full': valshape == (nrattribs,) + cube_shape,
+    'tolast': ret_data_format == 'channels_last',
+  }
+  plans.update({key: plan})
+  return plan
 
 def adaptFromModel( model, samples, inp_shape, ret_data_format ):
-  nrdims = len( model.output_shape )
-  if nrdims == 2:
+  if len( model.output_shape ) == 2:
     return samples.transpose()
 
   nrpts = inp_shape[0]
-  cube_shape = (nrpts,)
-  model_data_format = get_data_format( model )
-  switchedattribs = model_data_format != ret_data_format
-  shapelims = ()
-  if model_data_format == 'channels_first':
-    nrattribs = model.output_shape[1]
-    for i in range(2,nrdims):
-      shapelims += (model.output_shape[i],)
+  plan = getOutputLayoutPlan_( model, samples.shape[1:], inp_shape[1:],
+                               ret_data_format )
+  if plan['fromlast']:
+    samples = np.moveaxis( samples, -1, 1 )
+  samples = np.reshape( samples, (nrpts,)+plan['valshape'] )
+  if plan['full']:
+    if plan['tolast']:
+      samples = np.moveaxis( samples, 1, -1 )
+    return np.ascontiguousarray( samples )
+
+  if plan['tolast']:
+    res = np.zeros( (nrpts,)+plan['shape'][1:]+plan['shape'][:1], samples.dtype )
+    np.moveaxis( res, -1, 1 )[plan['region']] = samples
   else:
-    nrattribs = model.output_shape[-1]
-    for i in range(1,nrdims-1):
-      shapelims += (model.output_shape[i],)
-
-  data_dims = len(inp_shape)
-  if ret_data_format == 'channels_first':
-    cube_shape += (nrattribs,)
-  if ret_data_format == 'channels_first':
-    for i in range(2,data_dims):
-      cube_shape += (inp_shape[i],)
-  else:
-    for i in range(1,data_dims-1):
-      cube_shape += (inp_shape[i],)
-  if ret_data_format == 'channels_last':
-    cube_shape += (nrattribs,)
-
-  res = np.zeros( cube_shape, samples.dtype )
-  if model_data_format == 'channels_last':
-    if nrdims == 5:
-      if switchedattribs:
-        for iattr in range(nrattribs):
-          res[:,iattr,:shapelims[0],:shapelims[1],:shapelims[2]] = samples[:,:,:,:,iattr]
-      else:
-        res[:,:shapelims[0],:shapelims[1],:shapelims[2]] = samples
-    if nrdims == 4:
-      if data_dims == 5:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,iattr,:,:shapelims[0],:shapelims[1]] = samples[:,:,:,iattr]
-        else:
-          res[:,:,:shapelims[0],:shapelims[1]] = samples
-      elif data_dims == 4:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,iattr,:shapelims[0],:shapelims[1]] = samples[:,:,:,iattr]
-        else:
-          res[:,:shapelims[0],:shapelims[1]] = samples
-    if nrdims == 3:
-      if data_dims == 5:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,iattr,:,:,:shapelims[0]] = samples[:,:,iattr]
-        else:
-          res[:,:,:,:shapelims[0]] = samples
-      elif data_dims == 4:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,iattr,:,:shapelims[0]] = samples[:,:,iattr]
-        else:
-          res[:,:,:shapelims[0]] = samples
-      elif data_dims == 3:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,iattr,:shapelims[0]] = samples[:,:,iattr]
-        else:
-          res[:,:shapelims[0]] = samples
-  else:
-    if nrdims == 5:
-      if switchedattribs:
-        for iattr in range(nrattribs):
-          res[:,:shapelims[0],:shapelims[1],:shapelims[2],iattr] = samples[:,iattr]
-      else:
-        res[:,:,:shapelims[0],:shapelims[1],:shapelims[2]] = samples
-    if nrdims == 4:
-      if data_dims == 5:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,:,:shapelims[0],:shapelims[1],iattr] = samples[:,iattr]
-        else:
-          res[:,:,:,:shapelims[0],:shapelims[1]] = samples
-      elif data_dims == 4:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,:shapelims[0],:shapelims[1],iattr] = samples[:,iattr]
-        else:
-          res[:,:,:shapelims[0],:shapelims[1]] = samples
-    if nrdims == 3:
-      if data_dims == 5:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,:,:,:shapelims[0],iattr] = samples[:,iattr]
-        else:
-          res[:,:,:,:,:shapelims[0]] = samples
-      elif data_dims == 4:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,:,:shapelims[0],iattr] = samples[:,iattr]
-        else:
-          res[:,:,:,:shapelims[0]] = samples
-      elif data_dims == 3:
-        if switchedattribs:
-          for iattr in range(nrattribs):
-            res[:,:shapelims[0],iattr] = samples[:,iattr]
-        else:
-          res[:,:,:shapelims[0]] = samples
-
+    res = np.zeros( (nrpts,)+plan['shape'], samples.dtype )
+    res[plan['region']] = samples
   return res
 
 def plot( model, outfnm, showshapes=True, withlaynames=False, vertical=True ):
@@ -30,6 +30,8 @@ from odpy.oscommand import printProcessTime
 import odpy.hdf5 as odhdf5
 import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
+from dgbpy.mlscaler import getNewScaler, getAffineTransform, applyAffineTransform, \
+                           getNrAttribs_
 from multiprocessing import cpu_count
 
 tot_cpu = cpu_count()
@@ -355,25 +357,6 @@ def getSVMPars( modelname='Support Vector Machine',
     'modelname': modelname
     }
 
-def getNewScaler( mean, scale ):
-  """ Gets new scaler object
-
-  Parameters:
-    * mean (ndarray of shape (n_features,) or None): mean value to be used for scaling
-    * scale ndarray of shape (n_features,) or None: Per feature relative scaling of the
-      data to achieve zero mean and unit variance (fromm sklearn docs)
-
-  Returns:
-    * object: scaler (an instance of sklearn.preprocessing..StandardScaler())
-  """
-
-  scaler = StandardScaler()
-  scaler.mean_ = np.array( mean )
-  scaler.scale_ = np.array( scale )
-  scaler.var_ = np.square( scaler.scale_ )
-  scaler.n_samples_seen_ = len(mean)
-  return scaler
-
 def getScaler( x_train, byattrib ):
   nrattribs = x_train.shape[1]
   mean = list()
@@ -393,6 +376,70 @@ def getScaler( x_train, byattrib ):
   scaler.n_samples_seen_ = len(mean)
   return scaler
 
+def getScalerStats( x_train, byattrib ):
+  """ Gets the statistics of a block of examples, to be merged with mergeScalerStats
+
+  Parameters:
+    * x_train (array): examples, with the attributes along the second axis
+    * byattrib (bool): compute the statistics by attribute
+
+  Returns:
+    * tuple: (count,mean,M2) arrays, by attribute, in double precision
+  """
+
+  if byattrib:
+    axes = (0,) + tuple(range(2,len(x_train.shape)))
+    count = np.full( x_train.shape[1], x_train.size // x_train.shape[1], dtype=np.float64 )
+  else:
+    axes = None
+    count = np.full( 1, x_train.size, dtype=np.float64 )
+  mean = np.atleast_1d( np.mean( x_train, axis=axes, dtype=np.float64 ) )
+  m2 = np.atleast_1d( np.var( x_train, axis=axes, dtype=np.float64 ) ) * count
+  return (count,mean,m2)
+
+def mergeScalerStats( stats, newstats ):
+  """ Merges two sets of statistics (Chan et al. parallel algorithm)
+
+  Parameters:
+    * stats (tuple or None): (count,mean,M2) arrays, as returned by getScalerStats
+    * newstats (tuple or None): (count,mean,M2) arrays to be added
+
+  Returns:
+    * tuple: (count,mean,M2) arrays of the combined examples
+  """
+
+  if stats == None:
+    return newstats
+  if newstats == None:
+    return stats
+  (count_a,mean_a,m2_a) = stats
+  (count_b,mean_b,m2_b) = newstats
+  count = count_a + count_b
+  delta = mean_b - mean_a
+  with np.errstate(invalid='ignore',divide='ignore'):
+    mean = np.where( count > 0, mean_a + delta * count_b / count, 0 )
+    m2 = np.where( count > 0, m2_a + m2_b + np.square(delta) * count_a * count_b / count, 0 )
+  return (count,mean,m2)
+
+def getScalerFromStats( stats ):
+  """ Gets scaler object from statistics
+
+  Parameters:
+    * stats (tuple): (count,mean,M2) arrays, as returned by getScalerStats
+
+  Returns:
+    * object: StandardScaler object, identical to getScaler on the same examples
+  """
+
+  (count,mean,m2) = stats
+  var = np.where( count > 0, m2 / np.maximum(count,1), 0 )
+  scaler = StandardScaler()
+  scaler.mean_ = np.array( mean )
+  scaler.var_ = np.array( var )
+  scaler.scale_ = np.sqrt( scaler.var_ )
+  scaler.n_samples_seen_ = len(mean)
+  return scaler
+
 def transform( samples, mean, stddev ):
   samples -= mean
   samples /= stddev
@@ -406,24 +453,14 @@ def transformBack( samples, mean, stddev ):
 def scale( samples, scaler ):
   if scaler == None:
     return samples
-  if scaler.n_samples_seen_ == 1:
-    samples = transform( samples, scaler.mean_[0], scaler.scale_[0] )
-  else:
-    for i in range(scaler.n_samples_seen_):
-      samples[:,i] = transform( samples[:,i], scaler.mean_[i], scaler.scale_[i] )
-
-  return samples
+  (factor,offset) = getAffineTransform( getNrAttribs_(samples), scaler=scaler )
+  return applyAffineTransform( samples, factor, offset )
 
 def unscale( samples, scaler ):
   if scaler == None:
     return samples
-  if scaler.n_samples_seen_ == 1:
-    samples = transformBack( samples, scaler.mean_[0], scaler.scale_[0] )
-  else:
-    for i in range(scaler.n_samples_seen_):
-      samples[:,i] = transformBack( samples[:,i], scaler.mean_[i], scaler.scale_[i] )
-
-  return samples
+  (factor,offset) = getAffineTransform( getNrAttribs_(samples), unscaler=scaler )
+  return applyAffineTransform( samples, factor, offset )
 
 def getDefaultModel( setup, params=scikit_dict ):
   modelname = params['modelname']
@@ -531,6 +568,114 @@ def train(model, trainingdp):
   assessQuality( model, trainingdp )
   return ret
 
+incrementalbatchsize = 4096
+
+def canTrainIncrementally( model ):
+  return hasattr( model, 'partial_fit' )
+
+def trainIncremental( model, infos, batch_size=incrementalbatchsize, ichunk=0,
+                      maxepochs=None ):
+  """ Trains a model one batch at a time, using partial_fit
+
+  The training data is streamed from the example file and never loaded at once.
+  Only models implementing partial_fit (MLP, ...) can be trained this way.
+  The model is trained for the number of iterations of the model (max_iter),
+  stopping earlier when the score on the validation examples does not improve
+  by tol for n_iter_no_change epochs, like fit does.
+
+  Parameters:
+    * model (object): scikit-learn model with a partial_fit method
+    * infos (dict): information about example file, with training selection and scalers
+    * batch_size (int): number of examples per batch
+    * ichunk (int): index of the data chunk to be used
+    * maxepochs (int): maximum number of passes over the training examples,
+      defaults to the max_iter of the model
+  """
+
+  if not canTrainIncrementally( model ):
+    log_msg( 'Model', model.__class__.__name__, 'cannot be trained incrementally' )
+    raise AttributeError
+  from dgbpy import mlapply as dgbmlapply
+  isclassification = infos[dgbkeys.classdictstr]
+  classes = None
+  if isclassification:
+    classes = np.arange( dgbhdf5.getNrClasses(infos) )
+  if maxepochs == None:
+    maxepochs = getattr( model, 'max_iter', 1 )
+  patience = getattr( model, 'n_iter_no_change', 5 )
+  tol = getattr( model, 'tol', None )
+  if tol == None:
+    tol = 0
+  printProcessTime( 'Training with scikit-learn', True, print_fn=log_msg )
+  bestscore = None
+  nrnoimprove = 0
+  for epoch in range(maxepochs):
+    nrpts = 0
+    redirect_stdout()
+    for (x_train,y_train) in dgbmlapply.getScaledTrainingBatchesByInfo( infos,
+                                      batch_size, ichunk=ichunk, flatten=True,
+                                      shuffle=True ):
+      y_train = y_train.ravel()
+      if isclassification:
+        model.partial_fit( x_train, y_train, classes=classes )
+      else:
+        model.partial_fit( x_train, y_train )
+      nrpts += len(y_train)
+    restore_stdout()
+    score = getValidationScore( model, infos, batch_size, ichunk )
+    if epoch == 0:
+      log_msg( '\nTraining on', nrpts, 'samples per epoch' )
+    if score == None:
+      continue
+    log_msg( 'Epoch', epoch+1, 'validation score:', "%.4f" % score )
+    if bestscore == None or score > bestscore + tol:
+      bestscore = score
+      nrnoimprove = 0
+    else:
+      nrnoimprove += 1
+      if nrnoimprove >= patience:
+        break
+  printProcessTime( 'Training with scikit-learn', False, print_fn=log_msg, withprocline=False )
+  score = getValidationScore( model, infos, batch_size, ichunk )
+  if score != None:
+    log_msg( '\nCorrelation coefficient with validation data: ', "%.4f" % score, '\n' )
+  return model
+
+def getValidationScore( model, infos, batch_size=incrementalbatchsize, ichunk=0 ):
+  """ Quality of a model on the validation examples, streamed from the example file
+
+  Returns:
+    * float: ratio of correctly predicted classes, or correlation coefficient of
+      the predicted values. None without validation examples.
+  """
+
+  from dgbpy import mlapply as dgbmlapply
+  isclassification = infos[dgbkeys.classdictstr]
+  nrpts = 0
+  nrgood = 0
+  sums = np.zeros( 5, dtype=np.float64 )
+  for (x_valid,y_valid) in dgbmlapply.getScaledTrainingBatchesByInfo( infos,
+                                    batch_size, forvalidation=True, ichunk=ichunk,
+                                    flatten=True, prefetch=0 ):
+    y_valid = y_valid.ravel()
+    y_predicted = model.predict( x_valid ).ravel()
+    nrpts += len(y_valid)
+    if isclassification:
+      nrgood += np.count_nonzero( y_predicted == y_valid )
+    else:
+      (x,y) = (y_predicted.astype(np.float64),y_valid.astype(np.float64))
+      sums += (np.sum(x), np.sum(y), np.sum(x*x), np.sum(y*y), np.sum(x*y))
+  if nrpts < 1:
+    return None
+  if isclassification:
+    return nrgood / nrpts
+  (sx,sy,sxx,syy,sxy) = sums / nrpts
+  varx = sxx - sx*sx
+  vary = syy - sy*sy
+  if varx <= 0 or vary <= 0:
+    return 0.
+  return float( (sxy - sx*sy) / np.sqrt(varx*vary) )
+
 def assessQuality( model, trainingdp ):
   if not dgbkeys.yvaliddictstr in trainingdp:
     return
@@ -563,6 +708,17 @@ def onnx_from_sklearn(model):
       model.classes_ = model.classes_.astype( np.int64 )
   return convert_sklearn(model, initial_types=initial_type, options=options)
 
+def exportOnnx( model, joutfnm ):
+  onx = onnx_from_sklearn(model)
+  if onx == None:
+    return None
+  with open(joutfnm, 'wb') as f:
+    f.write(onx.SerializeToString())
+  return joutfnm
+
+def adaptToOnnx( model, infos, samples ):
+  return np.reshape( samples, (len(samples),-1) ).astype( np.float32 )
+
 def save( model, outfnm, save_type=defsavetype ):
   h5file = odhdf5.openFile( outfnm, 'w' )
   odhdf5.setAttr( h5file, 'backend', 'scikit-learn' )
@@ -581,9 +737,7 @@ def save( model, outfnm, save_type=defsavetype ):
   odhdf5.setAttr( modelgrp, 'type', save_type )
   if save_type == savetypes[0]:
     joutfnm = os.path.splitext( outfnm )[0] + '.onnx'
-    onx = onnx_from_sklearn(model)
-    with open(joutfnm, 'wb') as f:
-      f.write(onx.SerializeToString())
+    exportOnnx( model, joutfnm )
     odhdf5.setAttr( modelgrp, 'path', joutfnm )
   elif save_type == savetypes[1]:
     joutfnm = os.path.splitext( outfnm )[0] + '.joblib'
@@ -599,7 +753,7 @@ def save( model, outfnm, save_type=defsavetype ):
     odhdf5.setAttr( modelgrp, 'path', joutfnm )
   h5file.close()
 
-def load( modelfnm ):
+def load( modelfnm, sessopts=None ):
   model = None
   h5file = odhdf5.openFile( modelfnm, 'r' )
   modelgrp = h5file['model']
@@ -608,7 +762,7 @@ def load( modelfnm ):
     modfnm = odhdf5.getText( modelgrp, 'path' )
     modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
     from dgbpy.sklearn_classes import OnnxModel
-    model = OnnxModel( str(modfnm) )
+    model = OnnxModel( str(modfnm), sessopts )
   if savetype == savetypes[1]:
     modfnm = odhdf5.getText( modelgrp, 'path' )
     modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
@@ -649,11 +803,18 @@ def apply( model, samples, scaler, isclassification, withpred, withprobs, withco
 
   ret = {}
   res = None
+  withprobas = isclassification and (doprobabilities or withconfidence)
+  if withpred and withprobas and hasattr(model,'predict_with_proba'):
+    (pred,proba) = model.predict_with_proba( samples )
+    ret.update({dgbkeys.preddictstr: np.transpose(pred)})
+    ret.update({dgbkeys.probadictstr: np.transpose(proba)})
+    return ret
+
   if withpred:
     res = np.transpose( model.predict( samples ) )
     ret.update({dgbkeys.preddictstr: res})
 
-  if isclassification and (doprobabilities or withconfidence):
+  if withprobas:
     res = np.transpose( model.predict_proba( samples ) )
     ret.update({dgbkeys.probadictstr: res})
 
@@ -12,7 +12,7 @@ from dgbpy.torch_classes import DatasetApply
 import torch, os, json, pickle, joblib
 import numpy as np
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import odpy.hdf5 as odhdf5
@@ -25,7 +25,11 @@ torch_dict = {
     'criterion': nn.CrossEntropyLoss(),
     'batch_size': 8,
     'learnrate': 0.0001,
-    'type': None
+    'type': None,
+    'nbworkers': 0,
+    'prefetch_factor': 2,
+    'persistent_workers': True,
+    'apply_batch_factor': 16
 }
 platform = (dgbkeys.torchplfnm, 'PyTorch')
 cudacores = [ '1', '2', '4', '8', '16', '32', '48', '64', '96', '128', '144', '192', '256', \
@@ -43,13 +47,19 @@ def getParams(
     learnrate=torch_dict['learnrate'],
     epochs=torch_dict['epochs'],
     epochdrop=torch_dict['epochdrop'],
-    batch=torch_dict['batch_size']):
+    batch=torch_dict['batch_size'],
+    nbworkers=torch_dict['nbworkers'],
+    prefetchfactor=torch_dict['prefetch_factor'],
+    persistentworkers=torch_dict['persistent_workers']):
   ret = {
     'type': nntype,
     'learnrate': learnrate,
     'epochs': epochs,
     'epochdrop': epochdrop,
-    'batch': batch
+    'batch': batch,
+    'nbworkers': nbworkers,
+    'prefetch_factor': prefetchfactor,
+    'persistent_workers': persistentworkers
   }
   return ret
 
@@ -127,8 +137,10 @@ def getModelDims( model_shape, data_format ):
 
 savetypes = ( 'onnx', 'joblib', 'pickle' )
 defsavetype = savetypes[0]
+onnxinputnm = 'input'
+onnxoutputnm = 'output'
 
-def load( modelfnm ):
+def load( modelfnm, sessopts=None ):
   model = None
   h5file = odhdf5.openFile( modelfnm, 'r' )
   modelgrp = h5file['model']
@@ -141,7 +153,7 @@ def load( modelfnm ):
     modfnm = odhdf5.getText( modelgrp, 'path' )
     modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
     from dgbpy.torch_classes import OnnxModel
-    model = OnnxModel(str(modfnm))
+    model = OnnxModel(str(modfnm), sessopts)
   elif savetype == savetypes[1]:
     modfnm = odhdf5.getText( modelgrp, 'path' )
     modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
@@ -182,6 +194,20 @@ def onnx_from_torch(model, infos):
     dummy_input = torch.randn(input_size, model_shape[0], model_shape[1])
   return model_instance, dummy_input
 
+def exportOnnx( model, infos, joutfnm ):
+  retmodel, dummies = onnx_from_torch(model, infos)
+  torch.onnx.export(retmodel, dummies, joutfnm, input_names=[onnxinputnm],
+                    output_names=[onnxoutputnm],
+                    dynamic_axes={onnxinputnm: {0: 'batch'}, onnxoutputnm: {0: 'batch'}})
+  return joutfnm
+
+def adaptToOnnx( model, infos, samples ):
+  from dgbpy.torch_classes import getExamplesView
+  attribs = dgbhdf5.getNrAttribs(infos)
+  model_shape = get_model_shape(infos[dgbkeys.inpshapedictstr], attribs, True)
+  ndims = getModelDims(model_shape, True)
+  return np.ascontiguousarray(getExamplesView(samples, ndims), dtype=np.float32)
+
 def save( model, outfnm, infos, save_type=defsavetype ):
   h5file = odhdf5.openFile( outfnm, 'w' )
   odhdf5.setAttr( h5file, 'backend', 'PyTorch' )
@@ -194,8 +220,7 @@ def save( model, outfnm, infos, save_type=defsavetype ):
     save_type = savetypes[1]
   if save_type == savetypes[0]:
     joutfnm = os.path.splitext( outfnm )[0] + '.onnx'
-    retmodel, dummies = onnx_from_torch(model, infos)
-    torch.onnx.export(retmodel, dummies, joutfnm)
+    exportOnnx( model, infos, joutfnm )
     odhdf5.setAttr( modelgrp, 'path', joutfnm )
   elif save_type == savetypes[1]:
     joutfnm = os.path.splitext( outfnm )[0] + '.joblib'
@@ -209,7 +234,7 @@ def save( model, outfnm, infos, save_type=defsavetype ):
 
 def train(model, imgdp, params):
     from dgbpy.torch_classes import Trainer
-    trainloader, testloader = DataGenerator(imgdp, batchsize=params['batch'])
+    trainloader, testloader = DataGenerator(imgdp, batchsize=params['batch'], params=params)
     criterion = torch_dict['criterion']
     if imgdp[dgbkeys.infodictstr][dgbkeys.classdictstr]==False:
       criterion = nn.MSELoss()
@@ -231,28 +256,27 @@ def train(model, imgdp, params):
     model, training_losses, validation_losses, training_accs, validation_accs, lr_rates = trainer.run_trainer()
     return model
 
-def apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities ):
+def apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities,
+           batchsize=None ):
+  """ Applies a torch model, or its onnx export with onnxruntime
+
+  The outputs have the layout of onnx_classes.apply: the samples are along
+  the last axis, or along the first axis for image to image models.
+  """
+  import dgbpy.onnx_classes as dgbonnx
   if scaler != None:
     samples = scaler.transform( samples )
+  if model.__class__.__name__ == 'OnnxModel':
+    onnxmodel = dgbonnx.OnnxApplyModel( model.name, sessopts=model.sessopts )
+    return dgbonnx.apply( onnxmodel, samples, isclassification, withpred, withprobs,
+                          withconfidence, doprobabilities, batchsize=batchsize )
+
   attribs = dgbhdf5.getNrAttribs(info)
   model_shape = get_model_shape(info[dgbkeys.inpshapedictstr], attribs, True)
   ndims = getModelDims(model_shape, 'channels_first')
   sampleDataset = DatasetApply(samples, isclassification, 1, ndims=ndims)
-  ret = {}
-  res = None
-  try:
-    img2img = info[dgbkeys.seisimgtoimgtypestr]
-    img2img = True
-  except KeyError:
-    img2img = False
-  
-  if info[dgbkeys.learntypedictstr] == dgbkeys.seisclasstypestr or \
-      info[dgbkeys.learntypedictstr] == dgbkeys.loglogtypestr:
-      drop_last = True
-  else:
-    drop_last = False
-  batch_size = torch_dict['batch_size']
-  dataloader = getDataLoader(sampleDataset, batch_size=batch_size, drop_last=drop_last)
+  batch_size = getApplyBatchSize(sampleDataset, batchsize)
+  dataloader = getDataLoader(sampleDataset, batch_size=batch_size)
   if isclassification:
     nroutputs = len(info[dgbkeys.classesdictstr])
   else:
@@ -276,98 +300,82 @@ def apply( model, info, samples, scaler, isclassification, withpred, withprobs,
       else:
         dfdm = UNet(out_channels=1,  n_blocks=1, dim=ndims)
       dfdm.load_state_dict(model)
-  elif model.__class__.__name__ == 'OnnxModel':
-    dfdm = model
 
-  predictions = []
-  predictions_prob = []
+  outputs = dgbonnx.ApplyOutputs(len(sampleDataset), isclassification, withpred, withprobs,
+                                 withconfidence, doprobabilities)
   dfdm.eval()
-  for input in dataloader:
-      with torch.no_grad():
-        out = dfdm(input)
-        pred = out.detach().numpy()
-        pred_prob = pred.copy()
-        if isclassification:
-          pred = np.argmax(pred, axis=1)
-        for _ in pred:
-          predictions.append(_)
-        for _prob in pred_prob:
-          predictions_prob.append(_prob)
+  with torch.inference_mode():
+    for input in dataloader:
+      outputs.add(dfdm(input).detach().cpu().numpy())
+  return outputs.get()
+
+def getLoaderArgs(params=None):
+    """ DataLoader arguments for the workers settings of the torch params """
+    ret = {}
+    if params == None or not 'nbworkers' in params or params['nbworkers'] < 1:
+        return ret
+    ret['num_workers'] = params['nbworkers']
+    if 'prefetch_factor' in params:
+        ret['prefetch_factor'] = params['prefetch_factor']
+    if 'persistent_workers' in params:
+        ret['persistent_workers'] = params['persistent_workers']
+    ret['pin_memory'] = torch.cuda.is_available()
+    return ret
 
-  if withpred:
-    if isclassification:
-      if not (doprobabilities or withconfidence):
-        try:
-          res = np.array(predictions_prob)
-          res = np.transpose(np.array(predictions))
-        except AttributeError:
-          pass
-    
-  if isclassification and (doprobabilities or withconfidence or withpred):
-    if len(ret)<1:
-      allprobs = (np.array(predictions)).transpose()
+def getBatchDataLoader(dataset, batch_size=torch_dict['batch_size'], shuffle=False, drop_last=False,
+                       params=None):
+    """ DataLoader fetching each batch from a SeismicArrayDataset with a single
+        fancy-index, instead of collating the examples one by one.
+        With worker processes, the arrays of the dataset are shared through memory
+        mapped files unless the workers are forked """
+    if shuffle:
+        sampler = RandomSampler(dataset)
     else:
-      allprobs = ret[dgbkeys.preddictstr]
-    indices = None
-    if withconfidence or not img2img or (img2img and nroutputs>2):
-      N = 2
-      if img2img:
-        indices = np.argpartition(allprobs,-N,axis=1)[:,-N:]
-      else:
-        indices = np.argpartition(allprobs,-N,axis=0)[-N:]
-    if withpred and isinstance( indices, np.ndarray ):
-      if img2img:
-        ret.update({dgbkeys.preddictstr: indices[:,-1:]})
-      else:
-        ret.update({dgbkeys.preddictstr: indices[-1:]})
-    if doprobabilities and len(withprobs) > 0:
-      res = np.copy(allprobs[withprobs])
-      ret.update({dgbkeys.probadictstr: res})
-    if withconfidence:
-      N = 2
-      predictions_prob = np.array(predictions_prob)
-      x = predictions_prob.shape[0]
-      indices = np.argpartition(predictions_prob.transpose(),-N,axis=0)[-N:].transpose()
-      sortedprobs = predictions_prob.transpose()[indices.ravel(),np.tile(np.arange(x),N)].reshape(N,x)
-      res = np.diff(sortedprobs,axis=0)
-      ret.update({dgbkeys.confdictstr: res})
-  
-  if withpred:
-    res = np.transpose(np.array(predictions))
-    ret.update({dgbkeys.preddictstr: res})
-  
-  if doprobabilities:
-    res = np.transpose( np.array(predictions_prob) )
-    ret.update({dgbkeys.probadictstr: res})
-  if info[dgbkeys.learntypedictstr] == dgbkeys.seisimgtoimgtypestr:
-    if ndims==3:
-      if isclassification:
-        ret[dgbkeys.preddictstr] = ret[dgbkeys.preddictstr].transpose(3, 2, 1, 0)
-      else:
-        ret[dgbkeys.preddictstr] = ret[dgbkeys.preddictstr].transpose(4, 3, 2, 1, 0)
-    elif ndims==2:
-      if isclassification:
-        ret[dgbkeys.preddictstr] = ret[dgbkeys.preddictstr].transpose(2, 1, 0)
-      else:
-        ret[dgbkeys.preddictstr] = ret[dgbkeys.preddictstr].transpose(3, 2, 1, 0)  
-  return ret
+        sampler = SequentialSampler(dataset)
+    batchsampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    loaderargs = getLoaderArgs(params)
+    if 'num_workers' in loaderargs and hasattr(dataset, 'share'):
+        import torch.multiprocessing as mp
+        if mp.get_start_method() != 'fork':
+            dataset.share()
+    return DataLoader(dataset=dataset, sampler=batchsampler, batch_size=None, **loaderargs)
 
-def getTrainTestDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch_size']):
-    trainloader = DataLoader(dataset=traindataset, batch_size=batchsize, shuffle=True, drop_last=True)
-    testloader= DataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True)
-    return trainloader, testloader
+def getApplyBatchSize(dataset, maxbatchsize=None):
+    """ Number of samples per apply batch, from the size of the samples and
+        the available memory (see mlapply.getApplyBatchSize). The input size
+        does not account for the activations of the network, hence the batch
+        size is also limited to maxbatchsize, which defaults to
+        torch_dict['apply_batch_factor'] times the training batch size """
+    from dgbpy import mlapply as dgbmlapply
+    nrsamples = len(dataset)
+    if nrsamples < 1:
+        return 1
+    trainbatchsize = torch_dict['batch_size']
+    if maxbatchsize == None:
+        maxbatchsize = trainbatchsize * torch_dict['apply_batch_factor']
+    samplesz = dataset.X[0].numel() * dataset.X.element_size()
+    batchsize = dgbmlapply.getApplyBatchSize(samplesz, nrsamples, maxbatchsize)
+    return max(batchsize, min(nrsamples, trainbatchsize, maxbatchsize))
 
-def getDataLoader(dataset, batch_size=torch_dict['batch_size'], drop_last=False):
-    dataloader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False, drop_last=drop_last)
+def getTrainTestDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch_size'], params=None):
+    return getDataLoaders(traindataset, testdataset, batchsize, params)
+
+def getDataLoader(dataset, batch_size=torch_dict['batch_size'], drop_last=False, params=None):
+    dataloader = getBatchDataLoader(dataset, batch_size=batch_size, shuffle=False, drop_last=drop_last,
+                                    params=params)
     return dataloader
 
-def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch_size']):
-    trainloader = DataLoader(dataset=traindataset, batch_size=batchsize, shuffle=True, drop_last=True)
-    testloader= DataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True)
+def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch_size'], params=None):
+    trainloader = getBatchDataLoader(traindataset, batch_size=batchsize, shuffle=True, drop_last=True,
+                                     params=params)
+    testloader = getBatchDataLoader(testdataset, batch_size=batchsize, shuffle=False, drop_last=True,
+                                    params=params)
     return trainloader, testloader
 
-def DataGenerator(imgdp, batchsize):
+def DataGenerator(imgdp, batchsize, params=None):
     info = imgdp[dgbkeys.infodictstr]
+    if dgbkeys.streamingdictstr in imgdp:
+        return getStreamingDataLoaders(info, batchsize)
     x_train = imgdp[dgbkeys.xtraindictstr]
     y_train = imgdp[dgbkeys.ytraindictstr]
     x_test = imgdp[dgbkeys.xvaliddictstr]
@@ -381,5 +389,19 @@ def DataGenerator(imgdp, batchsize):
     train_dataset = SeismicTrainDataset(x_train, y_train, info, inp_ch, ndims)
     test_dataset = SeismicTestDataset(x_test, y_test, info, inp_ch, ndims)
 
-    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize)
+    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize, params)
+    return trainloader, testloader
+
+def getStreamingDataLoaders(info, batchsize=torch_dict['batch_size'], ichunk=0):
+    """ Training and validation DataLoaders reading the example file one batch
+        at a time, for example files that do not fit in memory
+    """
+    from dgbpy.torch_classes import StreamingDataset
+    attribs = dgbhdf5.getNrAttribs(info)
+    model_shape = get_model_shape(info[dgbkeys.inpshapedictstr], attribs, True)
+    ndims = getModelDims(model_shape, True)
+    train_dataset = StreamingDataset(info, ndims, batchsize, forvalidation=False, ichunk=ichunk)
+    test_dataset = StreamingDataset(info, ndims, batchsize, forvalidation=True, ichunk=ichunk)
+    trainloader = DataLoader(dataset=train_dataset, batch_size=None)
+    testloader = DataLoader(dataset=test_dataset, batch_size=None)
     return trainloader, testloader
@@ -16,7 +16,6 @@ from odpy.common import log_msg,  redirect_stdout, restore_stdout, isWin
 import odpy.hdf5 as odhdf5
 from odpy.common import std_msg
 
-from dgbpy import dgbscikit
 from dgbpy.keystr import *
 
 hdf5ext = 'h5'
@@ -151,78 +150,157 @@ def getOutdType( classinfo ):
     else:
       return np.uint64
 
+def getCubeLetsOutDType( infos ):
+  if infos[classdictstr]:
+    return getOutdType(np.array(infos[classesdictstr]))
+  return np.float32
+
+def getCubeLetsShapes( infos, nrpts ):
+  inpnrattribs = getNrAttribs( infos )
+  inparrshape = get_np_shape( infos[inpshapedictstr], nrpts, inpnrattribs )
+  if isImg2Img( infos ):
+    outarrshape = get_np_shape( infos[outshapedictstr], nrpts, 1 )
+  else:
+    outarrshape = (nrpts,getNrOutputs( infos ))
+  return (inparrshape,outarrshape)
+
+def getCubeLetsData_( infos, group, collnm ):
+  if not collnm in group:
+    return (None,None)
+  grp = group[collnm]
+  if not xdatadictstr in grp:
+    return (None,None)
+  if isSegmentation( infos ):
+    return (grp[xdatadictstr],[])
+  if not ydatadictstr in grp:
+    return (None,None)
+  return (grp[xdatadictstr],grp[ydatadictstr])
+
+maxrunsize = 256 * 1024 * 1024
+readoverheadsize = 64 * 1024
+directreadsize = 1024 * 1024
+
+def getContiguousRuns( idxs, maxgap=0 ):
+  """ Splits a selection of example indices into runs of consecutive indices
+
+  Parameters:
+    * idxs (list or array): example indices, in any order
+    * maxgap (int): number of unselected indices allowed within a run
+
+  Returns:
+    * tuple: (order,runs). order sorts idxs; runs is a list of (start,stop)
+      positions in the sorted indices
+  """
+
+  idxs = np.asarray( idxs, dtype=np.int64 )
+  order = np.argsort( idxs, kind='stable' )
+  sortedidxs = idxs[order]
+  breaks = np.flatnonzero( np.diff(sortedidxs) > maxgap+1 ) + 1
+  starts = np.concatenate( ([0],breaks) )
+  stops = np.concatenate( (breaks,[len(idxs)]) )
+  return (order, list(zip(starts.tolist(),stops.tolist())))
+
+def getRowSize_( dset ):
+  return max( 1, int(np.prod(dset.shape[1:],dtype=np.int64)) * dset.dtype.itemsize )
+
+def getMaxGap_( dset ):
+  """ Numbers of rows of the largest gap read through, and of the largest read
+
+  A gap is only read when it takes less time than an additional read call,
+  whose fixed cost is about that of reading readoverheadsize bytes. Sparse
+  selections thus read the selected rows only.
+  """
+  rowsize = getRowSize_( dset )
+  return (readoverheadsize // rowsize, max( 1, maxrunsize // rowsize ))
+
+def readRuns_( dset, idxs, order, runs, arr ):
+  sortedidxs = np.asarray( idxs, dtype=np.int64 )[order]
+  isordered = np.array_equal( order, np.arange(len(order)) )
+  rowshape = dset.shape[1:]
+  directread = dset.dtype == arr.dtype and rowshape == arr.shape[1:]
+  maxrows = getMaxGap_( dset )[1]
+  mindirectrows = directreadsize // getRowSize_( dset )
+  for (start,stop) in runs:
+    substart = start
+    while substart < stop:
+      first = int(sortedidxs[substart])
+      substop = substart + int(np.searchsorted( sortedidxs[substart:stop], first+maxrows ))
+      last = int(sortedidxs[substop-1])
+      nrrows = substop-substart
+      srcsel = np.s_[first:last+1]
+      if isordered and directread and last-first+1 == nrrows and \
+         nrrows >= mindirectrows:
+        dset.read_direct( arr, srcsel, np.s_[substart:substop] )
+      else:
+        buf = dset[srcsel]
+        if len(buf) != nrrows:
+          buf = buf[sortedidxs[substart:substop]-first]
+        arr[order[substart:substop]] = np.reshape( buf, (nrrows,)+arr.shape[1:] )
+      substart = substop
+
+def canReadRuns_( dset, dsetnms, arr ):
+  if not hasattr(dset,'read_direct') or len(dsetnms) < 1:
+    return False
+  if not isinstance(dsetnms[0],(int,np.integer)):
+    return False
+  return np.prod(dset.shape[1:],dtype=np.int64) == \
+         np.prod(arr.shape[1:],dtype=np.int64)
+
+def readCubeLets_( x_data, y_data, dsetnms, cubelets, output, img2img ):
+  hasydata = len(y_data) > 0
+  if canReadRuns_( x_data, dsetnms, cubelets ) and \
+     (not hasydata or canReadRuns_( y_data, dsetnms, output )):
+    (order,runs) = getContiguousRuns( dsetnms, getMaxGap_(x_data)[0] )
+    readRuns_( x_data, dsetnms, order, runs, cubelets )
+    if hasydata:
+      readRuns_( y_data, dsetnms, order, runs, output )
+    return
+
+  readCubeLetsByExample_( x_data, y_data, dsetnms, cubelets, output, img2img )
+
+def readCubeLetsByExample_( x_data, y_data, dsetnms, cubelets, output, img2img ):
+  hasydata = len(y_data) > 0
+  for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
+    dset = x_data[dsetnm]
+    if hasydata:
+      odset = y_data[dsetnm]
+
+    cubelets[idx] = np.resize( dset, cubelets[idx].shape )
+    if hasydata:
+      if img2img:
+        output[idx] = np.resize( odset, output[idx].shape )
+      else:
+        output[idx] = np.asarray( odset )
+
 def getCubeLets( infos, collection, groupnm ):
   if len(collection)< 1:
     return {}
-  inpnrattribs = getNrAttribs( infos )
-  inpshape = infos[inpshapedictstr]
-  outshape = infos[outshapedictstr]
-  nroutputs = getNrOutputs( infos )
-  isclass = infos[classdictstr]
   img2img = isImg2Img( infos )
-  iscluster = isSegmentation( infos )
-  examples = infos[exampledictstr]
-  if img2img:
-    outnrattribs = 1
-  outdtype = np.float32
-  if isclass:
-    outdtype = getOutdType(np.array(infos[classesdictstr]))
+  outdtype = getCubeLetsOutDType( infos )
   h5file = odhdf5.openFile( infos[filedictstr], 'r' )
   group = h5file[groupnm]
 
-  firstcollnm = next(iter(collection))
   hasdata = None
   allcubelets = list()
   alloutputs = list()
   for collnm in collection:
-    if not collnm in group:
-      continue
-
-    grp = group[collnm]
-    if not xdatadictstr in grp:
+    (x_data,y_data) = getCubeLetsData_( infos, group, collnm )
+    if x_data is None:
       continue
 
-    if not iscluster and not ydatadictstr in grp:
-      continue
-
-    x_data = grp[xdatadictstr]
-    if not iscluster:
-      y_data = grp[ydatadictstr]
-    else:
-      y_data = []
-
     dsetnms = collection[collnm]
     nrpts = len(dsetnms)
     if nrpts < 1:
       continue
 
-    hasydata = len(y_data) > 0
-    inparrshape = get_np_shape(inpshape,nrpts,inpnrattribs)
-    if img2img:
-      outarrshape = get_np_shape(outshape,nrpts,outnrattribs)
+    (inparrshape,outarrshape) = getCubeLetsShapes( infos, nrpts )
     if len(x_data) == nrpts and len(y_data) == nrpts:
       cubelets = np.resize( x_data, inparrshape ).astype( np.float32 )
-      if img2img:
-        output = np.resize( y_data, outarrshape ).astype( outdtype )
-      else:
-        output = np.resize( y_data, (nrpts,nroutputs) ).astype( outdtype )
+      output = np.resize( y_data, outarrshape ).astype( outdtype )
     else:
       cubelets = np.empty( inparrshape, np.float32 )
-      if img2img:
-        output = np.empty( outarrshape, outdtype )
-      else:
-        output = np.empty( (nrpts,nroutputs), outdtype )
-      for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
-        dset = x_data[dsetnm]
-        if hasydata:
-          odset = y_data[dsetnm]
-
-        cubelets[idx] = np.resize( dset, cubelets[idx].shape )
-        if hasydata:
-          if img2img:
-            output[idx] = np.resize( odset, output[idx].shape )
-          else:
-            output[idx] = np.asarray( odset )
+      output = np.empty( outarrshape, outdtype )
+      readCubeLets_( x_data, y_data, dsetnms, cubelets, output, img2img )
 
     allcubelets.append( cubelets )
     alloutputs.append( output )
@@ -240,6 +318,78 @@ def getCubeLets( infos, collection, groupnm ):
     ytraindictstr: output
   }
 
+def getCubeLetsIter( infos, datasets, batch_size, shuffle=False ):
+  """ Iterates over the examples of a dataset selection, one batch at a time
+
+  Only one batch is held in memory: the examples are read from the
+  example file as the batches are requested.
+
+  Parameters:
+    * infos (dict): information about example file
+    * datasets (dict): dataset selection, by group and collection
+    * batch_size (int): number of examples per batch
+    * shuffle (bool): randomize the order of the examples within each collection
+
+  Returns:
+    * generator: dict with x_train and y_train arrays of (at most) batch_size
+      examples. Only the last batch may be smaller.
+  """
+
+  img2img = isImg2Img( infos )
+  outdtype = getCubeLetsOutDType( infos )
+  (inparrshape,outarrshape) = getCubeLetsShapes( infos, batch_size )
+  h5file = odhdf5.openFile( infos[filedictstr], 'r' )
+  try:
+    cubelets = None
+    nrdone = 0
+    for groupnm in datasets:
+      if not groupnm in h5file:
+        continue
+      group = h5file[groupnm]
+      collection = datasets[groupnm]
+      for collnm in collection:
+        (x_data,y_data) = getCubeLetsData_( infos, group, collnm )
+        if x_data is None:
+          continue
+        dsetnms = collection[collnm]
+        if shuffle:
+          dsetnms = list(dsetnms)
+          random.shuffle( dsetnms )
+        start = 0
+        while start < len(dsetnms):
+          if cubelets is None:
+            cubelets = np.empty( inparrshape, np.float32 )
+            output = np.empty( outarrshape, outdtype )
+          nrpts = min( batch_size-nrdone, len(dsetnms)-start )
+          stop = start+nrpts
+          readCubeLets_( x_data, y_data, dsetnms[start:stop],
+                         cubelets[nrdone:nrdone+nrpts],
+                         output[nrdone:nrdone+nrpts], img2img )
+          nrdone += nrpts
+          start = stop
+          if nrdone == batch_size:
+            yield {
+              xtraindictstr: cubelets,
+              ytraindictstr: output
+            }
+            cubelets = None
+            nrdone = 0
+    if nrdone > 0:
+      yield {
+        xtraindictstr: cubelets[:nrdone],
+        ytraindictstr: output[:nrdone]
+      }
+  finally:
+    h5file.close()
+
+def getNrBatches( datasets, batch_size ):
+  nrpts = 0
+  for groupnm in datasets:
+    collection = datasets[groupnm]
+    for collnm in collection:
+      nrpts += len(collection[collnm])
+  return int(np.ceil( nrpts / batch_size ))
+
 def getDatasets_( infos, datasets, fortrain ):
   dictkeys = list()
   if fortrain:
@@ -396,7 +546,8 @@ def getInfo( filenm, quick ):
     if len(inpsurv) > 0:
       inpobj.update({ locationdictstr: inpsurv})
     if len(scales) > 0:
-      inpobj.update({scaledictstr: dgbscikit.getNewScaler(means,scales) })
+      from dgbpy import mlscaler
+      inpobj.update({scaledictstr: mlscaler.getNewScaler(means,scales) })
     inputs.update({ odhdf5.getText( info, inpidxstr+'Name' ): inpobj})
     idx += 1
 
@@ -578,6 +729,34 @@ def getClassIndices( info, filternms=None ):
     classnms.append( classnm )
   return (idxs,classnms)
 
+classblocksize = 64 * 1024 * 1024
+
+def getUniqueValues( arr, ret=None ):
+  """ Gets the sorted distinct values of an array, reading it by blocks
+
+  Parameters:
+    * arr (ndarray or h5py Dataset): values, only blocks of classblocksize
+      bytes along the first axis are read at once
+    * ret (ndarray or None): distinct values found so far, to be merged with
+
+  Returns:
+    * ndarray: sorted distinct values
+  """
+
+  nrpts = len(arr)
+  if nrpts < 1:
+    return ret
+  rowsz = max( 1, int(np.prod(arr.shape[1:],dtype=np.int64)) * arr.dtype.itemsize )
+  step = max( 1, classblocksize // rowsz )
+  for start in range(0,nrpts,step):
+    blk = np.asarray( arr[start:start+step] ).ravel()
+    if blk.dtype == np.uint8 or blk.dtype == np.bool_:
+      vals = np.flatnonzero( np.bincount(blk,minlength=1) ).astype( blk.dtype )
+    else:
+      vals = np.unique( blk )
+    ret = vals if ret is None else np.union1d( ret, vals )
+  return ret
+
 def getClassIndicesFromData( info ):
   if classesdictstr in info:
     return info[classesdictstr]
@@ -587,16 +766,16 @@ def getClassIndicesFromData( info ):
   if odhdf5.hasAttr( dsinfoin, classesvalstr ):
     return odhdf5.getIArray( dsinfoin, classesvalstr )
   groups = info[exampledictstr].keys()
-  ret = list()
+  ret = None
   for groupnm in groups:
     grp = h5file[groupnm]
     for inpnm in grp:
-      outdtype = getOutdType(np.array(grp[inpnm][ydatadictstr]))
-      sublist = list(set(np.array(grp[inpnm][ydatadictstr]).astype(outdtype).ravel()))
-      sublist.extend( ret )
-      ret = list(set(sublist))
-  ret = np.sort( ret )
+      ret = getUniqueValues( grp[inpnm][ydatadictstr], ret )
   h5file.close()
+  if ret is None:
+    ret = np.array( [], dtype=np.uint8 )
+  else:
+    ret = np.unique( ret.astype(getOutdType(ret)) )
   h5fileout = odhdf5.openFile( filenm, 'r+' )
   dsinfoout = odhdf5.ensureHasDataset( h5fileout )
   odhdf5.setArray( dsinfoout, classesvalstr, ret )
@@ -0,0 +1,89 @@
+#
+# (C) dGB Beheer B.V.; (LICENSE) http://opendtect.org/OpendTect_license.txt
+# AUTHOR   : A. Huck
+# DATE     : Oct 2026
+#
+# Benchmark of the example reading from hdf5 files:
+# per-example reading versus contiguous runs reading
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from odpy.common import *
+import dgbpy.hdf5 as dgbhdf5
+
+parser = argparse.ArgumentParser(
+          description='Compares the speed of the examples reading methods on a synthetic example file')
+parser.add_argument( '-v', '--version',
+            action='version',version='%(prog)s 1.0')
+datagrp = parser.add_argument_group( 'Data' )
+datagrp.add_argument( '--nrexamples',
+            dest='nrexamples', action='store',
+            type=int, default=100000,
+            help='Number of examples in the synthetic file' )
+datagrp.add_argument( '--nrattribs',
+            dest='nrattribs', action='store',
+            type=int, default=1,
+            help='Number of input attributes' )
+datagrp.add_argument( '--shape',
+            dest='shape', nargs=3, action='store',
+            type=int, default=[1,1,64],
+            help='Shape of each example' )
+datagrp.add_argument( '--fraction',
+            dest='fractions', nargs='+', action='store',
+            type=float, default=[0.8,0.05,0.02],
+            help='Fractions of the examples randomly selected, as for decimation or a validation split. The small fractions give sparse selections' )
+loggrp = parser.add_argument_group( 'Logging' )
+loggrp.add_argument( '--log',
+            dest='logfile', metavar='file', nargs='?',
+            type=argparse.FileType('w'), default=sys.stdout,
+            help='Progress report output' )
+loggrp.add_argument( '--syslog',
+            dest='sysout', metavar='stdout', nargs='?',
+            type=argparse.FileType('w'), default=sys.stdout,
+            help='System log' )
+
+args = vars(parser.parse_args())
+initLogging( args )
+
+nrpts = args['nrexamples']
+inpshape = (nrpts,args['nrattribs'],*args['shape'])
+tmpdir = tempfile.mkdtemp()
+filenm = os.path.join( tmpdir, 'examples.h5' )
+with h5py.File( filenm, 'w' ) as h5file:
+  h5file.create_dataset( 'x_data', data=np.random.random(inpshape).astype(np.float32) )
+  h5file.create_dataset( 'y_data', data=np.random.randint(0,5,(nrpts,1)).astype(np.float32) )
+
+def timeReader( readfn, dsetnms ):
+  nrsel = len(dsetnms)
+  cubelets = np.empty( (nrsel,*inpshape[1:]), np.float32 )
+  output = np.empty( (nrsel,1), np.uint8 )
+  with h5py.File( filenm, 'r' ) as h5file:
+    start = time.time()
+    readfn( h5file['x_data'], h5file['y_data'], dsetnms, cubelets, output, False )
+    duration = time.time()-start
+  return (duration,cubelets,output)
+
+try:
+  for fraction in args['fractions']:
+    nrsel = max( 1, int( nrpts*fraction ) )
+    dsetnms = np.random.permutation( nrpts )[:nrsel].tolist()
+    log_msg( 'Reading', nrsel, 'of', nrpts, 'examples of shape', inpshape[1:] )
+    (runstime,runsx,runsy) = timeReader( dgbhdf5.readCubeLets_, dsetnms )
+    log_msg( 'Contiguous runs:', '{:.3f}'.format(runstime), 's.' )
+    (looptime,loopx,loopy) = timeReader( dgbhdf5.readCubeLetsByExample_, dsetnms )
+    log_msg( 'Per example:', '{:.3f}'.format(looptime), 's.' )
+    if not np.array_equal(runsx,loopx) or not np.array_equal(runsy,loopy):
+      log_msg( 'Error: the two methods returned different examples' )
+      sys.exit(1)
+    log_msg( 'Speedup:', '{:.1f}'.format(looptime/runstime) )
+finally:
+  os.remove( filenm )
+  os.rmdir( tmpdir )
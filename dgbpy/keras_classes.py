@@ -11,21 +11,174 @@
 from datetime import datetime, timedelta
 import numpy as np
 import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
 from tensorflow.keras.utils import Sequence, to_categorical
 
 import dgbpy.keystr as dgbkeys
 from dgbpy import hdf5 as dgbhdf5
 
+class ChunkLoader:
+  """Loads the training chunks, ready to be used by the TrainingSequence objects
+
+  The chunks are read, scaled and adapted to the model in a background thread,
+  so that the next chunk gets loaded while the model trains on the current one.
+  At most two chunks are kept in memory: the current one and the next one.
+  The train and validation sequences share the same loaded chunk.
+  """
+  def __init__(self,trainbatch,model):
+      self._trainbatch = trainbatch
+      self._model = model
+      self._infos = trainbatch[dgbkeys.infodictstr]
+      self._nbchunks = len(self._infos[dgbkeys.trainseldicstr])
+      self._current = None
+      self._next = None
+      self.prefetch( 0 )
+
+  def get(self,ichunk):
+      """ Gets the arrays of a chunk, adapted to the model
+
+      Waits for the background loading if the chunk was prefetched,
+      loads it synchronously otherwise.
+      """
+      if self._current != None and self._current[0] == ichunk:
+          return self._current[1]
+      self._current = None
+      if self._next != None and self._next[0] == ichunk:
+          (thread,result) = self._next[1:]
+          thread.join()
+          self._next = None
+          if 'error' in result:
+              raise result['error']
+          chunk = result['chunk']
+      else:
+          self._next = None
+          chunk = self._load( ichunk )
+      self._current = (ichunk,chunk)
+      return chunk
+
+  def prefetch(self,ichunk):
+      """ Starts loading a chunk in the background
+
+      Has no effect if there is a single chunk, as it is already in memory.
+      """
+      if self._nbchunks < 2 or ichunk >= self._nbchunks or self._next != None:
+          return
+      import threading
+      result = {}
+      def load():
+          try:
+              result['chunk'] = self._load( ichunk )
+          except Exception as e:
+              result['error'] = e
+      thread = threading.Thread( target=load, daemon=True )
+      thread.start()
+      self._next = (ichunk,thread,result)
+
+  def _load(self,ichunk):
+      from dgbpy import dgbkeras
+      if self._nbchunks > 1:
+          from dgbpy import mlapply as dgbmlapply
+          trainbatch = dgbmlapply.getScaledTrainingDataByInfo( self._infos,
+                                                 flatten=False,
+                                                 scale=True, ichunk=ichunk )
+      else:
+          trainbatch = self._trainbatch
+      ret = {}
+      model = self._model
+      for key in (dgbkeys.xtraindictstr,dgbkeys.xvaliddictstr):
+          if key in trainbatch:
+              ret[key] = dgbkeras.adaptToModel( model, trainbatch[key] )
+      for key in (dgbkeys.ytraindictstr,dgbkeys.yvaliddictstr):
+          if key in trainbatch:
+              y_data = trainbatch[key]
+              if len(y_data.shape) > 2:
+                  y_data = dgbkeras.adaptToModel( model, y_data )
+              ret[key] = y_data
+      return ret
+
+def rotateExample(data,k,axes):
+  """ tensorflow equivalent of np.rot90 for a single example """
+  (a,b) = axes
+  k = k % 4
+  if k == 0:
+    return data
+  if k == 2:
+    return tf.reverse( data, [a,b] )
+  perm = list(range(len(data.shape)))
+  (perm[a],perm[b]) = (perm[b],perm[a])
+  if k == 1:
+    return tf.transpose( tf.reverse(data,[b]), perm )
+  return tf.reverse( tf.transpose(data,perm), [b] )
+
+def getRotations(inp_shape,channels_format):
+  """ Gets the rotations used for data augmentation, for examples of shape inp_shape
+
+  Returns:
+    * tuple: (rot,rotidx,rotdims). rotidx are the numbers of quarter turns
+      within the rotdims axes of a batch, or flips (0 or 2) for 2D examples,
+      rot their indices. Without augmentation rot has a single element.
+  """
+  if len(inp_shape) == 4:
+      if channels_format == 'channels_first':
+          rotdims = (2,3)
+          cubesz = inp_shape[1:3]
+      else:
+          rotdims = (1,2)
+          cubesz = inp_shape[0:2]
+      if cubesz[0] == cubesz[1]:
+          return (range(4),range(4),rotdims)
+      return (range(2),range(0,4,2),rotdims)
+  if len(inp_shape) == 3:
+      rotdims = 2 if channels_format == 'channels_first' else 1
+      return (range(2),range(0,4,2),rotdims)
+  return (range(1),range(1),None)
+
+def rotateBatch(data,k,rotdims):
+  """ Rotates (or flips for 2D) a batch like TrainingSequence """
+  if isinstance( rotdims, tuple ):
+    return np.rot90( data, k, rotdims )
+  if k == 0:
+    return data
+  return np.fliplr( data )
+
+def getOneHotFn(nrclasses):
+  """ tensorflow equivalent of to_categorical, to be mapped on batches """
+  def onehot(x,y):
+    if len(y.shape) > 1 and y.shape[-1] == 1:
+      y = tf.squeeze( y, axis=-1 )
+    return (x,tf.one_hot(tf.cast(y,tf.int32),nrclasses))
+  return onehot
+
+class TempModelSaver(Callback):
+  """Keras callback saving the model being trained at most every saveinterval
+
+  Saves at the end of the epochs, whatever the data backend: Keras does not
+  call the on_epoch_end method of the sequences when training on a
+  tf.data.Dataset.
+  """
+  def __init__(self,tempnm,saveinterval=timedelta(minutes=10)):
+      super().__init__()
+      self._tempnm = tempnm
+      self._saveinterval = saveinterval
+      self._lastsaved = datetime.now()
+
+  def on_epoch_end(self,epoch,logs=None):
+      now = datetime.now()
+      if now - self._lastsaved > self._saveinterval:
+          from dgbpy import dgbkeras
+          dgbkeras.save( self.model, self._tempnm )
+          self._lastsaved = now
+
 class TrainingSequence(Sequence):
   def __init__(self,trainbatch,forvalidation,model,exfilenm=None,batch_size=1,\
-               with_augmentation=True,tempnm=None):
+               with_augmentation=True,chunkloader=None):
       from dgbpy import dgbkeras
       self._trainbatch = trainbatch
+      if chunkloader == None:
+        chunkloader = ChunkLoader( trainbatch, model )
+      self._chunkloader = chunkloader
       self._forvalid = forvalidation
       self._model = model
-      self._nrdone = -1
-      self._tempnm = tempnm
-      self._lastsaved = datetime.now()
       self._batch_size = batch_size
       self._augmentation = with_augmentation
       self._channels_format = dgbkeras.get_data_format(model)
@@ -45,56 +198,22 @@ class TrainingSequence(Sequence):
       return int(np.floor(len(self._data_IDs)/float(self._batch_size)))
 
   def set_chunk(self,ichunk):
-      from dgbpy import dgbkeras
-      infos = self._infos
-      nbchunks = len(infos[dgbkeys.trainseldicstr])
-      if nbchunks > 1:
-          from dgbpy import mlapply as dgbmlapply
-          trainbatch = dgbmlapply.getScaledTrainingDataByInfo( infos,
-                                                 flatten=False,
-                                                 scale=True, ichunk=ichunk )
-      else:
-          trainbatch = self._trainbatch
-
+      trainbatch = self._chunkloader.get( ichunk )
       if self._forvalid:
           if not dgbkeys.xvaliddictstr in trainbatch or \
              not dgbkeys.yvaliddictstr in trainbatch:
               return False
-          x_data = trainbatch[dgbkeys.xvaliddictstr]
-          y_data = trainbatch[dgbkeys.yvaliddictstr]
+          self._x_data = trainbatch[dgbkeys.xvaliddictstr]
+          self._y_data = trainbatch[dgbkeys.yvaliddictstr]
       else:
           if not dgbkeys.xtraindictstr in trainbatch or \
              not dgbkeys.ytraindictstr in trainbatch:
               return False
-          x_data = trainbatch[dgbkeys.xtraindictstr]
-          y_data = trainbatch[dgbkeys.ytraindictstr]
-      model = self._model
-      self._x_data = dgbkeras.adaptToModel( model, x_data )
-      if len(y_data.shape) > 2:
-          self._y_data = dgbkeras.adaptToModel( model, y_data )
-      else:
-          self._y_data = y_data
-      inp_shape = self._x_data.shape[1:]
-      if self._augmentation and len(inp_shape) == 4:
-          if self._channels_format == 'channels_first':
-              self._rotdims = (2,3)
-              cubesz = self._x_data.shape[2:4]
-          else:
-              self._rotdims = (1,2)
-              cubesz = self._x_data.shape[1:3]
-          if cubesz[0] == cubesz[1]:
-              self._rot = range(4)
-              self._rotidx = self._rot
-          else:
-              self._rot = range(2)
-              self._rotidx = range(0,4,2)
-      elif self._augmentation and len(inp_shape) == 3:
-          self._rot = range(2)
-          self._rotidx = range(0,4,2)
-          if self._channels_format == 'channels_first':
-              self._rotdims = 2
-          else:
-              self._rotdims = 1
+          self._x_data = trainbatch[dgbkeys.xtraindictstr]
+          self._y_data = trainbatch[dgbkeys.ytraindictstr]
+      if self._augmentation:
+          (self._rot,self._rotidx,self._rotdims) = getRotations( self._x_data.shape[1:],
+                                                      self._channels_format )
       else:
           self._rot = range(1)
       self._data_IDs = range(len(self._x_data)*len(self._rot))
@@ -102,16 +221,63 @@ class TrainingSequence(Sequence):
       return True
 
   def on_epoch_end(self):
-      self._nrdone = self._nrdone+1
-      if self._tempnm != None and self._nrdone > 0:
-          now = datetime.now()
-          if now - self._lastsaved > timedelta(minutes=10):
-              from dgbpy import dgbkeras
-              dgbkeras.save( self._model, self._tempnm )
-              self._lastsaved = now
       self._indexes = np.arange(len(self._data_IDs))
       np.random.shuffle(self._indexes)
 
+  def asDataset(self):
+      """ Gets the examples of the current chunk as a tf.data.Dataset
+
+      Yields the same batches as the sequence, but the augmentation and
+      the one-hot encoding are mapped in parallel and the batches are
+      prefetched, overlapping with the training steps. The examples are read
+      from the arrays of the chunk one at a time, not copied into the graph.
+      """
+      x_data = self._x_data
+      y_data = self._y_data
+      xspec = tf.TensorSpec( x_data.shape[1:], dtype=tf.as_dtype(x_data.dtype) )
+      yspec = tf.TensorSpec( y_data.shape[1:], dtype=tf.as_dtype(y_data.dtype) )
+      def readExample(iex):
+          (x,y) = tf.numpy_function( lambda i: (x_data[i],y_data[i]), [iex],
+                                     (xspec.dtype,yspec.dtype) )
+          x.set_shape( xspec.shape )
+          y.set_shape( yspec.shape )
+          return (x,y)
+
+      nrrot = len(self._rot)
+      nrexamples = len(self._data_IDs)
+      ret = tf.data.Dataset.range( nrexamples )
+      if not self._forvalid:
+          ret = ret.shuffle( nrexamples, reshuffle_each_iteration=True )
+
+      if nrrot == 1:
+          getExample = readExample
+      else:
+          rotdims = self._rotdims
+          flip2d = not isinstance( rotdims, tuple )
+          rotatey = len(y_data.shape) > 2
+          def transformFn(k):
+              if flip2d:
+                  if k == 0:
+                      return lambda data: data
+                  return lambda data: tf.reverse( data, [0] )
+              axes = (rotdims[0]-1,rotdims[1]-1)
+              return lambda data: rotateExample( data, k, axes )
+          transforms = [transformFn(k) for k in self._rotidx]
+          def getExample(idx):
+              (iex,irot) = (idx // nrrot, tf.cast(idx % nrrot,tf.int32))
+              (x,y) = readExample( iex )
+              x = tf.switch_case( irot, [lambda fn=fn: fn(x) for fn in transforms] )
+              if rotatey:
+                  y = tf.switch_case( irot, [lambda fn=fn: fn(y) for fn in transforms] )
+              return (x,y)
+
+      autotune = tf.data.AUTOTUNE
+      ret = ret.map( getExample, num_parallel_calls=autotune, deterministic=False )
+      ret = ret.batch( self._batch_size )
+      if self._nrclasses > 0:
+          ret = ret.map( getOneHotFn(self._nrclasses), num_parallel_calls=autotune )
+      return ret.prefetch( autotune )
+
   def __getitem__(self, index):
       islast = index==(len(self)-1)
       bsize = self._batch_size
@@ -166,6 +332,130 @@ class TrainingSequence(Sequence):
           Y = to_categorical(Y,self._nrclasses)
       return (X, Y)
 
+class StreamingData:
+  """Training examples streamed from the example file, one batch at a time
+
+  The examples are not loaded at once like in TrainingSequence. They cannot
+  be accessed by index either: the batches are only available in the order
+  they are read, from the batches generator or as a tf.data.Dataset.
+  """
+  def __init__(self,infos,forvalidation,model,batch_size=1,ichunk=0,\
+               with_augmentation=True,shuffle=True,prefetch=2):
+      from dgbpy import dgbkeras
+      from dgbpy import mlapply as dgbmlapply
+      self._infos = infos
+      self._forvalid = forvalidation
+      self._model = model
+      self._batch_size = batch_size
+      self._ichunk = ichunk
+      self._shuffle = shuffle and not forvalidation
+      self._prefetch = prefetch
+      self._channels_format = dgbkeras.get_data_format(model)
+      self._nrbatches = dgbmlapply.getNrTrainingBatches( infos, batch_size,
+                                            forvalidation, ichunk )
+      if with_augmentation:
+          (self._rot,self._rotidx,self._rotdims) = getRotations( model.input_shape[1:],
+                                                      self._channels_format )
+      else:
+          self._rot = range(1)
+      self._nrclasses = 0
+      if self._infos[dgbkeys.classdictstr]:
+        self._nrclasses = dgbhdf5.getNrClasses( self._infos )
+        if dgbhdf5.isImg2Img(self._infos) and self._nrclasses <= 2:
+          self._nrclasses = 0
+
+  def __len__(self):
+      return self._nrbatches * len(self._rot)
+
+  def _adapt(self,x_data,y_data):
+      from dgbpy import dgbkeras
+      X = dgbkeras.adaptToModel( self._model, x_data )
+      if len(y_data.shape) > 2:
+          Y = dgbkeras.adaptToModel( self._model, y_data )
+      else:
+          Y = y_data
+      return (X, Y)
+
+  def _getOutputShape(self):
+      """ Shape of the outputs of one example, as returned by the batches """
+      from dgbpy import dgbkeras
+      (_,outshape) = dgbhdf5.getCubeLetsShapes( self._infos, 1 )
+      if len(outshape) > 2:
+          outshape = dgbkeras.adaptToModel( self._model, np.zeros(outshape,np.float32) ).shape
+      return tuple(outshape[1:])
+
+  def batches(self,shuffle=None):
+      """ Iterates over the scaled and adapted batches of one epoch
+
+      With augmentation each batch read is returned in all rotations, mixed
+      over as many batches, like the examples of TrainingSequence.
+      The classes are not one-hot encoded.
+      """
+      from dgbpy import mlapply as dgbmlapply
+      if shuffle == None:
+          shuffle = self._shuffle
+      nrrot = len(self._rot)
+      for (x_data,y_data) in dgbmlapply.getScaledTrainingBatchesByInfo( self._infos,
+                                  self._batch_size, self._forvalid,
+                                  scale=True, ichunk=self._ichunk,
+                                  shuffle=shuffle, prefetch=self._prefetch ):
+          (X,Y) = self._adapt( x_data, y_data )
+          if nrrot == 1:
+              yield (X,Y)
+              continue
+          X = np.concatenate( [rotateBatch(X,k,self._rotdims) for k in self._rotidx] )
+          if len(Y.shape) > 2:
+              Y = np.concatenate( [rotateBatch(Y,k,self._rotdims) for k in self._rotidx] )
+          else:
+              Y = np.concatenate( [Y]*nrrot )
+          indexes = np.arange( len(X) )
+          if shuffle:
+              np.random.shuffle( indexes )
+          nrpts = len(x_data)
+          for start in range(0,len(X),nrpts):
+              batchidxs = indexes[start:start+nrpts]
+              yield (X[batchidxs],Y[batchidxs])
+
+  def asDataset(self,cache=None):
+      """ Gets the examples streamed from the example file as a tf.data.Dataset
+
+      Parameters:
+        * cache (str or None): directory used to cache the scaled and adapted
+          examples after the first epoch, which are then no longer read from
+          the example file. An empty string caches in memory, None disables
+          caching. See the 'datacache' Keras training parameter.
+      """
+      shuffle = self._shuffle and cache == None
+      xspec = tf.TensorSpec( shape=(None,)+tuple(self._model.input_shape[1:]),
+                             dtype=tf.float32 )
+      yspec = tf.TensorSpec( shape=(None,)+self._getOutputShape(),
+                             dtype=tf.as_dtype(dgbhdf5.getCubeLetsOutDType(self._infos)) )
+      ret = tf.data.Dataset.from_generator( lambda: self.batches(shuffle),
+                                        output_signature=(xspec,yspec) )
+      if cache != None:
+          if len(cache) > 0:
+              cache = self._getCacheFile( cache )
+          ret = ret.cache( cache )
+          if self._shuffle:
+              ret = ret.shuffle( max(1,len(self)), reshuffle_each_iteration=True )
+      autotune = tf.data.AUTOTUNE
+      if self._nrclasses > 0:
+          ret = ret.map( getOneHotFn(self._nrclasses), num_parallel_calls=autotune )
+      return ret.prefetch( autotune )
+
+  def _getCacheFile(self,cachedir):
+      """ Cache file of this chunk and data set in cachedir, without
+          the content cached by an earlier training
+      """
+      import glob
+      import os
+      os.makedirs( cachedir, exist_ok=True )
+      setnm = 'validation' if self._forvalid else 'training'
+      cachefnm = os.path.join( cachedir, setnm+'_'+str(self._ichunk) )
+      for fnm in glob.glob( cachefnm+'.*' ):
+          os.remove( fnm )
+      return cachefnm
+
 import importlib
 import pkgutil
 import inspect
@@ -20,6 +20,7 @@ confdictstr = 'confidence'
 datasetdictstr = 'datasets'
 dbkeydictstr = 'dbkey'
 decimkeystr = 'decimation'
+defbatchstr = 'defaultbatchsz'
 dtypeconf = 'confdtype'
 dtypepred = 'preddtype'
 dtypeprob = 'probdtype'
@@ -40,9 +41,12 @@ nroutdictstr = 'nroutputs'
 pathdictstr = 'path'
 plfdictstr = 'platform'
 preddictstr = 'prediction'
+prefercpustr = 'prefercpu'
 probadictstr = 'probabilities'
+quantizedictstr = 'quantize'
 rangedictstr = 'range'
 scaledictstr = 'scale'
+streamingdictstr = 'streaming'
 outshapedictstr = 'out_shape'
 segmentdictstr = 'segmentation'
 surveydictstr = 'survey'
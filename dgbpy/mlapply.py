@@ -20,99 +20,123 @@ import dgbpy.mlio as dgbmlio
 
 TrainType = Enum( 'TrainType', 'New Resume Transfer', module=__name__ )
 
+scalerblocksize = 64 * 1024 * 1024
+streamingmemfraction = 0.5
+
+def useStreaming( infos, streaming=None ):
+  """ Whether the training examples are read one batch at a time from the
+      example file, instead of being loaded at once
+
+  Parameters:
+    * infos (dict): information about example file
+    * streaming (bool or None): force (True) or disable (False) streaming.
+      With None, the examples are streamed if they need more than
+      streamingmemfraction of the available memory
+
+  Returns:
+    * bool
+  """
+
+  if streaming != None:
+    return bool( streaming )
+  if dgbkeys.estimatedsizedictstr in infos:
+    examplessz = infos[dgbkeys.estimatedsizedictstr]
+  else:
+    examplessz = dgbhdf5.getTotalSize( infos )
+  import psutil
+  return examplessz > streamingmemfraction * psutil.virtual_memory().available
+
+def getScalerBatchSize( infos ):
+  inpshape = dgbhdf5.getCubeLetsShapes( infos, 1 )[0]
+  examplesize = np.prod( inpshape, dtype=np.int64 ) * np.dtype(np.float32).itemsize
+  return max( 1, int(scalerblocksize // examplesize) )
+
+def computeScalerStats_( datasets, infos, scalebyattrib, stats=None ):
+  """ Accumulates the statistics needed by the scaler, one block of examples at a time
+
+  Parameters:
+    * datasets (dict): dataset
+    * infos (dict): information about example file
+    * scalebyattrib (bool): compute the statistics by attribute
+    * stats (tuple): statistics to be merged with, see dgbscikit.getScalerStats
+  """
+
+  import dgbpy.dgbscikit as dgbscikit
+  if dgbkeys.traindictstr in datasets:
+    dsetsels = [datasets[dgbkeys.traindictstr]]
+    if dgbkeys.validdictstr in datasets:
+      dsetsels.append( datasets[dgbkeys.validdictstr] )
+  else:
+    dsetsels = [datasets]
+  batchsize = getScalerBatchSize( infos )
+  for dsetsel in dsetsels:
+    for batch in dgbhdf5.getCubeLetsIter( infos, dsetsel, batchsize ):
+      x_data = batch[dgbkeys.xtraindictstr]
+      if len(x_data) < 1:
+        continue
+      stats = dgbscikit.mergeScalerStats( stats,
+                          dgbscikit.getScalerStats(x_data,scalebyattrib) )
+  return stats
+
 def computeScaler_( datasets, infos, scalebyattrib ):
   """ Computes scaler
 
   Parameters:
     * datasets (dict): dataset
     * infos (dict): information about example file
-    * scalebyattrib (bool): 
+    * scalebyattrib (bool): compute the scaling by attribute
   """
 
-  ret = dgbmlio.getTrainingDataByInfo( infos, datasets )
-  allx = list()
-  if dgbkeys.xtraindictstr in ret:
-    if len(ret[dgbkeys.xtraindictstr]) > 0:
-      allx.append( ret[dgbkeys.xtraindictstr] )
-  if dgbkeys.xvaliddictstr in ret:
-    if len(ret[dgbkeys.xvaliddictstr]) > 0:
-      allx.append( ret[dgbkeys.xvaliddictstr] )
-  if len(allx) > 0:
-    x_data = np.concatenate( allx )
-    return getScaler( x_data, byattrib=scalebyattrib )
-  return None
+  stats = computeScalerStats_( datasets, infos, scalebyattrib )
+  if stats == None:
+    return None
+  import dgbpy.dgbscikit as dgbscikit
+  return dgbscikit.getScalerFromStats( stats )
 
 def computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib):
-  chunknb = len(datasets)
-  chunkmean = list()
-  chunkstd = list()
-  chunklen = list()
+  stats = None
   for dataset in datasets:
     datasetchunk = dgbmlio.getDatasetsByGroup( dataset, groupnm )
-    chunksize = 0
-    for keynm in datasetchunk:
-      data = datasetchunk[keynm]
-      if groupnm in data:
-        dsets = data[groupnm]
-        for subgroupnm in dsets:
-          chunksize += len(dsets[subgroupnm])
-    chunklen.append(chunksize)
-    scaleronechunk = computeScaler_( datasetchunk, infos, scalebyattrib )
-    if scaleronechunk == None:
-      chunkmean.append(0)
-      chunkstd.append(0)
-    else:
-      chunkmean.append(scaleronechunk.mean_)
-      chunkstd.append(scaleronechunk.scale_)
-
-  if chunknb < 2:
-    return getNewScaler( chunkmean[0], chunkstd[0] )
-  if scalebyattrib:
-    attrnb = dgbhdf5.getNrAttribs(infos)
-  else:
-    attrnb = 1
-  #Calculate Mean and Var
-  totalmean = list()
-  totalstd = list()
-  for attr in range(attrnb):
-    attrmeansum = 0
-    attrstdsum = 0
-    attrsize = 0
-    for ichunk in range(chunknb):
-      attrchunksize = chunklen[ichunk]
-      if attrchunksize > 0:
-        attrmeansum += chunkmean[ichunk][attr] * attrchunksize
-        attrstdsum += chunkstd[ichunk][attr] * attrchunksize
-      attrsize += attrchunksize
-    if attrsize > 0:
-      attrmeansum /= attrsize
-      attrstdsum /= attrsize
-      totalmean.append( attrmeansum )
-      totalstd.append( attrstdsum )
-  return getNewScaler( totalmean, totalstd )
+    stats = computeScalerStats_( datasetchunk, infos, scalebyattrib, stats )
+  if stats == None:
+    return None
+  import dgbpy.dgbscikit as dgbscikit
+  return dgbscikit.getScalerFromStats( stats )
+
+def getCachedScaler_( infos, datasets, scalebyattrib, computefn ):
+  filenm = infos[dgbkeys.filedictstr]
+  scaler = dgbmlio.getCachedScaler( filenm, datasets, scalebyattrib )
+  if scaler != None:
+    log_msg( 'Using cached scaler' )
+    return scaler
+  printProcessTime( 'Scaler computation', True, print_fn=log_msg )
+  scaler = computefn()
+  printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+  dgbmlio.setCachedScaler( filenm, datasets, scalebyattrib, scaler )
+  return scaler
 
 def computeScaler( infos, scalebyattrib, force=False ):
   datasets = infos[dgbkeys.trainseldicstr]
   inp = infos[dgbkeys.inputdictstr]
   if infos[dgbkeys.learntypedictstr] == dgbkeys.loglogtypestr:
     if not dgbmlio.hasScaler(infos) or force:
-      printProcessTime( 'Scaler computation', True, print_fn=log_msg )
-      scaler = computeScaler_( datasets[0], infos, scalebyattrib )
-      printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+      scaler = getCachedScaler_( infos, datasets[0], scalebyattrib,
+                  lambda: computeScaler_( datasets[0], infos, scalebyattrib ) )
       for groupnm in inp:
         inp[groupnm].update({dgbkeys.scaledictstr: scaler})
   else:
     for groupnm in inp:
       if dgbmlio.hasScaler( infos, groupnm ) and not force:
         continue
-      printProcessTime( 'Scaler computation', True, print_fn=log_msg )
-      scaler = computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib)
-      printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+      groupdatasets = [dgbmlio.getDatasetsByGroup(dataset,groupnm) \
+                       for dataset in datasets]
+      scaler = getCachedScaler_( infos, groupdatasets, scalebyattrib,
+                  lambda: computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib) )
       inp[groupnm].update({dgbkeys.scaledictstr: scaler})
   return infos
 
 def getScaledTrainingData( filenm, flatten=False, scale=True, force=False, 
-                           nbchunks=1, split=None ):
+                           nbchunks=1, split=None, streaming=False ):
   """ Gets scaled training data
 
   Parameters:
@@ -121,6 +145,8 @@ def getScaledTrainingData( filenm, flatten=False, scale=True, force=False,
     * scale (bool or iter): 
     * nbchunks (int): number of data chunks to be created
     * split (float): size of validation data (between 0-1)
+    * streaming (bool or None): only return the info, for reading the examples
+      one batch at a time (see useStreaming and getScaledTrainingBatchesByInfo)
   """
 
   if isinstance(scale,bool):
@@ -138,6 +164,9 @@ def getScaledTrainingData( filenm, flatten=False, scale=True, force=False,
   infos.update({dgbkeys.trainseldicstr: datasets})
   if doscale:
     infos = computeScaler( infos, scalebyattrib, force )
+  if useStreaming( infos, streaming ):
+    log_msg( 'Streaming the training examples from the example file' )
+    return {dgbkeys.infodictstr: infos, dgbkeys.streamingdictstr: True}
   if nbchunks > 1: #Decimate, only need to return the updated info
     return {dgbkeys.infodictstr: infos}
   return getScaledTrainingDataByInfo( infos, flatten=flatten, scale=scale )
@@ -230,6 +259,62 @@ def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0 ):
     ret[dgbkeys.xvaliddictstr] = np.reshape( x_validate, (len(x_validate),-1) )
   return ret
 
+def getScaledTrainingBatchesByInfo( infos, batch_size, forvalidation=False,
+                                    scale=True, ichunk=0, flatten=False,
+                                    shuffle=False, prefetch=2 ):
+  """ Iterates over scaled training data, one batch at a time
+
+  The equivalent of getScaledTrainingDataByInfo for example files that do not
+  fit in memory: the training or validation arrays are never built as a whole.
+
+  Parameters:
+    * infos (dict): information about example file
+    * batch_size (int): number of examples per batch
+    * forvalidation (bool): iterate over the validation data instead of the training data
+    * scale (bool): defaults to True, a scaling object is applied to returned data
+    * ichunk (int): index of the data chunk to iterate over
+    * flatten (bool): reshape the examples to (nrpts,-1)
+    * shuffle (bool): randomize the order of the examples
+    * prefetch (int): number of batches read ahead in a background thread (0 to disable)
+
+  Returns:
+    * generator: (x,y) tuples of at most batch_size examples
+  """
+
+  datasets = infos[dgbkeys.trainseldicstr][ichunk]
+  dsetkey = dgbkeys.validdictstr if forvalidation else dgbkeys.traindictstr
+  def batches():
+    for groupnm in getInputList( datasets ):
+      dsets = dgbmlio.getDatasetsByGroup( datasets, groupnm )
+      if not dsetkey in dsets:
+        continue
+      scaler = None
+      if scale and groupnm in infos[dgbkeys.inputdictstr]:
+        scaler = infos[dgbkeys.inputdictstr][groupnm][dgbkeys.scaledictstr]
+      for batch in dgbmlio.getTrainingDataIterByInfo( infos, dsets[dsetkey],
+                                                      batch_size, shuffle ):
+        x_data = batch[dgbkeys.xtraindictstr]
+        if scaler != None:
+          transform( x_data, scaler )
+        if flatten:
+          x_data = np.reshape( x_data, (len(x_data),-1) )
+        yield (x_data,batch[dgbkeys.ytraindictstr])
+
+  return dgbmlio.prefetch( batches(), prefetch )
+
+def getNrTrainingBatches( infos, batch_size, forvalidation=False, ichunk=0 ):
+  """ Gets the number of batches returned by getScaledTrainingBatchesByInfo
+  """
+
+  datasets = infos[dgbkeys.trainseldicstr][ichunk]
+  dsetkey = dgbkeys.validdictstr if forvalidation else dgbkeys.traindictstr
+  ret = 0
+  for groupnm in getInputList( datasets ):
+    dsets = dgbmlio.getDatasetsByGroup( datasets, groupnm )
+    if dsetkey in dsets:
+      ret += dgbhdf5.getNrBatches( dsets[dsetkey], batch_size )
+  return ret
+
 def getScaler( x_train, byattrib=True ):
   """ Gets scaler object for data scaling
 
@@ -254,24 +339,16 @@ def getNewScaler( mean, scale ):
       data to achieve zero mean and unit variance (fromm sklearn docs)
 
   Returns:
-    * object: scaler (an instance of sklearn.preprocessing..StandardScaler())
+    * object: scaler (a Scaler, with the attributes of sklearn.preprocessing..StandardScaler())
   """
 
-  import dgbpy.dgbscikit as dgbscikit
-  return dgbscikit.getNewScaler( mean, scale )
+  import dgbpy.mlscaler as dgbscaler
+  return dgbscaler.getNewScaler( mean, scale )
 
 def transform(x_train,scaler):
-  nrattribs = scaler.n_samples_seen_
-  if nrattribs > 0:
-    for iattr in range(nrattribs):
-      if nrattribs == 1:
-        inp = x_train
-      else:
-        inp = x_train[:,iattr]
-      inp -= scaler.mean_[iattr]
-      doscale = np.flatnonzero( scaler.scale_ )
-      if (doscale == iattr)[iattr]:
-        inp /= scaler.scale_[iattr]
+  import dgbpy.mlscaler as dgbscaler
+  (factor,offset) = dgbscaler.getAffineTransform( x_train.shape[1], scaler=scaler )
+  return dgbscaler.applyAffineTransform( x_train, factor, offset )
 
 
 def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
@@ -308,6 +385,9 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
 
   trainingdp = None
   validation_split = 0.2 #Params?
+  streaming = None
+  if params != None and dgbkeys.streamingdictstr in params:
+    streaming = params[dgbkeys.streamingdictstr]
   if platform == dgbkeys.kerasplfnm:
     import dgbpy.dgbkeras as dgbkeras
     import tempfile
@@ -318,7 +398,8 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
     trainingdp = getScaledTrainingData( examplefilenm, flatten=False,
                                         scale=True, force=False,
                                         nbchunks=params['nbchunk'],
-                                        split=validation_split )
+                                        split=validation_split,
+                                        streaming=streaming )
     logdir = dgbkeras.getLogDir( examplefilenm, logdir, clearlogs, args )
     if type == TrainType.New:
       model = dgbkeras.getDefaultModel(trainingdp[dgbkeys.infodictstr],
@@ -355,7 +436,8 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
       params = dgbtorch.getParams()
     trainingdp = getScaledTrainingData( examplefilenm, flatten=False,
                                         scale=True, force=False,
-                                        split=validation_split )
+                                        split=validation_split,
+                                        streaming=streaming )
 
     if type == TrainType.New:
       model = dgbtorch.getDefaultModel(trainingdp[dgbkeys.infodictstr], type=params['type']
@@ -370,12 +452,23 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
       params = dgbscikit.getParams()
     trainingdp = getScaledTrainingData( examplefilenm, flatten=True,
                                         scale=True, force=False,
-                                        split=validation_split )
+                                        split=validation_split,
+                                        streaming=streaming )
     if type == TrainType.New:
       model = dgbscikit.getDefaultModel( trainingdp[dgbkeys.infodictstr],
                                          params )
+    if dgbkeys.streamingdictstr in trainingdp and \
+       not dgbscikit.canTrainIncrementally( model ):
+      log_msg( 'Model', model.__class__.__name__, 'cannot be trained incrementally,',
+               'loading all examples' )
+      trainingdp = getScaledTrainingDataByInfo( trainingdp[dgbkeys.infodictstr],
+                                                flatten=True, scale=True )
     print('--Training Started--', flush=True)
-    model = dgbscikit.train( model, trainingdp )
+    if dgbkeys.streamingdictstr in trainingdp:
+      log_msg( 'Training on the examples streamed from the example file' )
+      model = dgbscikit.trainIncremental( model, trainingdp[dgbkeys.infodictstr] )
+    else:
+      model = dgbscikit.train( model, trainingdp )
   else:
     log_msg( 'Unsupported machine learning platform' )
     raise AttributeError
@@ -383,7 +476,9 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
   infos = trainingdp[dgbkeys.infodictstr]
   modtype = dgbmlio.getModelType( infos )
   outfnm = dgbmlio.getSaveLoc( outnm, modtype, args )
-  dgbmlio.saveModel( model, examplefilenm, platform, infos, outfnm )
+  quantize = params != None and dgbkeys.quantizedictstr in params and \
+             params[dgbkeys.quantizedictstr]
+  dgbmlio.saveModel( model, examplefilenm, platform, infos, outfnm, quantize=quantize )
   return (outfnm != None and os.path.isfile( outfnm ))
 
 def reformat( res, applyinfo ):
@@ -405,12 +500,35 @@ def reformat( res, applyinfo ):
     res[dgbkeys.confdictstr] = res[dgbkeys.confdictstr].astype( applyinfo[dgbkeys.dtypeconf] )
   return res
 
-def doApplyFromFile( modelfnm, samples, outsubsel=None ):
+applybatchmem = 256 * 1024 * 1024 #Bytes of input samples per apply batch
+
+def getApplyBatchSize( samplesz, nrsamples, maxbatchsize=None ):
+  """ Gets the number of samples per apply batch
+
+  Parameters:
+    * samplesz (int): size of a single input sample, in bytes
+    * nrsamples (int): number of samples to be applied
+    * maxbatchsize (int): maximum number of samples per batch, None for no limit
+
+  Returns:
+    * int: batch size with at most applybatchmem bytes of input samples,
+      and at most an eighth of the available memory
+  """
+
+  import psutil
+  maxmem = min( applybatchmem, psutil.virtual_memory().available // 8 )
+  batchsize = maxmem // max( 1, samplesz )
+  if maxbatchsize != None:
+    batchsize = min( batchsize, maxbatchsize )
+  return int( max(1, min(nrsamples,batchsize)) )
+
+def doApplyFromFile( modelfnm, samples, outsubsel=None, quantized=False, onnx=False,
+                     sessopts=None ):
   """
   """
 
-  (model,info) = dgbmlio.getModel( modelfnm, fortrain=False )
-  applyinfo = dgbmlio.getApplyInfo( info, outsubsel )
+  (model,info,applyinfo) = dgbmlio.getCachedModel( modelfnm, outsubsel, quantized, onnx,
+                                                   sessopts )
   return doApply( model, info, samples, applyinfo=applyinfo )
 
 def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None ):
@@ -444,7 +562,13 @@ def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None )
     withconfidence = dgbkeys.dtypeconf in applyinfo
 
   res = None
-  if platform == dgbkeys.kerasplfnm:
+  if model.__class__.__name__ == 'OnnxApplyModel':
+    import dgbpy.onnx_classes as dgbonnx
+    if scaler != None:
+      samples = transform( samples, scaler )
+    res = dgbonnx.apply( model, samples, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
+                         batchsize=batchsize )
+  elif platform == dgbkeys.kerasplfnm:
     import dgbpy.dgbkeras as dgbkeras
     res = dgbkeras.apply( model, samples, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
                           scaler=None, batch_size=batchsize  )
@@ -453,7 +577,8 @@ def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None )
     res = dgbscikit.apply( model, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities )
   elif platform == dgbkeys.torchplfnm:
     import dgbpy.dgbtorch as dgbtorch
-    res = dgbtorch.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities )
+    res = dgbtorch.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
+                          batchsize=batchsize )
   elif platform == dgbkeys.numpyvalstr:
     res = numpyApply( samples )
   else:
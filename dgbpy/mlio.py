@@ -8,7 +8,10 @@
 # various tools machine learning data handling
 #
 
+import collections
+import copy
 import os
+import threading
 import numpy as np
 
 import odpy.dbman as oddbman
@@ -19,6 +22,13 @@ nladbdirid = '100060'
 mlinpgrp = 'Deep Learning Example Data'
 mltrlgrp = 'Deep Learning Model'
 dgbtrl = 'dGB'
+modelcachemaxsize = 2 * 1024 * 1024 * 1024
+quantizedgrpnm = 'quantized'
+onnxgrpnm = 'onnx'
+quantcalibsize = 256
+
+__modelcache = collections.OrderedDict()
+__modelcachelock = threading.RLock()
 
 def getInfo( filenm, quick=False ):
   """ Gets information from an example file
@@ -164,6 +174,127 @@ def hasScaler( infos, inputsel=None ):
       return False
   return True
 
+scalercachesuffix = '.scalers.json'
+scalercachemaxsize = 32
+
+def getScalerCacheFile( filenm ):
+  return os.path.splitext( filenm )[0] + scalercachesuffix
+
+def getFileFingerprint_( filenm ):
+  st = os.stat( filenm )
+  return {
+    'path': os.path.abspath( filenm ),
+    'mtime': st.st_mtime_ns,
+    'size': st.st_size
+  }
+
+def getScalerCacheKey_( datasets, scalebyattrib ):
+  import hashlib
+  import json
+  if not isinstance(datasets,list):
+    datasets = [datasets]
+  groups = {}
+  for dataset in datasets:
+    if dgbkeys.traindictstr in dataset:
+      dsetsels = [dataset[keynm] for keynm in dataset]
+    else:
+      dsetsels = [dataset]
+    for dsetsel in dsetsels:
+      for groupnm in dsetsel:
+        collsel = groups.setdefault( groupnm, {} )
+        for collnm in dsetsel[groupnm]:
+          collsel.setdefault( collnm, set() ).update(
+                                    str(nm) for nm in dsetsel[groupnm][collnm] )
+  selection = {groupnm: {collnm: sorted(groups[groupnm][collnm]) \
+                         for collnm in groups[groupnm]} for groupnm in groups}
+  keytxt = json.dumps( [selection,bool(scalebyattrib)], sort_keys=True )
+  return hashlib.sha1( keytxt.encode() ).hexdigest()
+
+def readScalerCache_( filenm ):
+  import json
+  cachefnm = getScalerCacheFile( filenm )
+  if not os.path.isfile(cachefnm):
+    return None
+  try:
+    with open( cachefnm, 'r', encoding='utf-8' ) as fp:
+      cache = json.load( fp )
+  except (OSError,ValueError):
+    return None
+  if cache.get('file') != getFileFingerprint_(filenm):
+    try:
+      os.remove( cachefnm )
+    except OSError:
+      pass
+    return None
+  return cache
+
+def getCachedScaler( filenm, datasets, scalebyattrib ):
+  """ Gets a previously computed scaler from the example file cache
+
+  Parameters:
+    * filenm (str): example file name/path in hdf5 format
+    * datasets (dict or list): dataset selection the scaler was computed from
+    * scalebyattrib (bool): the scaler was computed by attribute
+
+  Returns:
+    * object: scaler (a Scaler, see mlscaler.getNewScaler), or None if not
+      in the cache, or if the example file changed since
+  """
+
+  cache = readScalerCache_( filenm )
+  if cache == None:
+    return None
+  key = getScalerCacheKey_( datasets, scalebyattrib )
+  if not key in cache['scalers']:
+    return None
+  entry = cache['scalers'][key]
+  import dgbpy.mlscaler as dgbscaler
+  return dgbscaler.getNewScaler( entry['mean'], entry['scale'] )
+
+def setCachedScaler( filenm, datasets, scalebyattrib, scaler ):
+  """ Stores a scaler in the example file cache (a file next to the example file)
+
+  Parameters:
+    * filenm (str): example file name/path in hdf5 format
+    * datasets (dict or list): dataset selection the scaler was computed from
+    * scalebyattrib (bool): the scaler was computed by attribute
+    * scaler (obj): scaler (an instance of sklearn.preprocessing..StandardScaler())
+
+  Only the most recently stored scalers are kept, and all entries are removed
+  once the example file is modified.
+  """
+
+  import json
+  import time
+  if scaler == None:
+    return
+  cache = readScalerCache_( filenm )
+  if cache == None:
+    cache = {
+      'file': getFileFingerprint_( filenm ),
+      'scalers': {}
+    }
+  scalers = cache['scalers']
+  scalers.update({ getScalerCacheKey_(datasets,scalebyattrib): {
+    'mean': np.asarray(scaler.mean_,dtype=np.float64).tolist(),
+    'scale': np.asarray(scaler.scale_,dtype=np.float64).tolist(),
+    'time': time.time()
+  }})
+  while len(scalers) > scalercachemaxsize:
+    oldest = min( scalers, key=lambda key: scalers[key]['time'] )
+    del scalers[oldest]
+  cachefnm = getScalerCacheFile( filenm )
+  tmpfnm = cachefnm + '.' + str(os.getpid())
+  try:
+    with open( tmpfnm, 'w', encoding='utf-8' ) as fp:
+      json.dump( cache, fp )
+    os.replace( tmpfnm, cachefnm )
+  except OSError:
+    from odpy.common import log_msg
+    log_msg( '[Warning] Could not write the scaler cache:', cachefnm )
+    if os.path.exists(tmpfnm):
+      os.remove( tmpfnm )
+
 def getDatasetsByGroup( dslist, groupnm ):
   ret = {}
   for keynm in dslist:
@@ -249,33 +380,118 @@ def getTrainingDataByInfo( info, dsetsel=None ):
                               info[dgbkeys.classesdictstr] )
   return ret
 
+def getTrainingDataIterByInfo( info, dsetsel, batch_size, shuffle=False ):
+  """ Iterates over training data from file info, one batch at a time
+
+  Parameters:
+    * info (dict): information about example file
+    * dsetsel (dict): dataset selection, by group and collection
+    * batch_size (int): number of examples per batch
+    * shuffle (bool): randomize the order of the examples
+
+  Returns:
+    * generator: dict with x_train and y_train arrays of batch_size examples,
+      the class values being normalized for classification
+  """
+
+  isclass = dgbkeys.classdictstr in info and info[dgbkeys.classdictstr]
+  if isclass and not dgbkeys.classesdictstr in info:
+    info.update({dgbkeys.classesdictstr: dgbhdf5.getClassIndicesFromData(info)})
+  for batch in dgbhdf5.getCubeLetsIter( info, dsetsel, batch_size, shuffle ):
+    if isclass:
+      normalize_class_vector( batch[dgbkeys.ytraindictstr], \
+                              info[dgbkeys.classesdictstr] )
+    yield batch
+
+def prefetch( batches, maxsize=2 ):
+  """ Reads the items of an iterable in a background thread
+
+  At most maxsize items are kept ready in a bounded queue, ahead of the consumer.
+
+  Parameters:
+    * batches (iter): iterable to be prefetched, typically a batch generator
+    * maxsize (int): maximum number of prefetched items
+
+  Returns:
+    * generator: the items of batches, in the same order
+  """
+
+  if maxsize < 1:
+    yield from batches
+    return
+
+  import queue
+  items = queue.Queue( maxsize=maxsize )
+  stopped = threading.Event()
+  finished = object()
+  def put( item ):
+    while not stopped.is_set():
+      try:
+        items.put( item, timeout=0.1 )
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def producer():
+    try:
+      for item in batches:
+        if not put( (item,None) ):
+          return
+      put( (finished,None) )
+    except Exception as e:
+      put( (finished,e) )
+
+  thread = threading.Thread( target=producer, daemon=True )
+  thread.start()
+  try:
+    while True:
+      (item,err) = items.get()
+      if err != None:
+        raise err
+      if item is finished:
+        break
+      yield item
+  finally:
+    stopped.set()
+    thread.join()
+
 def getClasses( info, y_vectors ):
   if not info[dgbkeys.classdictstr] or dgbkeys.classesdictstr in info:
     return info
   import numpy as np
-  classes = []
+  values = None
   for y_vec in y_vectors:
-    (minval,maxval) = ( np.min(y_vec), np.max(y_vec) )
-    for idx in np.arange(minval,maxval+1,1,dtype=np.uint8):
-      if np.any(y_vec == idx ):
-        classes.append( idx )
-  if len(classes) > 0:
-    info.update( {dgbkeys.classesdictstr: np.array(classes,dtype=np.uint8)} )
+    values = dgbhdf5.getUniqueValues( y_vec, values )
+  if values is None:
+    return info
+  values = values[(values >= 0) & (values < 256) & (values == np.floor(values))]
+  if len(values) > 0:
+    info.update( {dgbkeys.classesdictstr: values.astype(np.uint8)} )
   return info
 
 def normalize_class_vector( arr, classes ):
   import numpy as np
   classes = np.sort( classes )
-  for i in range( len(classes) ):
-    arr[arr == classes[i]] = i
+  if len(classes) < 1:
+    return
+  vals = arr.reshape( -1 ) if arr.flags.c_contiguous else arr
+  idxs = np.searchsorted( classes, vals )
+  np.minimum( idxs, len(classes)-1, out=idxs )
+  np.copyto( vals, idxs, casting='unsafe', where=classes[idxs] == vals )
 
 def unnormalize_class_vector( arr, classes ):
   import numpy as np
   classes = np.sort( classes )
-  for i in reversed(range( len(classes) ) ):
-    arr[arr == i] = classes[i]
-
-def saveModel( model, inpfnm, platform, infos, outfnm ):
+  if len(classes) < 1:
+    return
+  vals = arr.reshape( -1 ) if arr.flags.c_contiguous else arr
+  idxs = vals.astype( np.int64 )
+  valid = (idxs >= 0) & (idxs < len(classes)) & (idxs == vals)
+  np.clip( idxs, 0, len(classes)-1, out=idxs )
+  np.copyto( vals, classes[idxs], casting='unsafe', where=valid )
+
+def saveModel( model, inpfnm, platform, infos, outfnm, quantize=False ):
   """ Saves trained model for any platform workflow
 
   Parameters:
@@ -284,6 +500,8 @@ def saveModel( model, inpfnm, platform, infos, outfnm ):
     * platform (str): machine learning platform (options; keras, Scikit-learn, torch)
     * infos (dict): example file info
     * outfnm (str): name of model to be saved
+    * quantize (bool): also save an int8 quantized version of the model,
+      for CPU inference (see quantizeModel)
   """
 
   from odpy.common import log_msg
@@ -306,31 +524,384 @@ def saveModel( model, inpfnm, platform, infos, outfnm ):
     log_msg( 'Unsupported machine learning platform' )
     raise AttributeError
   dgbhdf5.addInfo( inpfnm, platform, outfnm, infos, model.__class__.__name__ )
+  if quantize:
+    try:
+      quantizeModel( model, platform, infos, outfnm )
+    except Exception as e:
+      log_msg( '[Warning] Could not quantize the model:', repr(e) )
+  clearModelCache( outfnm )
   log_msg( 'Model saved.' )
 
-def getModel( modelfnm, fortrain=False, pars=None ):
+def getPlatformModule_( platform ):
+  if platform == dgbkeys.kerasplfnm:
+    import dgbpy.dgbkeras as dgbkeras
+    return dgbkeras
+  elif platform == dgbkeys.scikitplfnm:
+    import dgbpy.dgbscikit as dgbscikit
+    return dgbscikit
+  elif platform == dgbkeys.torchplfnm:
+    import dgbpy.dgbtorch as dgbtorch
+    return dgbtorch
+  return None
+
+def getCalibrationData_( infos, nrsamples ):
+  """ Random sample of the training examples of all input groups (reservoir
+      sampling), or of the validation examples if there are no training examples
+  """
+
+  import dgbpy.mlapply as dgbmlapply
+  for forvalidation in (False,True):
+    x_calib = None
+    y_calib = None
+    nrseen = 0
+    for (x_data,y_data) in dgbmlapply.getScaledTrainingBatchesByInfo( infos,
+                                         nrsamples, forvalidation=forvalidation,
+                                         scale=True ):
+      if x_calib is None:
+        x_calib = np.empty( (nrsamples,)+x_data.shape[1:], dtype=x_data.dtype )
+        y_calib = np.empty( (nrsamples,)+y_data.shape[1:], dtype=y_data.dtype )
+      idxs = nrseen + np.arange( len(x_data) )
+      nrseen += len(x_data)
+      dest = np.where( idxs < nrsamples, idxs, np.random.randint(0,idxs+1) )
+      keep = dest < nrsamples
+      x_calib[dest[keep]] = x_data[keep]
+      y_calib[dest[keep]] = y_data[keep]
+    if x_calib is not None:
+      nrkept = min( nrseen, nrsamples )
+      return (x_calib[:nrkept],y_calib[:nrkept])
+  return (None,None)
+
+def getValidationBatches_( infos, batch_size ):
+  """ Iterates over the validation examples of all chunks """
+
+  import dgbpy.mlapply as dgbmlapply
+  for ichunk in range(len(infos[dgbkeys.trainseldicstr])):
+    for batch in dgbmlapply.getScaledTrainingBatchesByInfo( infos, batch_size,
+                                         forvalidation=True, scale=True,
+                                         ichunk=ichunk ):
+      yield batch
+
+def quantizeModel( model, platform, infos, modelfnm ):
+  """ Saves an int8 quantized version of a saved model
+
+  The model is exported to ONNX and quantized with onnxruntime: statically
+  for neural networks, calibrated on a random sample of the training split,
+  and dynamically (weights only) for scikit-learn models. The quantized model
+  is compared with the float model on the whole validation split, read one
+  batch at a time.
+  The quantized model file name and the comparison report are recorded in the
+  quantizedgrpnm group of the model file.
+
+  Parameters:
+    * model (obj): trained model on any platform
+    * platform (str): machine learning platform (options; keras, Scikit-learn, torch)
+    * infos (dict): example file info, with the training selection
+    * modelfnm (str): saved model file name/path in hdf5 format
+
+  Returns:
+    * dict: comparison report (see onnx_classes.compareModelsByBatches), None on failure
+  """
+
+  import json
+  from odpy.common import log_msg
+  import odpy.hdf5 as odhdf5
+  import dgbpy.onnx_classes as dgbonnx
+  platmod = getPlatformModule_( platform )
+  floatfnm = getOnnxModelFile( modelfnm, export=False )
+  if floatfnm == None:
+    floatfnm = exportOnnxModel_( model, platform, infos, modelfnm )
+  if floatfnm == None:
+    log_msg( 'No ONNX export available for this model, it is not quantized' )
+    return None
+
+  calibsamples = None
+  if platform != dgbkeys.scikitplfnm:
+    (x_data,_) = getCalibrationData_( infos, quantcalibsize )
+    if x_data is None:
+      log_msg( 'No examples available to calibrate the quantization' )
+      return None
+    calibsamples = platmod.adaptToOnnx( model, infos, x_data )
+  quantfnm = dgbonnx.quantizeModel( floatfnm, calibsamples )
+  isclassification = infos[dgbkeys.classdictstr]
+  outidx = 0 if platform == dgbkeys.scikitplfnm else -1
+  batches = ((platmod.adaptToOnnx(model,infos,x_valid),y_valid) \
+             for (x_valid,y_valid) in getValidationBatches_(infos,quantcalibsize))
+  report = dgbonnx.compareModelsByBatches( floatfnm, quantfnm, batches,
+                                           isclassification, outidx=outidx )
+  log_msg( 'Quantized model:', json.dumps(report) )
+
+  h5file = odhdf5.openFile( modelfnm, 'r+' )
+  if quantizedgrpnm in h5file:
+    del h5file[quantizedgrpnm]
+  quantgrp = h5file.create_group( quantizedgrpnm )
+  odhdf5.setAttr( quantgrp, dgbkeys.pathdictstr, quantfnm )
+  odhdf5.setAttr( quantgrp, 'report', json.dumps(report) )
+  h5file.close()
+  return report
+
+def getQuantizedModelFile( modelfnm ):
+  """ Gets the file name of the quantized version of a model, if any
+
+  Parameters:
+    * modelfnm (str): model file path/name in hdf5 format
+
+  Returns:
+    * str: quantized onnx model file path/name, None if not quantized
+  """
+
+  import odpy.hdf5 as odhdf5
+  h5file = odhdf5.openFile( modelfnm, 'r' )
+  ret = None
+  if quantizedgrpnm in h5file:
+    quantfnm = odhdf5.getText( h5file[quantizedgrpnm], dgbkeys.pathdictstr )
+    ret = str( dgbhdf5.translateFnm(quantfnm,modelfnm) )
+  h5file.close()
+  if ret != None and not os.path.exists(ret):
+    ret = None
+  return ret
+
+def exportOnnxModel_( model, platform, infos, modelfnm ):
+  import odpy.hdf5 as odhdf5
+  platmod = getPlatformModule_( platform )
+  onnxfnm = os.path.splitext( modelfnm )[0] + '.onnx'
+  if platform == dgbkeys.torchplfnm:
+    onnxfnm = platmod.exportOnnx( model, infos, onnxfnm )
+  else:
+    onnxfnm = platmod.exportOnnx( model, onnxfnm )
+  if onnxfnm == None:
+    return None
+  data_format = 'channels_first'
+  if platform == dgbkeys.kerasplfnm:
+    data_format = platmod.get_data_format( model )
+  h5file = odhdf5.openFile( modelfnm, 'r+' )
+  if onnxgrpnm in h5file:
+    del h5file[onnxgrpnm]
+  onnxgrp = h5file.create_group( onnxgrpnm )
+  odhdf5.setAttr( onnxgrp, dgbkeys.pathdictstr, onnxfnm )
+  if data_format != None:
+    odhdf5.setAttr( onnxgrp, 'data_format', data_format )
+  h5file.close()
+  return onnxfnm
+
+def getOnnxModelFile( modelfnm, quantized=False, export=True ):
+  """ Gets the ONNX version of a saved model, exporting it if needed
+
+  The ONNX file is the one recorded in the onnxgrpnm group of the model file,
+  the one the model was saved as, or the ONNX file next to the model file.
+  Otherwise the model is loaded with its platform and exported once
+  (Keras with tf2onnx, PyTorch and scikit-learn with their onnx_from functions).
+
+  Parameters:
+    * modelfnm (str): model file path/name in hdf5 format
+    * quantized (bool): get the int8 quantized version if available
+    * export (bool): export the model if there is no ONNX version yet
+
+  Returns:
+    * str: onnx model file path/name, None if not available
+  """
+
+  from odpy.common import log_msg
+  import odpy.hdf5 as odhdf5
+  if quantized:
+    quantfnm = getQuantizedModelFile( modelfnm )
+    if quantfnm != None:
+      return quantfnm
+    log_msg( 'No quantized model available, using the float model' )
+  h5file = odhdf5.openFile( modelfnm, 'r' )
+  onnxfnm = None
+  if onnxgrpnm in h5file:
+    onnxfnm = odhdf5.getText( h5file[onnxgrpnm], dgbkeys.pathdictstr )
+  elif 'model' in h5file and odhdf5.hasAttr( h5file['model'], dgbkeys.pathdictstr ):
+    onnxfnm = odhdf5.getText( h5file['model'], dgbkeys.pathdictstr )
+    if os.path.splitext( onnxfnm )[1] != '.onnx':
+      onnxfnm = None
+  h5file.close()
+  if onnxfnm != None:
+    onnxfnm = str( dgbhdf5.translateFnm(onnxfnm,modelfnm) )
+  else:
+    onnxfnm = os.path.splitext( modelfnm )[0] + '.onnx'
+  if os.path.exists(onnxfnm):
+    return onnxfnm
+  if not export:
+    return None
+  (model,infos) = loadModel_( modelfnm, False, None )
+  log_msg( 'Exporting the model to ONNX' )
+  try:
+    return exportOnnxModel_( model, infos[dgbkeys.plfdictstr], infos, modelfnm )
+  except Exception as e:
+    log_msg( '[Warning] Could not export the model to ONNX:', repr(e) )
+  return None
+
+def getOnnxModel_( modelfnm, infos, quantized, sessopts=None ):
+  from odpy.common import log_msg
+  import odpy.hdf5 as odhdf5
+  from dgbpy.onnx_classes import OnnxApplyModel
+  onnxfnm = getOnnxModelFile( modelfnm, quantized )
+  if onnxfnm == None:
+    log_msg( 'No ONNX version of the model available, using the platform model' )
+    return None
+  platform = infos[dgbkeys.plfdictstr]
+  data_format = 'channels_first'
+  if platform == dgbkeys.kerasplfnm:
+    data_format = 'channels_last'
+    h5file = odhdf5.openFile( modelfnm, 'r' )
+    if onnxgrpnm in h5file:
+      data_format = None
+      if odhdf5.hasAttr( h5file[onnxgrpnm], 'data_format' ):
+        data_format = odhdf5.getText( h5file[onnxgrpnm], 'data_format' )
+    h5file.close()
+  return OnnxApplyModel( onnxfnm, data_format=data_format,
+                         flatten=platform == dgbkeys.scikitplfnm,
+                         sessopts=sessopts )
+
+def getModel( modelfnm, fortrain=False, pars=None, quantized=False, onnx=False,
+              sessopts=None ):
   """ Get model and model information
 
   Parameters:
     * modelfnm (str): model file path/name in hdf5 format
     * fortrain (bool): specifies if the model might be further trained
     * pars (dict): parameters to be used when restoring the model if needed
+    * quantized (bool): load the int8 quantized version of the model if
+      available (see quantizeModel), not for training
+    * onnx (bool): load the model to be applied with onnxruntime, whatever
+      its platform (see getOnnxModelFile), not for training
+    * sessopts (dict): onnxruntime session options of the models applied
+      with onnxruntime (see onnx_classes.getSessionOptions), None for defaults
 
   Returs:
     * tuple: (trained model and model/project info)
+
+  Notes:
+    * Models loaded for applying only (fortrain False, no pars) are kept in
+      a process-wide cache, see getCachedModel
+  """
+
+  if not fortrain and pars == None:
+    with __modelcachelock:
+      entry = getModelCacheEntry_( modelfnm, quantized, onnx, sessopts )
+      return (entry['model'],copy.deepcopy(entry['info']))
+  return loadModel_( modelfnm, fortrain, pars, quantized and not fortrain,
+                     onnx and not fortrain, sessopts )
+
+def getModelMemorySize_( model, modelfnm ):
+  if model.__class__.__name__ == 'OnnxApplyModel':
+    return os.path.getsize( model.name )
+  if hasattr(model,'count_params'):
+    return model.count_params() * 4
+  if hasattr(model,'state_dict'):
+    model = model.state_dict()
+  if isinstance(model,dict):
+    tensors = [val for val in model.values() if hasattr(val,'element_size')]
+    if len(tensors) > 0:
+      return sum( [tensor.numel()*tensor.element_size() for tensor in tensors] )
+  return os.path.getsize( modelfnm )
+
+def getModelCacheEntry_( modelfnm, quantized, onnx, sessopts ):
+  modelfnm = os.path.abspath( modelfnm )
+  mtime = os.stat( modelfnm ).st_mtime_ns
+  sesskey = None
+  if sessopts != None:
+    sesskey = tuple( sorted(sessopts.items()) )
+  key = (modelfnm,mtime,quantized,onnx,sesskey)
+  if key in __modelcache:
+    __modelcache.move_to_end( key )
+    entry = __modelcache[key]
+  else:
+    for oldkey in [oldkey for oldkey in __modelcache \
+                   if oldkey[0] == modelfnm and oldkey[1] != mtime]:
+      del __modelcache[oldkey]
+    (model,infos) = loadModel_( modelfnm, False, None, quantized, onnx, sessopts )
+    if onnx:
+      # The ONNX export is recorded in the model file
+      key = (modelfnm,os.stat(modelfnm).st_mtime_ns,quantized,onnx,sesskey)
+    entry = {
+      'model': model,
+      'info': infos,
+      'size': getModelMemorySize_( model, modelfnm ),
+      'applyinfo': {}
+    }
+    if entry['size'] <= modelcachemaxsize:
+      __modelcache.update({key: entry})
+    while sum([itm['size'] for itm in __modelcache.values()]) > modelcachemaxsize:
+      __modelcache.popitem( last=False )
+  return entry
+
+def getCachedModel( modelfnm, outsubsel=None, quantized=False, onnx=False,
+                    sessopts=None ):
+  """ Gets a model to be applied, loading it only if not in the model cache
+
+  The cache is keyed by model file path and modification time (and the way
+  the model is loaded), and holds at
+  most modelcachemaxsize bytes of (estimated) model size, evicting the least
+  recently used models first.
+
+  Parameters:
+    * modelfnm (str): model file path/name in hdf5 format
+    * outsubsel (dict): output selection for the apply info (see getApplyInfo)
+    * quantized (bool): get the int8 quantized version of the model if available
+    * onnx (bool): get the model to be applied with onnxruntime
+    * sessopts (dict): onnxruntime session options of the models applied
+      with onnxruntime (see onnx_classes.getSessionOptions), None for defaults
+
+  Returns:
+    * tuple: (trained model, model info, apply info)
+  """
+
+  with __modelcachelock:
+    entry = getModelCacheEntry_( modelfnm, quantized, onnx, sessopts )
+    applykey = repr( outsubsel )
+    if not applykey in entry['applyinfo']:
+      entry['applyinfo'].update({applykey: getApplyInfo(entry['info'],outsubsel)})
+    return (entry['model'],copy.deepcopy(entry['info']),
+            copy.deepcopy(entry['applyinfo'][applykey]))
+
+def clearModelCache( modelfnm=None ):
+  """ Removes a model file, or all models, from the model cache
+
+  Parameters:
+    * modelfnm (str): model file path/name in hdf5 format, None for all models
   """
 
+  with __modelcachelock:
+    if modelfnm == None:
+      __modelcache.clear()
+      return
+    modelfnm = os.path.abspath( modelfnm )
+    for key in [key for key in __modelcache if key[0] == modelfnm]:
+      del __modelcache[key]
+
+def loadModel_( modelfnm, fortrain, pars, quantized=False, onnx=False, sessopts=None ):
   infos = getInfo( modelfnm )
   platform = infos[dgbkeys.plfdictstr]
-  if platform == dgbkeys.kerasplfnm:
+  if onnx:
+    model = getOnnxModel_( modelfnm, infos, quantized, sessopts )
+    if model != None:
+      return (model,infos)
+  quantfnm = None
+  if quantized:
+    from odpy.common import log_msg
+    quantfnm = getQuantizedModelFile( modelfnm )
+    if quantfnm == None:
+      log_msg( 'No quantized model available, using the float model' )
+    elif platform == dgbkeys.kerasplfnm:
+      log_msg( 'Quantized Keras models cannot be applied with Keras, using the float model' )
+      quantfnm = None
+  if quantfnm != None and platform == dgbkeys.scikitplfnm:
+    from dgbpy.sklearn_classes import OnnxModel
+    model = OnnxModel( quantfnm, sessopts )
+  elif quantfnm != None and platform == dgbkeys.torchplfnm:
+    from dgbpy.torch_classes import OnnxModel
+    model = OnnxModel( quantfnm, sessopts )
+  elif platform == dgbkeys.kerasplfnm:
     import dgbpy.dgbkeras as dgbkeras
     model = dgbkeras.load( modelfnm, fortrain, infos, pars )
   elif platform == dgbkeys.scikitplfnm:
     import dgbpy.dgbscikit as dgbscikit
-    model = dgbscikit.load( modelfnm )
+    model = dgbscikit.load( modelfnm, sessopts )
   elif platform == dgbkeys.torchplfnm:
     import dgbpy.dgbtorch as dgbtorch
-    model = dgbtorch.load(modelfnm)
+    model = dgbtorch.load(modelfnm, sessopts)
   else:
     from odpy.common import log_msg
     log_msg( 'Unsupported machine learning platform' )
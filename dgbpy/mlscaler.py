@@ -0,0 +1,147 @@
+#__________________________________________________________________________
+#
+# (C) dGB Beheer B.V.; (LICENSE) http://opendtect.org/OpendTect_license.txt
+# Author:        A. Huck
+# Date:          Jan 2019
+#
+# _________________________________________________________________________
+# scaling of the examples, without any machine learning platform
+#
+
+import numpy as np
+
+class Scaler:
+  """ Standard scaler of given statistics
+
+  Has the fitted attributes of sklearn.preprocessing.StandardScaler
+  (mean_, scale_, var_ and n_samples_seen_), and its transform and
+  inverse_transform methods, without importing scikit-learn.
+  """
+
+  def __init__(self, mean, scale):
+    self.mean_ = np.array( mean )
+    self.scale_ = np.array( scale )
+    self.var_ = np.square( self.scale_ )
+    self.n_samples_seen_ = len(mean)
+
+  def transform(self, samples):
+    (factor,offset) = getAffineTransform( getNrAttribs_(samples), scaler=self )
+    return applyAffineTransform( np.array(samples), factor, offset )
+
+  def inverse_transform(self, samples):
+    (factor,offset) = getAffineTransform( getNrAttribs_(samples), unscaler=self )
+    return applyAffineTransform( np.array(samples), factor, offset )
+
+def getNewScaler( mean, scale ):
+  """ Gets new scaler object
+
+  Parameters:
+    * mean (ndarray of shape (n_features,) or None): mean value to be used for scaling
+    * scale ndarray of shape (n_features,) or None: Per feature relative scaling of the
+      data to achieve zero mean and unit variance (fromm sklearn docs)
+
+  Returns:
+    * object: scaler (a Scaler, with the attributes of sklearn.preprocessing..StandardScaler())
+  """
+
+  return Scaler( mean, scale )
+
+affineblocksize = 1024*1024 #Bytes, kept in the cache between the multiply and the add
+
+def getAffineTransform( nrattribs, scaler=None, unscaler=None ):
+  """ Folds a scaling and an un-scaling into a single multiply-add by attribute
+
+  Parameters:
+    * nrattribs (int): number of attributes of the samples
+    * scaler (object or None): scaler applied first, as with Scaler.transform
+    * unscaler (object or None): scaler reverted next, as with Scaler.inverse_transform
+
+  Returns:
+    * tuple: (factor,offset) double precision arrays of length nrattribs,
+      such that scaled samples = samples * factor + offset
+  """
+
+  factor = np.ones( nrattribs, dtype=np.float64 )
+  offset = np.zeros( nrattribs, dtype=np.float64 )
+  for (scl,forward) in ((scaler,True),(unscaler,False)):
+    if scl == None:
+      continue
+    nrseen = int( scl.n_samples_seen_ )
+    mean = np.asarray( scl.mean_, dtype=np.float64 )[:nrseen]
+    stddev = np.asarray( scl.scale_, dtype=np.float64 )[:nrseen]
+    stddev = np.where( stddev == 0, 1., stddev )
+    if nrseen == 1:
+      idxs = slice( None )
+    else:
+      idxs = slice( 0, min(nrseen,nrattribs) )
+      mean = mean[idxs]
+      stddev = stddev[idxs]
+    if forward:
+      factor[idxs] /= stddev
+      offset[idxs] = (offset[idxs] - mean) / stddev
+    else:
+      factor[idxs] *= stddev
+      offset[idxs] = offset[idxs] * stddev + mean
+  return (factor,offset)
+
+def applyAffineTransform( samples, factor, offset, dtype=None ):
+  """ Applies an affine transform by attribute, in a single pass over the samples
+
+  Parameters:
+    * samples (ndarray): samples, with the attributes along the second axis
+    * factor (ndarray): multiplication factor by attribute, see getAffineTransform
+    * offset (ndarray): offset by attribute, added after the multiplication
+    * dtype (dtype or None): output data type, defaults to the samples data type
+
+  Returns:
+    * ndarray: transformed samples. The samples are modified in place when
+      writeable and of the requested data type
+  """
+
+  if dtype == None:
+    dtype = samples.dtype
+  dtype = np.dtype( dtype )
+  inplace = samples.dtype == dtype and samples.flags.writeable
+  if np.all(factor == 1) and np.all(offset == 0):
+    return samples if samples.dtype == dtype else samples.astype( dtype )
+  if inplace:
+    out = samples
+  else:
+    out = np.empty( samples.shape, dtype=dtype )
+
+  if len(samples.shape) < 2:
+    np.multiply( samples, factor[0], out=out, casting='unsafe' )
+    np.add( out, offset[0], out=out, casting='unsafe' )
+    return out
+
+  nrattribs = samples.shape[1]
+  bcshape = (1,nrattribs) + (1,)*(len(samples.shape)-2)
+  fact = np.reshape( factor, bcshape ).astype( dtype )
+  offs = np.reshape( offset, bcshape ).astype( dtype )
+  if not samples.flags.c_contiguous:
+    np.multiply( samples, fact, out=out, casting='unsafe' )
+    np.add( out, offs, out=out )
+    return out
+
+  nrpts = samples.shape[0]
+  inp = samples.reshape( (nrpts,nrattribs,-1) )
+  outp = out.reshape( (nrpts,nrattribs,-1) )
+  fact = fact.reshape( (1,nrattribs,1) )
+  offs = offs.reshape( (1,nrattribs,1) )
+  nrz = inp.shape[-1]
+  examplesz = max( 1, nrattribs * nrz * max(samples.itemsize,dtype.itemsize) )
+  nrex = max( 1, affineblocksize // examplesz )
+  zstep = nrz if nrex > 1 else max( 1, nrz * affineblocksize // examplesz )
+  for iex in range(0,nrpts,nrex):
+    exsl = slice( iex, iex+nrex )
+    for iz in range(0,nrz,zstep):
+      zsl = slice( iz, iz+zstep )
+      blk = outp[exsl,:,zsl]
+      np.multiply( inp[exsl,:,zsl], fact, out=blk, casting='unsafe' )
+      np.add( blk, offs, out=blk )
+  return out
+
+def getNrAttribs_( samples ):
+  if len(samples.shape) < 2:
+    return 1
+  return samples.shape[1]
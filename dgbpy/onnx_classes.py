@@ -7,7 +7,20 @@
 # _________________________________________________________________________
 # various tools for Onnx model files
 #
-import onnx
+import os
+import threading
+
+onnxsession_dict = {
+  'intra_op_threads': 0,
+  'inter_op_threads': 0,
+  'optimization': 'all',
+  'optimizedcache': False,
+}
+optimizationlevels = ('disable', 'basic', 'extended', 'all')
+optimizedsuffix = '_optimized.onnx'
+
+__sessions = {}
+__sessionslock = threading.Lock()
 
 def __model_type( onnx_model ):
     prodnm = getattr(onnx_model, 'producer_name', 'unknown')
@@ -38,6 +51,7 @@ def __output_shape( onnx_model ):
     return res
 
 def model_info( modelfnm ):
+    import onnx
     model = onnx.load( modelfnm )
     mi = model_info_dict( model )
     return (mi['model_type'], mi['version'], mi['input_shape'], mi['output_shape'])
@@ -49,3 +63,484 @@ def model_info_dict( onnx_model ):
     minfo['input_shape'] = __input_shape(onnx_model)
     minfo['output_shape'] = __output_shape(onnx_model)
     return minfo
+
+def getSessionOptions( intra_op_threads=onnxsession_dict['intra_op_threads'],
+                       inter_op_threads=onnxsession_dict['inter_op_threads'],
+                       optimization=onnxsession_dict['optimization'],
+                       optimizedcache=onnxsession_dict['optimizedcache'] ):
+    """ Gets the options of the onnxruntime inference sessions
+
+    Parameters:
+      * intra_op_threads (int): threads used within an operator (0: onnxruntime default)
+      * inter_op_threads (int): threads used across operators (0: onnxruntime default)
+      * optimization (str): graph optimization level, one of optimizationlevels
+      * optimizedcache (bool): save the optimized graph next to the model file,
+        and use it in later sessions. The optimized graph may be specific to the
+        hardware it was created on.
+    """
+
+    if not optimization in optimizationlevels:
+        raise ValueError( f'Invalid optimization level {optimization}' )
+    return {
+      'intra_op_threads': intra_op_threads,
+      'inter_op_threads': inter_op_threads,
+      'optimization': optimization,
+      'optimizedcache': optimizedcache,
+    }
+
+def __session_options( rt, sessopts ):
+    opts = rt.SessionOptions()
+    opts.intra_op_num_threads = sessopts['intra_op_threads']
+    opts.inter_op_num_threads = sessopts['inter_op_threads']
+    levels = {
+      'disable': rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+      'basic': rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+      'extended': rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+      'all': rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    opts.graph_optimization_level = levels[sessopts['optimization']]
+    return opts
+
+def __create_session( modelfnm, sessopts ):
+    import onnxruntime as rt
+    opts = __session_options( rt, sessopts )
+    if not sessopts['optimizedcache'] or sessopts['optimization'] == 'disable':
+        return rt.InferenceSession( modelfnm, sess_options=opts )
+
+    optfnm = os.path.splitext( modelfnm )[0] + optimizedsuffix
+    if os.path.exists(optfnm) and \
+       os.path.getmtime(optfnm) >= os.path.getmtime(modelfnm):
+        opts.graph_optimization_level = rt.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return rt.InferenceSession( optfnm, sess_options=opts )
+        except Exception:
+            opts = __session_options( rt, sessopts )
+    opts.optimized_model_filepath = optfnm
+    try:
+        return rt.InferenceSession( modelfnm, sess_options=opts )
+    except Exception:
+        # The optimized model could not be written
+        return rt.InferenceSession( modelfnm,
+                                    sess_options=__session_options(rt,sessopts) )
+
+def getInferenceSession( modelfnm, sessopts=None ):
+    """ Gets an onnxruntime inference session for a model file
+
+    Sessions are created once and shared, until the model file is modified.
+
+    Parameters:
+      * modelfnm (str): onnx model file name/path
+      * sessopts (dict): session options, see getSessionOptions
+
+    Returns:
+      * onnxruntime.InferenceSession
+    """
+
+    if not os.path.exists(modelfnm):
+        raise FileNotFoundError( modelfnm )
+    if sessopts == None:
+        sessopts = getSessionOptions()
+    modelfnm = os.path.abspath( modelfnm )
+    mtime = os.stat( modelfnm ).st_mtime_ns
+    key = (modelfnm, mtime, tuple(sorted(sessopts.items())))
+    with __sessionslock:
+        if key in __sessions:
+            return __sessions[key]
+        for oldkey in [oldkey for oldkey in __sessions \
+                       if oldkey[0] == modelfnm and oldkey[1] != mtime]:
+            del __sessions[oldkey]
+        sess = __create_session( modelfnm, sessopts )
+        __sessions.update({key: sess})
+    return sess
+
+quantizedsuffix = '_int8.onnx'
+quantbatchsize = 32
+
+def getBatchSize( modelfnm, sessopts=None ):
+    """ Batch size an onnx model was exported with, None if it is dynamic """
+    batchsz = getInferenceSession( modelfnm, sessopts ).get_inputs()[0].shape[0]
+    if isinstance(batchsz, int) and batchsz > 0:
+        return batchsz
+    return None
+
+def __batches( modelfnm, samples, batchsize=quantbatchsize, sessopts=None ):
+    import numpy as np
+    batchsz = getBatchSize( modelfnm, sessopts )
+    fixed = batchsz != None
+    if not fixed:
+        batchsz = batchsize
+    for start in range(0, len(samples), batchsz):
+        batch = samples[start:start+batchsz]
+        nrsamples = len(batch)
+        if fixed and nrsamples < batchsz:
+            padding = np.zeros( (batchsz-nrsamples,)+batch.shape[1:], dtype=batch.dtype )
+            batch = np.concatenate( (batch,padding) )
+        yield (batch,nrsamples)
+
+def runModel( modelfnm, samples, outidx=-1 ):
+    """ Applies an onnx model on all samples, by batches
+
+    Parameters:
+      * modelfnm (str): onnx model file name/path
+      * samples (ndarray): samples, with the model input shape and type
+      * outidx (int): index of the model output to be returned
+
+    Returns:
+      * ndarray: the requested output for all samples
+    """
+
+    import numpy as np
+    sess = getInferenceSession( modelfnm )
+    inpnm = sess.get_inputs()[0].name
+    outnm = sess.get_outputs()[outidx].name
+    ret = list()
+    for (batch,nrsamples) in __batches( modelfnm, samples ):
+        ret.append( np.asarray(sess.run([outnm], {inpnm: batch})[0])[:nrsamples] )
+    return np.concatenate( ret )
+
+def quantizeModel( modelfnm, calibsamples=None, outfnm=None ):
+    """ Quantizes the weights and activations of an onnx model to int8,
+        for CPU inference
+
+    Parameters:
+      * modelfnm (str): float onnx model file name/path
+      * calibsamples (ndarray or None): samples used for calibrating the
+        activation ranges (static quantization). Without samples only
+        the weights are quantized (dynamic quantization).
+      * outfnm (str): quantized model file name, defaults to the model file
+        name with the quantizedsuffix
+
+    Returns:
+      * str: quantized onnx model file name/path
+    """
+
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, \
+                                         QuantType, CalibrationDataReader
+    if outfnm == None:
+        outfnm = os.path.splitext( modelfnm )[0] + quantizedsuffix
+    if calibsamples is None:
+        quantize_dynamic( modelfnm, outfnm, weight_type=QuantType.QInt8 )
+        return outfnm
+
+    inpnm = getInferenceSession( modelfnm ).get_inputs()[0].name
+    calibbatches = __batches( modelfnm, calibsamples )
+    class CalibrationReader(CalibrationDataReader):
+        def get_next(self):
+            batch = next( calibbatches, None )
+            if batch == None:
+                return None
+            return {inpnm: batch[0]}
+
+    quantize_static( modelfnm, outfnm, CalibrationReader(),
+                     activation_type=QuantType.QInt8, weight_type=QuantType.QInt8 )
+    return outfnm
+
+def compareModels( floatfnm, quantfnm, samples, isclassification, targets=None,
+                   outidx=-1 ):
+    """ Compares the predictions of a quantized model with its float model
+
+    Parameters:
+      * floatfnm (str): float onnx model file name/path
+      * quantfnm (str): quantized onnx model file name/path
+      * samples (ndarray): samples, with the model input shape and type
+      * isclassification (bool): compare the predicted classes, or the values
+      * targets (ndarray or None): expected output, for the accuracy of both models
+      * outidx (int): index of the model output to be compared
+
+    Returns:
+      * dict: comparison report, see compareModelsByBatches
+    """
+
+    return compareModelsByBatches( floatfnm, quantfnm, [(samples,targets)],
+                                   isclassification, outidx )
+
+def compareModelsByBatches( floatfnm, quantfnm, batches, isclassification,
+                            outidx=-1 ):
+    """ Compares the predictions of a quantized model with its float model,
+        on samples given by batches
+
+    Parameters:
+      * floatfnm (str): float onnx model file name/path
+      * quantfnm (str): quantized onnx model file name/path
+      * batches (iterable): (samples,targets) tuples. The samples have the
+        model input shape and type, the targets are the expected output for
+        the accuracy of both models, or None
+      * isclassification (bool): compare the predicted classes, or the values
+      * outidx (int): index of the model output to be compared
+
+    Returns:
+      * dict: comparison report, with the model sizes, the agreement of the
+        predicted classes or the RMS difference of the predicted values,
+        and the accuracy (or RMSE) of both models if the targets are given
+    """
+
+    import numpy as np
+    nrsamples = 0
+    nrvalues = 0
+    nrtargetvalues = 0
+    difference = 0.
+    floaterror = 0.
+    quanterror = 0.
+    for (samples,targets) in batches:
+        floatout = runModel( floatfnm, samples, outidx )
+        quantout = runModel( quantfnm, samples, outidx )
+        nrsamples += len(samples)
+        if isclassification and len(floatout.shape) > 1 and floatout.shape[1] > 1:
+            floatout = np.argmax( floatout, axis=1 )
+            quantout = np.argmax( quantout, axis=1 )
+        if not isclassification:
+            floatout = floatout.astype( np.float64 )
+            quantout = quantout.astype( np.float64 )
+        if targets is not None:
+            targets = np.asarray( targets )
+            if targets.size == floatout.size:
+                targets = targets.reshape( floatout.shape )
+            else:
+                targets = None
+        nrvalues += floatout.size
+        if isclassification:
+            difference += np.count_nonzero( floatout != quantout )
+            if targets is not None:
+                floaterror += np.count_nonzero( floatout != targets )
+                quanterror += np.count_nonzero( quantout != targets )
+        else:
+            difference += np.sum( np.square(floatout-quantout) )
+            if targets is not None:
+                targets = targets.astype( np.float64 )
+                floaterror += np.sum( np.square(floatout-targets) )
+                quanterror += np.sum( np.square(quantout-targets) )
+        if targets is not None:
+            nrtargetvalues += floatout.size
+
+    ret = {
+      'nrsamples': nrsamples,
+      'float_size': os.path.getsize( floatfnm ),
+      'quantized_size': os.path.getsize( quantfnm ),
+    }
+    if nrvalues < 1:
+        return ret
+    if isclassification:
+        ret['agreement'] = float( 1 - difference / nrvalues )
+        if nrtargetvalues > 0:
+            ret['float_accuracy'] = float( 1 - floaterror / nrtargetvalues )
+            ret['quantized_accuracy'] = float( 1 - quanterror / nrtargetvalues )
+    else:
+        ret['rms_difference'] = float( np.sqrt(difference / nrvalues) )
+        if nrtargetvalues > 0:
+            ret['float_rmse'] = float( np.sqrt(floaterror / nrtargetvalues) )
+            ret['quantized_rmse'] = float( np.sqrt(quanterror / nrtargetvalues) )
+    return ret
+
+class OnnxApplyModel:
+    """ A saved model of any platform, applied with onnxruntime only
+
+    Parameters:
+      * filepath (str): onnx model file name/path
+      * data_format (str): position of the attributes axis in the model
+        input and output: 'channels_first', 'channels_last', or None
+      * flatten (bool): the model takes the samples flattened to vectors
+        and returns the labels as first output (scikit-learn models)
+      * sessopts (dict): session options, see getSessionOptions
+    """
+
+    def __init__(self, filepath : str, data_format='channels_first', flatten=False,
+                 sessopts=None):
+        self.name = filepath
+        self.data_format = data_format
+        self.flatten = flatten
+        self.sessopts = sessopts
+
+    def getSession(self):
+        return getInferenceSession( self.name, self.sessopts )
+
+    def getBatchSize(self):
+        """ Batch size the model was exported with, None if it is dynamic """
+        return getBatchSize( self.name, self.sessopts )
+
+    def adaptToModel(self, samples):
+        """ Lays out samples with the attributes along the second axis as the
+            model input: float32, possibly flattened, transposed or with the
+            single-sample dimensions removed
+        """
+
+        import numpy as np
+        nrsamples = len(samples)
+        if self.flatten:
+            return np.ascontiguousarray( np.reshape(samples,(nrsamples,-1)),
+                                         dtype=np.float32 )
+        if self.data_format == 'channels_last' and len(samples.shape) > 2:
+            samples = np.moveaxis( samples, 1, -1 )
+        inpshape = tuple( self.getSession().get_inputs()[0].shape[1:] )
+        if all([isinstance(dim,int) and dim > 0 for dim in inpshape]):
+            samples = np.reshape( samples, (nrsamples,)+inpshape )
+        else:
+            attribaxis = len(samples.shape)-1 if self.data_format == 'channels_last' else 1
+            singleaxes = [ax for ax in range(1,len(samples.shape)) \
+                          if ax != attribaxis and samples.shape[ax] == 1]
+            nrextra = len(samples.shape) - 1 - len(inpshape)
+            if nrextra > 0 and len(singleaxes) >= nrextra:
+                samples = np.squeeze( samples, axis=tuple(singleaxes[:nrextra]) )
+        return np.ascontiguousarray( samples, dtype=np.float32 )
+
+    def predict(self, batch):
+        """ Runs the model on a batch of adapted samples
+
+        Returns:
+          * tuple: (labels, scores). The scores have the model outputs (class
+            scores or regression values) along the second axis. The labels are
+            only returned by the models outputting them (scikit-learn classifiers),
+            None otherwise
+        """
+
+        import numpy as np
+        sess = self.getSession()
+        inpnm = sess.get_inputs()[0].name
+        outputs = sess.get_outputs()
+        labels = None
+        if self.flatten:
+            res = sess.run( [output.name for output in outputs], {inpnm: batch} )
+            if len(res) > 1:
+                labels = np.asarray( res[0] )
+            scores = np.asarray( res[-1] )
+        else:
+            scores = np.asarray( sess.run([outputs[-1].name], {inpnm: batch})[0] )
+            if self.data_format == 'channels_last' and len(scores.shape) > 2:
+                scores = np.moveaxis( scores, -1, 1 )
+        if len(scores.shape) < 2:
+            scores = np.reshape( scores, (len(scores),1) )
+        return (labels, scores)
+
+class ApplyOutputs:
+    """ Output arrays of apply for all samples, filled one batch at a time
+
+    The arrays are allocated when the scores of the first batch are added.
+    Used by the apply of any model returning the scores by batches.
+
+    Parameters:
+      * nrsamples (int): number of samples to be applied
+      * isclassification (bool): the scores are class scores
+      * withpred (bool): return the predicted classes or values
+      * withprobs (list): indices of the class probabilities to be returned
+      * withconfidence (bool): return the difference between the two highest
+        class scores
+      * doprobabilities (bool): return the class probabilities
+    """
+
+    def __init__(self, nrsamples, isclassification, withpred, withprobs,
+                 withconfidence, doprobabilities):
+        import numpy as np
+        self.nrsamples = nrsamples
+        self.isclassification = isclassification
+        self.withpred = withpred
+        self.withconfidence = isclassification and withconfidence
+        self.doprobabilities = isclassification and doprobabilities
+        self.probidxs = None
+        if self.doprobabilities and len(withprobs) > 0:
+            self.probidxs = np.asarray( withprobs )
+        self.predictions = None
+        self.probabilities = None
+        self.confidences = None
+        self.outshape = ()
+        self.pos = 0
+
+    def _allocate(self, scores):
+        import numpy as np
+        nrsamples = self.nrsamples
+        self.outshape = scores.shape[2:]
+        if self.withpred and self.isclassification:
+            self.predictions = np.empty( (nrsamples,1)+self.outshape, dtype=np.int64 )
+        elif self.withpred:
+            self.predictions = np.empty( (nrsamples,)+scores.shape[1:], dtype=scores.dtype )
+        if self.doprobabilities:
+            nrprobs = scores.shape[1] if self.probidxs is None else len(self.probidxs)
+            self.probabilities = np.empty( (nrsamples,nrprobs)+self.outshape,
+                                           dtype=scores.dtype )
+        if self.withconfidence:
+            self.confidences = np.empty( (nrsamples,1)+self.outshape, dtype=scores.dtype )
+
+    def add(self, scores, labels=None):
+        """ Adds the outputs of the next batch of samples
+
+        Parameters:
+          * scores (ndarray): class scores or regression values of the batch,
+            with the outputs along the second axis
+          * labels (ndarray or None): predicted classes, when given by the model
+        """
+
+        import numpy as np
+        if len(scores.shape) < 2:
+            scores = np.reshape( scores, (len(scores),1) )
+        nrbatch = len(scores)
+        if self.pos == 0:
+            self._allocate( scores )
+        outrg = slice( self.pos, self.pos+nrbatch )
+        if self.predictions is not None:
+            if not self.isclassification:
+                self.predictions[outrg] = scores
+            elif labels is not None:
+                self.predictions[outrg] = np.reshape( labels, (nrbatch,1)+self.outshape )
+            else:
+                self.predictions[outrg] = np.argmax( scores, axis=1, keepdims=True )
+        if self.probabilities is not None:
+            self.probabilities[outrg] = scores if self.probidxs is None \
+                                               else scores[:,self.probidxs]
+        if self.confidences is not None:
+            top2 = np.partition( scores, scores.shape[1]-2, axis=1 )[:,-2:]
+            np.subtract( top2[:,1:2], top2[:,0:1], out=self.confidences[outrg] )
+        self.pos += nrbatch
+
+    def get(self):
+        """ Gets the predictions, probabilities and confidences of the samples
+            added so far
+
+        Returns:
+          * dict: the samples are along the last axis, or along the first
+            axis for image to image models, with the outputs (classes,
+            probabilities or values) along the second axis
+        """
+
+        import numpy as np
+        import dgbpy.keystr as dgbkeys
+        ret = {}
+        for (key,res) in ((dgbkeys.preddictstr,self.predictions),
+                          (dgbkeys.probadictstr,self.probabilities),
+                          (dgbkeys.confdictstr,self.confidences)):
+            if res is None:
+                continue
+            res = res[:self.pos]
+            ret.update({key: res if len(self.outshape) > 0 else np.transpose(res)})
+        return ret
+
+def apply( model, samples, isclassification, withpred, withprobs, withconfidence,
+           doprobabilities, batchsize=None ):
+    """ Applies a model exported from any platform with onnxruntime
+
+    Parameters:
+      * model (OnnxApplyModel): model to be applied
+      * samples (ndarray): samples, with the attributes along the second axis
+      * isclassification (bool): the model outputs class scores
+      * withpred (bool): return the predicted classes or values
+      * withprobs (list): indices of the class probabilities to be returned
+      * withconfidence (bool): return the difference between the two highest
+        class scores
+      * doprobabilities (bool): return the class probabilities
+      * batchsize (int): samples per inference run, defaults to
+        mlapply.applybatchmem bytes of samples. Not used by models with
+        a fixed batch size.
+
+    Returns:
+      * dict: predictions, probabilities and confidences, see ApplyOutputs.get
+    """
+
+    samples = model.adaptToModel( samples )
+    nrsamples = len(samples)
+    if batchsize == None:
+        from dgbpy import mlapply as dgbmlapply
+        samplesz = samples[0].nbytes if nrsamples > 0 else 1
+        batchsize = dgbmlapply.getApplyBatchSize( samplesz, nrsamples )
+    outputs = ApplyOutputs( nrsamples, isclassification, withpred, withprobs,
+                            withconfidence, doprobabilities )
+    for (batch,nrbatch) in __batches( model.name, samples, batchsize, model.sessopts ):
+        (labels,scores) = model.predict( batch )
+        outputs.add( scores[:nrbatch], None if labels is None else labels[:nrbatch] )
+    return outputs.get()
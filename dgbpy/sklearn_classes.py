@@ -4,29 +4,29 @@ from joblib import load
 import json
 
 class OnnxModel:
-    def __init__(self, filepath : str):
+    def __init__(self, filepath : str, sessopts=None):
         self.name = filepath
+        self.sessopts = sessopts
 
-    def _do_predict(self,x_data,outidx):
-        if not os.path.exists(str(self.name)):
-            raise FileNotFoundError()
-
-        import onnxruntime as rt
-        import numpy as np
-        sess = rt.InferenceSession(self.name)
+    def _do_predict(self,x_data,outidxs):
+        from dgbpy.onnx_classes import getInferenceSession
+        sess = getInferenceSession( str(self.name), self.sessopts )
         input_name = sess.get_inputs()[0].name
-        label_name = sess.get_outputs()[outidx].name
-        runopts = rt.RunOptions()
-        pred_onx = sess.run([label_name],
-                            {input_name: x_data.astype(np.single)},
-                            run_options=runopts)[0]
-        return np.squeeze( pred_onx )
+        outputs = sess.get_outputs()
+        label_names = [outputs[outidx].name for outidx in outidxs]
+        preds_onx = sess.run(label_names,
+                             {input_name: x_data.astype(np.single,copy=False)})
+        return [np.squeeze( pred_onx ) for pred_onx in preds_onx]
 
     def predict(self,x_data):
-        return self._do_predict(x_data,0)
+        return self._do_predict(x_data,[0])[0]
 
     def predict_proba(self,x_data):
-        return self._do_predict(x_data,1)
+        return self._do_predict(x_data,[1])[0]
+
+    def predict_with_proba(self,x_data):
+        """ Returns the predictions and probabilities from a single run """
+        return tuple(self._do_predict(x_data,[0,1]))
 
 def model_info( modelfnm ):
     model = load( modelfnm )
@@ -11,7 +11,7 @@
 import torch
 import numpy as np
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torch.nn import Linear, ReLU, Sequential, Conv1d, Conv2d, Conv3d
 from torch.nn import MaxPool1d, MaxPool2d, MaxPool3d, Softmax, BatchNorm1d, BatchNorm2d, BatchNorm3d
 from sklearn.metrics import accuracy_score
@@ -19,7 +19,6 @@ import dgbpy.keystr as dgbkeys
 import odpy.common as odcommon
 #import albumentations as A
 
-import onnxruntime as rt
 def Tensor2Numpy(tensor):
     return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
 
@@ -27,15 +26,23 @@ def Numpy2tensor(nparray):
     return torch.from_numpy(nparray)
 
 class OnnxModel():
-    def __init__(self, filepath : str):
+    def __init__(self, filepath : str, sessopts=None):
         self.name = filepath
+        self.sessopts = sessopts
 
     def __call__(self, inputs):
+        from dgbpy.onnx_classes import getInferenceSession
         self.inputs = inputs
-        ort_session = rt.InferenceSession(self.name)
+        ort_session = getInferenceSession(self.name, self.sessopts)
         ort_inputs = {ort_session.get_inputs()[0].name: Tensor2Numpy(self.inputs)}
-        ort_outs = np.array(ort_session.run(None, ort_inputs))[-1]
-        return Numpy2tensor(ort_outs)
+        ort_outname = ort_session.get_outputs()[-1].name
+        ort_outs = ort_session.run([ort_outname], ort_inputs)[0]
+        return Numpy2tensor(np.asarray(ort_outs))
+
+    def getBatchSize(self):
+        """ Batch size the model was exported with, None if it is dynamic """
+        from dgbpy.onnx_classes import getBatchSize
+        return getBatchSize(self.name, self.sessopts)
 
     def eval(self):
         pass
@@ -129,6 +136,21 @@ class Trainer:
         self.validation_accuracy = []
         self.F1_old = float('-inf')
         self.RMSE = 100 ** 10000
+        self.savemodel = self.model
+        self.validation_best = None
+        self.best_state = None
+        self.best_epoch = None
+        self.nrnoimprove = 0
+        self.segmentation = self._isSegmentation()
+
+    def _isSegmentation(self):
+        """ Image to image examples, with a target per input sample """
+        if dgbkeys.xtraindictstr in self.imgdp and dgbkeys.ytraindictstr in self.imgdp:
+            inpdims = len(self.imgdp[dgbkeys.xtraindictstr].shape)
+            outdims = len(self.imgdp[dgbkeys.ytraindictstr].shape)
+            return inpdims == outdims and inpdims == 5
+        from dgbpy.hdf5 import isImg2Img
+        return isImg2Img(self.imgdp[dgbkeys.infodictstr])
 
     def run_trainer(self):
         odcommon.log_msg(f'Device is: {self.device}')
@@ -143,11 +165,20 @@ class Trainer:
                 self._validate()
             """Learning rate scheduler block"""
             if self.lr_scheduler is not None:
-                if self.validation_DataLoader is not None and self.lr_scheduler.__class__.__name__ == 'ReduceLROnPlateau':
-                    self.lr_scheduler.batch(self.validation_loss[i])
+                if self.lr_scheduler.__class__.__name__ == 'ReduceLROnPlateau':
+                    if self.validation_DataLoader is not None:
+                        self.lr_scheduler.step(self.validation_loss[-1])
                 else:
-                    self.lr_scheduler.batch() 
-        odcommon.log_msg(f'Best model with validation accuracy {np.round(self.validation_best, 4)} saved.')
+                    self.lr_scheduler.step()
+            """Early stopping block"""
+            if self.earlystopping and self.nrnoimprove >= self.earlystopping:
+                odcommon.log_msg(f'No improvement for {self.nrnoimprove} epochs, stopping early.')
+                break
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+            self.savemodel = self.model
+            odcommon.log_msg(f'Best model with validation accuracy {np.round(self.validation_best, 4)} '
+                             f'from epoch {self.best_epoch} saved.')
         return (self.savemodel, self.training_loss, self.validation_loss, self.training_accuracy, 
                 self.validation_accuracy, self.learning_rate)
 
@@ -159,13 +190,13 @@ class Trainer:
         for input, target in self.training_DataLoader:
             self.optimizer.zero_grad()
             out = self.model(input) 
-            if len(self.imgdp[dgbkeys.xtraindictstr].shape)==len(self.imgdp[dgbkeys.ytraindictstr].shape) and len(self.imgdp[dgbkeys.xtraindictstr].shape)==5 and classification:
+            if self.segmentation and classification:
                 target = target.type(torch.LongTensor)
                 pred = out.detach().cpu().numpy()
                 pred = np.argmax(pred, axis=1)
                 acc = accuracy_score(pred.flatten(), target.flatten())
                 loss = self.criterion(out, target.squeeze(1))
-            elif len(self.imgdp[dgbkeys.xtraindictstr].shape)>len(self.imgdp[dgbkeys.ytraindictstr].shape) and classification:
+            elif classification:
                 target = target.type(torch.LongTensor)
                 pred = out.detach().numpy()
                 pred = np.argmax(pred, axis=1)
@@ -198,14 +229,14 @@ class Trainer:
         for input, target in self.validation_DataLoader:
             with torch.no_grad():
                 out = self.model(input)
-                if len(self.imgdp[dgbkeys.xtraindictstr].shape)==len(self.imgdp[dgbkeys.ytraindictstr].shape) and len(self.imgdp[dgbkeys.xtraindictstr].shape)==5 and classification:  #segmentation
+                if self.segmentation and classification:  #segmentation
                     target = target.type(torch.LongTensor)
                     target = target[:, :, :, :]
                     val_pred = out.detach().cpu().numpy()
                     val_pred = np.argmax(val_pred, axis=1)
                     acc = accuracy_score(val_pred.flatten(), target.flatten())
                     loss = self.criterion(out, target.squeeze(1))
-                elif len(self.imgdp[dgbkeys.xtraindictstr].shape)>len(self.imgdp[dgbkeys.ytraindictstr].shape) and classification:
+                elif classification:
                     target = target.type(torch.LongTensor)
                     val_pred = out.detach().numpy()
                     val_pred = np.argmax(val_pred, axis=1)
@@ -231,13 +262,21 @@ class Trainer:
             odcommon.log_msg(f'Validation MSE: {np.round(mean_valid_accs, 4)}')
         if self.F1_old < mean_valid_accs and classification:
             self.F1_old = mean_valid_accs
-            self.savemodel = self.model
-            self.validation_best = mean_valid_accs
+            self._snapshot(mean_valid_accs)
         elif self.RMSE > mean_valid_accs and not classification:
             self.F1_old = mean_valid_accs
             self.RMSE = self.F1_old
-            self.savemodel = self.model
-            self.validation_best = mean_valid_accs
+            self._snapshot(mean_valid_accs)
+        else:
+            self.nrnoimprove += 1
+
+    def _snapshot(self, validation_best):
+        """Keeps an in-memory copy of the weights of the best epoch"""
+        self.best_state = {key: value.detach().clone()
+                           for key, value in self.model.state_dict().items()}
+        self.validation_best = validation_best
+        self.best_epoch = self.epoch
+        self.nrnoimprove = 0
 
 ########### 3D RESNET 18 ARCHITECTURE START #############
 
@@ -713,150 +752,130 @@ class UNet(nn.Module):
         d = {self.__class__.__name__: attributes}
         return f'{d}'
 
-class SeismicTrainDataset:
-    def __init__(self, X, y, info,  im_ch, ndims):
+def getExamplesView(arr, ndims):
+    """ View of the example arrays with the singleton dimensions of the
+        lower dimensional models removed, without copying """
+    if ndims == 3:
+        return arr
+    if ndims == 2:
+        return arr[:, :, 0]
+    return arr[:, :, 0, 0]
+
+def removeSharedFiles(filenms):
+    import os
+    for filenm in filenms:
+        try:
+            os.remove(filenm)
+        except OSError:
+            pass
+
+class SeismicArrayDataset(Dataset):
+    """Map-style dataset wrapping in-memory example arrays without copying them.
+
+    The slicing of the examples is decided once at construction. Indexing with a
+    list of indices returns a whole batch using a single fancy-index: use with a
+    BatchSampler in a DataLoader created with batch_size=None, see
+    dgbtorch.getBatchDataLoader."""
+    def __init__(self, X, y, ndims):
         super().__init__()
-        self.im_ch = im_ch
         self.ndims = ndims
-        self.info = info
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
+        self.X = torch.from_numpy(getExamplesView(X.astype('float32', copy=False), ndims))
+        self.y = None
+        if y is not None:
+            y = y.astype('float32', copy=False)
+            if len(X.shape) == len(y.shape):
+                y = getExamplesView(y, ndims)
+            self.y = torch.from_numpy(y)
+        self.shared = None
+
+    def share(self):
+        """ Moves the arrays to memory mapped files, so that worker processes
+            map them instead of receiving a pickled copy of the arrays """
+        if self.shared != None:
+            return
+        import tempfile, weakref
+        self.shared = {}
+        for key in ('X', 'y'):
+            tensor = getattr(self, key)
+            if tensor is None:
+                continue
+            with tempfile.NamedTemporaryFile(suffix='.npy', delete=False) as fp:
+                filenm = fp.name
+            arr = np.lib.format.open_memmap(filenm, mode='w+', dtype=np.float32,
+                                            shape=tuple(tensor.shape))
+            arr[...] = tensor.numpy()
+            arr.flush()
+            del arr
+            self.shared[key] = filenm
+        weakref.finalize(self, removeSharedFiles, list(self.shared.values()))
+        self.__attachShared()
+
+    def __attachShared(self):
+        for key, filenm in self.shared.items():
+            setattr(self, key, torch.from_numpy(np.load(filenm, mmap_mode='c')))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared != None:
+            state['X'] = None
+            state['y'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared != None:
+            self.__attachShared()
 
     def __len__(self):
         return self.X.shape[0]
 
-    def __getitem__(self,index):
-        classification = self.info[dgbkeys.classdictstr]
-        if self.ndims == 3:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:     #segmentation
-                data = self.X[index, :, :, :, :]
-                label = self.y[index, :, :, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:     #supervised
-                data = self.X[index, :, :, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :, :, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :]
-        elif self.ndims == 2:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:     #segmentation
-                data = self.X[index, :, 0, :, :]
-                label = self.y[index, :, 0, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:     #supervised
-                data = self.X[index,  :, 0, :, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :, 0, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :]
-        elif self.ndims == 1:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:     #segmentation
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :, 0, 0, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:     #supervised classification
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :, 0, 0, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :]
-        elif classification:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
-        else:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
-
-        return data, label
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            index = torch.as_tensor(index)
+        if self.y is None:
+            return self.X[index]
+        return self.X[index], self.y[index]
 
-class SeismicTestDataset:
+class SeismicTrainDataset(SeismicArrayDataset):
     def __init__(self, X, y, info,  im_ch, ndims):
-        super().__init__()
+        super().__init__(X, y, ndims)
         self.im_ch = im_ch
-        self.ndims = ndims
         self.info = info
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
 
-    def __len__(self):
-        return self.X.shape[0]
-
-    def __getitem__(self,index):
-        classification = self.info[dgbkeys.classdictstr]
-        if self.ndims == 3:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, :, :, :]
-                label = self.y[index, :, :, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised
-                data = self.X[index, :, :, :, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :, :, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :]
-        elif self.ndims == 2:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, 0, :, :]
-                label = self.y[index, :, 0, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised
-                data = self.X[index, :, 0, :, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :, 0, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :]
-        elif self.ndims == 1:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :, 0, 0, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised classification
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :]
-            elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :, 0, 0, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :]
-        elif classification:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
-        else:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
-
-        return data, label
+class SeismicTestDataset(SeismicArrayDataset):
+    def __init__(self, X, y, info,  im_ch, ndims):
+        super().__init__(X, y, ndims)
+        self.im_ch = im_ch
+        self.info = info
 
-class DatasetApply(Dataset):
+class DatasetApply(SeismicArrayDataset):
     def __init__(self, X, isclassification, im_ch, ndims):
-        super().__init__()
+        super().__init__(X, None, ndims)
         self.im_ch = im_ch
-        self.ndims = ndims
-        self.X = X.astype('float32')
         self.isclassification = isclassification
 
-    def __len__(self):
-        return self.X.shape[0]
-    
-    def __getitem__(self,index):
-        if self.ndims == 3:
-            return self.X[index, :, :, :, :]
-        elif self.ndims == 2:
-            return self.X[index, :, 0, :, :]
-        elif self.ndims == 1:
-            return self.X[index, :, 0, 0, :]
+class StreamingDataset(IterableDataset):
+    """Iterable dataset reading the training examples one batch at a time.
+    Use with a DataLoader created with batch_size=None."""
+    def __init__(self, info, ndims, batch_size, forvalidation=False, ichunk=0, prefetch=2):
+        super().__init__()
+        self.info = info
+        self.ndims = ndims
+        self.batch_size = batch_size
+        self.forvalidation = forvalidation
+        self.ichunk = ichunk
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        from dgbpy import mlapply as dgbmlapply
+        batches = dgbmlapply.getScaledTrainingBatchesByInfo(self.info, self.batch_size,
+                                    self.forvalidation, scale=True, ichunk=self.ichunk,
+                                    shuffle=not self.forvalidation, prefetch=self.prefetch)
+        for x_data, y_data in batches:
+            x_data = getExamplesView(x_data, self.ndims)
+            if len(y_data.shape)==5:
+                y_data = getExamplesView(y_data, self.ndims)
+            yield torch.from_numpy(x_data), torch.from_numpy(y_data.astype('float32'))
 
 import importlib
 import pkgutil
@@ -0,0 +1,58 @@
+import threading
+
+import numpy as np
+
+import dgbpy.keystr as dgbkeys
+from dgbpy.deeplearning_apply_serverlib import ApplyBatcher
+
+class FakeModel:
+    """ Returns transposed outputs, with the samples along the last axis,
+        like dgbpy.mlapply.doApply for models that are not image to image
+    """
+
+    def __init__(self, nrclasses=3):
+        self.nrclasses = nrclasses
+        self.calls = list()
+
+    def apply(self, samples):
+        self.calls.append( len(samples) )
+        values = np.reshape( samples, (len(samples),-1) ).sum( axis=1 )
+        probs = np.stack( [values+iclass for iclass in range(self.nrclasses)] )
+        return {
+          dgbkeys.preddictstr: values[np.newaxis,:],
+          dgbkeys.probadictstr: probs,
+        }
+
+def applyConcurrently(batcher, requests):
+    results = [None] * len(requests)
+    barrier = threading.Barrier( len(requests) )
+    def run(idx):
+        barrier.wait()
+        results[idx] = batcher.apply( requests[idx] )
+    threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_batched_results_split_along_samples_axis():
+    model = FakeModel()
+    batcher = ApplyBatcher( model.apply, maxbatchsize=100, maxwait=2, samplesaxis=-1 )
+    requests = [np.random.rand(nrsamples,1,1,1,8).astype(np.float32) for nrsamples in (3,7)]
+    results = applyConcurrently( batcher, requests )
+    assert model.calls == [10]
+    for samples,result in zip(requests,results):
+        expected = model.apply( samples )
+        for outkey in expected:
+            assert result[outkey].shape == expected[outkey].shape
+            np.testing.assert_allclose( result[outkey], expected[outkey], rtol=1e-6 )
+
+def test_batched_img2img_results_split_along_first_axis():
+    def img2img(samples):
+        return {dgbkeys.preddictstr: samples[:,0] * 2}
+    batcher = ApplyBatcher( img2img, maxbatchsize=100, maxwait=2, samplesaxis=0 )
+    requests = [np.random.rand(nrsamples,1,1,4,4).astype(np.float32) for nrsamples in (2,5)]
+    results = applyConcurrently( batcher, requests )
+    for samples,result in zip(requests,results):
+        np.testing.assert_allclose( result[dgbkeys.preddictstr], samples[:,0] * 2 )
@@ -0,0 +1,39 @@
+import numpy as np
+
+import dgbpy.keystr as dgbkeys
+from dgbpy.onnx_classes import ApplyOutputs
+
+def fill(scores, batchsize, isclassification=True, withprobs=[]):
+    outputs = ApplyOutputs( len(scores), isclassification, True, withprobs,
+                            isclassification, isclassification )
+    for start in range(0,len(scores),batchsize):
+        outputs.add( scores[start:start+batchsize] )
+    return outputs.get()
+
+def test_samples_along_last_axis():
+    scores = np.random.rand(10,3).astype(np.float32)
+    ret = fill( scores, 4, withprobs=[0,2] )
+    assert ret[dgbkeys.preddictstr].shape == (1,10)
+    np.testing.assert_array_equal( ret[dgbkeys.preddictstr][0], np.argmax(scores,axis=1) )
+    np.testing.assert_array_equal( ret[dgbkeys.probadictstr], scores[:,[0,2]].T )
+    top2 = np.sort( scores, axis=1 )[:,-2:]
+    np.testing.assert_allclose( ret[dgbkeys.confdictstr][0], top2[:,1]-top2[:,0] )
+
+def test_regression_values():
+    scores = np.random.rand(7,2).astype(np.float32)
+    ret = fill( scores, 3, isclassification=False )
+    assert list(ret) == [dgbkeys.preddictstr]
+    np.testing.assert_array_equal( ret[dgbkeys.preddictstr], scores.T )
+
+def test_img2img_samples_along_first_axis():
+    scores = np.random.rand(5,3,4,4,2).astype(np.float32)
+    ret = fill( scores, 2 )
+    assert ret[dgbkeys.preddictstr].shape == (5,1,4,4,2)
+    np.testing.assert_array_equal( ret[dgbkeys.preddictstr][:,0], np.argmax(scores,axis=1) )
+    np.testing.assert_array_equal( ret[dgbkeys.probadictstr], scores )
+    assert ret[dgbkeys.confdictstr].shape == (5,1,4,4,2)
+
+def test_img2img_regression():
+    scores = np.random.rand(3,1,8,8).astype(np.float32)
+    ret = fill( scores, 2, isclassification=False )
+    np.testing.assert_array_equal( ret[dgbkeys.preddictstr], scores )